@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""
+Compare coin selection strategies on large pools of spendables - selection time, number of inputs and fee.
+"Provider order" is the first-come accumulation used before multisigcore.coinselect.
+
+    PYTHONPATH=. python benchmarks/coin_selection.py [pool sizes...]
+"""
+from __future__ import print_function
+import random
+import sys
+import time
+
+from multisigcore.coinselect import UTXOPool, FeeModel, BranchAndBound, LargestFirst, SmallestFirst, \
+    RandomImprove, finish
+from pycoin.tx import Spendable
+
+__author__ = 'devrandom'
+
+# a 2 of 3 P2SH input and a P2SH change output, at 10 sat/byte
+FEE_MODEL = FeeModel(10 + 32, 297, 32, 10)
+TARGETS = [10000, 1000000, 50000000]
+
+
+def provider_order(pool, spendables, target, fee_model):
+    selected = []
+    total = 0
+    for spend in spendables:
+        selected.append(spend)
+        total += spend.coin_value
+        if total >= target + fee_model.fee(len(selected), False):
+            return finish(selected, total, target, fee_model)
+    return None
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10000, 100000]
+    rng = random.Random(1)
+    strategies = [
+        ('provider order', None),
+        ('largest first', LargestFirst()),
+        ('smallest first', SmallestFirst()),
+        ('random improve', RandomImprove(random.Random(2))),
+        ('branch and bound', BranchAndBound()),
+    ]
+    for size in sizes:
+        # log-uniform values between 1000 and 10 BTC
+        spendables = [Spendable(int(10 ** rng.uniform(3, 9)), b'', b'\0' * 32, n) for n in range(size)]
+        start = time.time()
+        pool = UTXOPool(spendables)
+        print("%d spendables, index built in %.3fs" % (size, time.time() - start))
+        for target in TARGETS:
+            for name, selector in strategies:
+                start = time.time()
+                if selector is None:
+                    selection = provider_order(pool, spendables, target, FEE_MODEL)
+                else:
+                    selection = selector.select(pool, target, FEE_MODEL)
+                elapsed = time.time() - start
+                print("  target %10d %-18s %8.4fs %5d inputs fee %8d change %10d" % (
+                    target, name, elapsed, len(selection.spendables), selection.fee, selection.change))
+
+
+if __name__ == '__main__':
+    main()
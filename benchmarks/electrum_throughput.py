@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Measure the request throughput of AsyncElectrumService against a local stand-in server that answers each
+request after a random delay of up to 10ms, for several window sizes and with several accounts sharing
+the connection.
+
+    PYTHONPATH=. python3 benchmarks/electrum_throughput.py [addresses]
+"""
+import asyncio
+import sys
+import time
+
+from multisigcore.providers.electrum_async import AsyncElectrumService
+from multisigcore.testing import make_multisig_account
+from multisigcore.testing.electrum_server import StandInElectrumServer
+
+__author__ = 'devrandom'
+
+MAX_DELAY = 0.01
+
+
+async def measure(port, addresses, window, accounts):
+    service = AsyncElectrumService('127.0.0.1', port, ssl=False, window=window)
+    await service.connect()
+    share = len(addresses) // accounts
+    start = time.time()
+    await asyncio.gather(*[service.spendables_for_addresses(addresses[n * share:(n + 1) * share])
+                           for n in range(accounts)])
+    elapsed = time.time() - start
+    await service.close()
+    return elapsed
+
+
+async def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    account = make_multisig_account()
+    addresses = [leaf.address for leaf in account.leaves(0, count, processes=1)]
+    server = StandInElectrumServer({address: [1000] for address in addresses[::10]}, max_delay=MAX_DELAY)
+    port = await server.start()
+    for window in [1, 10, 100, 1000]:
+        for accounts in [1, 10]:
+            if window == 1 and count > 200:
+                sample = addresses[:200]
+            else:
+                sample = addresses
+            elapsed = await measure(port, sample, window, accounts)
+            print("window %4d accounts %2d: %5d requests in %.3fs, %8.0f requests/s" % (
+                window, accounts, len(sample), elapsed, len(sample) / elapsed))
+    await server.close()
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+"""
+Compare the memory used by cached multisig leaf keys stored as lists of BIP32Node objects
+(the representation used before the compact sec store) with multisigcore.cache.SecStore.
+
+    PYTHONPATH=. python benchmarks/key_storage_memory.py [paths]
+"""
+from __future__ import print_function
+import sys
+import tracemalloc
+
+from multisigcore.cache import SecStore
+from multisigcore.testing import wallet_key, recover_key, oracle_key
+from pycoin.key.BIP32Node import BIP32Node
+
+__author__ = 'devrandom'
+
+
+def measure(build):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    kept = build()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    used = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    return kept, used
+
+
+def main():
+    paths = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    chains = [key.public_leaves(0, paths) for key in [wallet_key, recover_key, oracle_key]]
+    secs = [[leaf.sec() for leaf in chain] for chain in chains]
+    leaves = [[(leaf.chain_code(), leaf.public_pair()) for leaf in chain] for chain in chains]
+    del chains
+
+    def build_nodes():
+        return dict(("0/%d" % n, [BIP32Node(netcode='BTC', chain_code=chain[n][0], depth=4, child_index=n,
+                                            public_pair=chain[n][1]) for chain in leaves])
+                    for n in range(paths))
+
+    def build_store():
+        store = SecStore('BTC')
+        for n in range(paths):
+            store["0/%d" % n] = [chain[n] for chain in secs]
+        return store
+
+    _, node_bytes = measure(build_nodes)
+    _, store_bytes = measure(build_store)
+    print("%d paths x 3 cosigners" % (paths,))
+    print("BIP32Node lists: %10d bytes (%d per path)" % (node_bytes, node_bytes // paths))
+    print("SecStore:        %10d bytes (%d per path)" % (store_bytes, store_bytes // paths))
+    print("reduction:       %10.1fx" % (float(node_bytes) / store_bytes))
+
+
+if __name__ == '__main__':
+    main()
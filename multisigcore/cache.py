@@ -0,0 +1,533 @@
+"""
+Compact storage and binary encoding of the account cache.
+
+The public keys of derived leaves are kept as 33 byte compressed secs, in contiguous per-chain
+arrays indexed by leaf number - see :class:`SecStore`.
+
+Layout of the cache (all integers big endian)::
+
+    magic "MSC" | version (2) | netcode length (1) | netcode | issued receive (4) | issued change (4)
+    chain count (4), then for each chain:
+        parent path length (2) | parent path | width (1) | leaf count (4) | present flags (leaf count) | secs
+    path count (4), then for each path that is not stored in a chain:
+        path length (2) | path | sec count (1) | secs
+
+Version 1 caches, where each key was stored as a 74 byte record starting with its sec, and JSON caches
+from earlier versions are still read.
+
+Changes made after a snapshot can be persisted incrementally as an append-only journal of records::
+
+    JOURNAL_SECS (3) | path length (2) | path | sec count (1) | secs
+    JOURNAL_ISSUED (2) | subchain (1, "0" or "1") | issued (4)
+
+A snapshot plus its journal is loaded with :func:`loads`, and can be folded into a new snapshot
+with :func:`compact`.
+"""
+import json
+import struct
+from collections import OrderedDict
+
+from pycoin.key.BIP32Node import BIP32Node
+
+from .derivation import split_leaf_path
+
+__author__ = 'devrandom'
+
+CACHE_MAGIC = b'MSC'
+CACHE_VERSION = 2
+SEC_SIZE = 33
+V1_KEY_RECORD_SIZE = 74
+MAX_LEAF_GAP = 4096
+"""Leaves further than this past the end of their chain array are stored individually"""
+LEAF_BLOCK = 256
+"""Number of leaves per block of a chain, the unit of eviction"""
+
+JOURNAL_KEYS = 1
+"""Version 1 journal record, with 74 byte key records.  Read only."""
+JOURNAL_ISSUED = 2
+JOURNAL_SECS = 3
+
+
+class CacheFormatError(ValueError):
+    pass
+
+
+class LRUCache(object):
+    """A mapping bounded to max_size entries, evicting the least recently used.  Keeps hit/miss statistics."""
+    __slots__ = ['max_size', 'on_evict', 'hits', 'misses', 'evictions', '_d']
+
+    def __init__(self, max_size=None, on_evict=None):
+        """
+        :param int max_size: maximum number of entries, or None for unbounded
+        :param on_evict: called with the key and value of each evicted entry
+        """
+        self.max_size = max_size
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._d = OrderedDict()
+
+    def get(self, key, default=None):
+        """Look up an entry, marking it as recently used"""
+        value = self._d.pop(key, default)
+        if value is default:
+            self.misses += 1
+            return default
+        self._d[key] = value
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        self._d.pop(key, None)
+        self._d[key] = value
+        self.trim()
+
+    def trim(self):
+        """Evict entries until we are within max_size"""
+        if self.max_size is None:
+            return
+        while len(self._d) > self.max_size:
+            key, value = self._d.popitem(last=False)
+            self.evictions += 1
+            if self.on_evict:
+                self.on_evict(key, value)
+
+    def pop(self, key, default=None):
+        return self._d.pop(key, default)
+
+    def clear(self):
+        self._d.clear()
+
+    def __contains__(self, key):
+        return key in self._d
+
+    def __len__(self):
+        return len(self._d)
+
+    def __iter__(self):
+        return iter(list(self._d))
+
+    def stats(self):
+        """:rtype: dict"""
+        return {'size': len(self._d), 'max_size': self.max_size,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class SecChain(object):
+    """
+    The secs of the leaves below one parent path, `width` secs per leaf.  Leaves are kept in contiguous blocks of
+    LEAF_BLOCK leaves, so that blocks can be evicted - see :attr:`SecStore.max_leaves`.
+    """
+    __slots__ = ['width', '_blocks', '_length']
+
+    def __init__(self, width, secs=None, present=None):
+        """
+        :param int width: number of secs per leaf
+        :param bytearray secs: the secs of leaves 0 .. len(present) - 1, concatenated
+        :param bytearray present: a flag per leaf, 1 if its secs are set
+        """
+        self.width = width
+        self._blocks = {}
+        self._length = 0
+        if present:
+            stride = width * SEC_SIZE
+            for block in range(0, (len(present) + LEAF_BLOCK - 1) // LEAF_BLOCK):
+                start = block * LEAF_BLOCK
+                flags = bytearray(present[start:start + LEAF_BLOCK])
+                if 1 not in flags:
+                    continue
+                data = bytearray(secs[start * stride:(start + LEAF_BLOCK) * stride])
+                flags.extend(bytearray(LEAF_BLOCK - len(flags)))
+                data.extend(bytearray(LEAF_BLOCK * stride - len(data)))
+                self._blocks[block] = (flags, data)
+            self._length = len(present)
+
+    def __contains__(self, n):
+        block = self._blocks.get(n // LEAF_BLOCK)
+        return block is not None and block[0][n % LEAF_BLOCK] == 1
+
+    def __len__(self):
+        """One more than the highest leaf number ever set"""
+        return self._length
+
+    def count(self):
+        """:return: the number of leaves stored"""
+        return sum(flags.count(b'\1') for flags, _ in self._blocks.values())
+
+    def can_store(self, n):
+        return n < self._length + MAX_LEAF_GAP
+
+    def set(self, n, secs):
+        stride = self.width * SEC_SIZE
+        block = self._blocks.get(n // LEAF_BLOCK)
+        if block is None:
+            block = self._blocks[n // LEAF_BLOCK] = (bytearray(LEAF_BLOCK), bytearray(LEAF_BLOCK * stride))
+        flags, data = block
+        i = n % LEAF_BLOCK
+        data[i * stride:(i + 1) * stride] = b''.join(secs)
+        flags[i] = 1
+        self._length = max(self._length, n + 1)
+
+    def get(self, n, i):
+        """:return: sec i of leaf n"""
+        offset = ((n % LEAF_BLOCK) * self.width + i) * SEC_SIZE
+        return bytes(self._blocks[n // LEAF_BLOCK][1][offset:offset + SEC_SIZE])
+
+    def blocks(self):
+        """:return: the numbers of the blocks stored"""
+        return sorted(self._blocks)
+
+    def evict(self, block):
+        """Forget the leaves of a block"""
+        self._blocks.pop(block, None)
+
+    @property
+    def present(self):
+        """The flags of leaves 0 .. len(self) - 1, contiguous
+        :rtype: bytearray"""
+        result = bytearray(self._length)
+        for block, (flags, _) in self._blocks.items():
+            start = block * LEAF_BLOCK
+            result[start:start + LEAF_BLOCK] = flags[:max(0, self._length - start)]
+        return result
+
+    @property
+    def secs(self):
+        """The secs of leaves 0 .. len(self) - 1, contiguous and zero for leaves not set
+        :rtype: bytearray"""
+        stride = self.width * SEC_SIZE
+        result = bytearray(self._length * stride)
+        for block, (_, data) in self._blocks.items():
+            start = block * LEAF_BLOCK * stride
+            result[start:start + len(data)] = data[:max(0, self._length * stride - start)]
+        return result
+
+
+class SecView(object):
+    """Read-only sequence of the secs of one leaf in a :class:`SecChain`"""
+    __slots__ = ['_chain', '_n']
+
+    def __init__(self, chain, n):
+        self._chain = chain
+        self._n = n
+
+    def __len__(self):
+        return self._chain.width
+
+    def __getitem__(self, i):
+        if not 0 <= i < self._chain.width:
+            raise IndexError(i)
+        return self._chain.get(self._n, i)
+
+    def __iter__(self):
+        for i in range(self._chain.width):
+            yield self[i]
+
+
+def _split_secs(data, count):
+    return tuple(bytes(data[i * SEC_SIZE:(i + 1) * SEC_SIZE]) for i in range(count))
+
+
+class SecStore(object):
+    """
+    Map of derivation path to the secs of the public keys at that path - one sec for single key accounts,
+    one per cosigner for multisig accounts.
+
+    Leaves are stored in a :class:`SecChain` per parent path.  Other paths (e.g. hardened leaves) are stored
+    individually.  Entries from legacy JSON caches are decoded on first access.
+
+    Chain leaves can be bounded with :attr:`max_leaves`, evicting the least recently used blocks of LEAF_BLOCK leaves.
+    Evicted leaves are no longer in the store, nor in snapshots of it.  Individually stored paths are not evicted.
+    """
+    __slots__ = ['netcode', '_chains', '_sparse', '_legacy', '_blocks']
+
+    def __init__(self, netcode, chains=None, sparse=None, legacy=None, max_leaves=None):
+        """
+        :param netcode: network code
+        :param dict chains: map of parent path to :class:`SecChain`
+        :param dict sparse: map of path to a tuple of secs
+        :param dict legacy: map of path to a legacy JSON value
+        :param int max_leaves: bound on the number of chain leaves, or None for unbounded
+        """
+        self.netcode = netcode
+        self._chains = chains or {}
+        self._sparse = sparse or {}
+        self._legacy = legacy or {}
+        self._blocks = LRUCache(on_evict=self._evict)
+        for prefix, chain in self._chains.items():
+            for block in chain.blocks():
+                self._blocks[(prefix, block)] = chain
+        self.max_leaves = max_leaves
+
+    @property
+    def max_leaves(self):
+        """Bound on the number of chain leaves, rounded down to whole blocks but at least one block, or None"""
+        if self._blocks.max_size is None:
+            return None
+        return self._blocks.max_size * LEAF_BLOCK
+
+    @max_leaves.setter
+    def max_leaves(self, max_leaves):
+        self._blocks.max_size = None if max_leaves is None else max(1, max_leaves // LEAF_BLOCK)
+        self._blocks.trim()
+
+    @staticmethod
+    def _evict(key, chain):
+        chain.evict(key[1])
+
+    def __contains__(self, path):
+        if path in self._sparse or path in self._legacy:
+            return True
+        split = split_leaf_path(path)
+        if split is None:
+            return False
+        chain = self._chains.get(split[0])
+        return chain is not None and split[1] in chain
+
+    def __getitem__(self, path):
+        """
+        :return: the secs for the path
+        :rtype: SecView or tuple[bytes]
+        """
+        split = split_leaf_path(path)
+        if split is not None:
+            chain = self._chains.get(split[0])
+            if chain is not None and split[1] in chain:
+                self._blocks.get((split[0], split[1] // LEAF_BLOCK))
+                return SecView(chain, split[1])
+        secs = self._sparse.get(path)
+        if secs is None:
+            secs = self._decode_legacy(self._legacy.pop(path))
+            self[path] = secs
+            return self[path]
+        return secs
+
+    def __setitem__(self, path, secs):
+        """
+        :param list[bytes] secs: the secs for the path
+        """
+        self._legacy.pop(path, None)
+        split = split_leaf_path(path)
+        if split is not None:
+            prefix, n = split
+            chain = self._chains.get(prefix)
+            if chain is None:
+                chain = self._chains[prefix] = SecChain(len(secs))
+            if chain.width == len(secs) and chain.can_store(n):
+                self._sparse.pop(path, None)
+                chain.set(n, secs)
+                self._blocks[(prefix, n // LEAF_BLOCK)] = chain
+                return
+        self._sparse[path] = tuple(secs)
+
+    def __len__(self):
+        return sum(chain.count() for chain in self._chains.values()) + \
+            len(self._sparse) + len(self._legacy)
+
+    @staticmethod
+    def _decode_legacy(value):
+        if isinstance(value, list):
+            return tuple(BIP32Node.from_hwif(v['hwif']).sec() for v in value)
+        return (BIP32Node.from_hwif(value['hwif']).sec(),)
+
+    def record(self, path):
+        """The sec count and concatenated secs for the path"""
+        secs = tuple(self[path])
+        return struct.pack(">B", len(secs)) + b''.join(secs)
+
+    def chains(self):
+        """:rtype: dict[str, SecChain]"""
+        return self._chains
+
+    def sparse_paths(self):
+        """Paths not stored in a chain, including undecoded legacy entries"""
+        return list(self._sparse) + list(self._legacy)
+
+
+class CacheJournal(object):
+    """
+    A base class for receiving journal records as the account cache changes.  Does nothing.
+    """
+    def append(self, record):
+        """
+        :param bytes record: a journal record, to be appended to the journal stored with the last snapshot
+        """
+        pass
+
+
+class FileCacheJournal(CacheJournal):
+    """Append journal records to a binary file-like object"""
+    def __init__(self, f):
+        self.f = f
+
+    def append(self, record):
+        self.f.write(record)
+        self.f.flush()
+
+
+def _path_record(path, record):
+    path_bytes = path.encode('ascii')
+    return struct.pack(">H", len(path_bytes)) + path_bytes + record
+
+
+def keys_journal_record(path, keys):
+    """:type keys: SecStore"""
+    return struct.pack(">B", JOURNAL_SECS) + _path_record(path, keys.record(path))
+
+
+def issued_journal_record(subchain, issued):
+    return struct.pack(">Bc", JOURNAL_ISSUED, subchain.encode('ascii')) + struct.pack(">L", issued)
+
+
+def _parse_path(blob, offset):
+    path_len, = struct.unpack(">H", blob[offset:offset + 2])
+    offset += 2
+    return blob[offset:offset + path_len].decode('ascii'), offset + path_len
+
+
+def _parse_secs_record(blob, offset):
+    count, = struct.unpack(">B", blob[offset:offset + 1])
+    offset += 1
+    return _split_secs(blob[offset:offset + count * SEC_SIZE], count), offset + count * SEC_SIZE
+
+
+def _parse_v1_key_record(blob, offset):
+    count, = struct.unpack(">B", blob[offset:offset + 1])
+    offset += 1
+    # a count of zero meant a single key, rather than a list.  Each record starts with the sec.
+    count = max(count, 1)
+    secs = tuple(bytes(blob[offset + i * V1_KEY_RECORD_SIZE:offset + i * V1_KEY_RECORD_SIZE + SEC_SIZE])
+                 for i in range(count))
+    return secs, offset + count * V1_KEY_RECORD_SIZE
+
+
+def replay(journal, issued, keys):
+    """
+    Apply journal records to the issued counters and key store loaded from a snapshot
+
+    :param bytes journal: concatenated journal records
+    :type issued: dict
+    :type keys: SecStore
+    """
+    journal = bytes(journal)
+    offset = 0
+    while offset < len(journal):
+        record_type, = struct.unpack(">B", journal[offset:offset + 1])
+        offset += 1
+        if record_type == JOURNAL_SECS:
+            path, offset = _parse_path(journal, offset)
+            secs, offset = _parse_secs_record(journal, offset)
+            keys[path] = secs
+        elif record_type == JOURNAL_KEYS:
+            path, offset = _parse_path(journal, offset)
+            secs, offset = _parse_v1_key_record(journal, offset)
+            keys[path] = secs
+        elif record_type == JOURNAL_ISSUED:
+            subchain, value = struct.unpack(">cL", journal[offset:offset + 5])
+            issued[subchain.decode('ascii')] = value
+            offset += 5
+        else:
+            raise CacheFormatError("unknown journal record type %d" % (record_type,))
+    if offset != len(journal):
+        raise CacheFormatError("truncated journal")
+
+
+def compact(snapshot, journal, netcode='BTC'):
+    """
+    Fold a journal into its snapshot
+
+    :param snapshot: the last snapshot, in binary or legacy JSON format, or None
+    :param bytes journal: journal records appended since the snapshot
+    :param netcode: network code, for legacy JSON or missing snapshots
+    :return: the new snapshot
+    :rtype: bytes
+    """
+    if snapshot:
+        issued, keys = loads(snapshot, netcode, journal)
+        netcode = keys.netcode
+    else:
+        issued, keys = {'0': 1, '1': 1}, SecStore(netcode)
+        replay(journal, issued, keys)
+    return dumps(netcode, issued, keys)
+
+
+def dumps(netcode, issued, keys):
+    """
+    Encode the account cache
+
+    :param str netcode: network code
+    :param dict issued: number of issued keys on the receive ('0') and change ('1') subchains
+    :type keys: SecStore
+    :rtype: bytes
+    """
+    netcode_bytes = netcode.encode('ascii')
+    chains = keys.chains()
+    parts = [CACHE_MAGIC, struct.pack(">BB", CACHE_VERSION, len(netcode_bytes)), netcode_bytes,
+             struct.pack(">LLL", issued['0'], issued['1'], len(chains))]
+    for prefix, chain in chains.items():
+        parts.append(_path_record(prefix, struct.pack(">BL", chain.width, len(chain))))
+        parts.append(bytes(chain.present))
+        parts.append(bytes(chain.secs))
+    sparse_paths = keys.sparse_paths()
+    parts.append(struct.pack(">L", len(sparse_paths)))
+    for path in sparse_paths:
+        parts.append(_path_record(path, keys.record(path)))
+    return b''.join(parts)
+
+
+def loads(blob, netcode, journal=None):
+    """
+    Decode an account cache in the binary format, or in the legacy JSON format.
+
+    :param blob: the cache
+    :type blob: bytes or str
+    :param netcode: network code, for legacy JSON caches
+    :param bytes journal: journal records appended since the snapshot, to be replayed
+    :return: the issued counters and the key store
+    :rtype: (dict, SecStore)
+    """
+    if not is_binary(blob):
+        d = json.loads(blob)
+        issued, keys = d['issued'], SecStore(netcode, legacy=d['keys'])
+    else:
+        blob = bytes(blob)
+        version, netcode_len = struct.unpack(">BB", blob[3:5])
+        if version not in (1, CACHE_VERSION):
+            raise CacheFormatError("unsupported cache version %d" % (version,))
+        offset = 5 + netcode_len
+        netcode = blob[5:offset].decode('ascii')
+        issued0, issued1, count = struct.unpack(">LLL", blob[offset:offset + 12])
+        offset += 12
+        issued, keys = {'0': issued0, '1': issued1}, SecStore(netcode)
+        if version == 1:
+            for _ in range(count):
+                path, offset = _parse_path(blob, offset)
+                secs, offset = _parse_v1_key_record(blob, offset)
+                keys[path] = secs
+        else:
+            chains = keys.chains()
+            for _ in range(count):
+                prefix, offset = _parse_path(blob, offset)
+                width, leaf_count = struct.unpack(">BL", blob[offset:offset + 5])
+                offset += 5
+                present = bytearray(blob[offset:offset + leaf_count])
+                offset += leaf_count
+                secs = bytearray(blob[offset:offset + leaf_count * width * SEC_SIZE])
+                offset += leaf_count * width * SEC_SIZE
+                chains[prefix] = SecChain(width, secs, present)
+            count, = struct.unpack(">L", blob[offset:offset + 4])
+            offset += 4
+            for _ in range(count):
+                path, offset = _parse_path(blob, offset)
+                secs, offset = _parse_secs_record(blob, offset)
+                keys[path] = secs
+        if offset != len(blob):
+            raise CacheFormatError("trailing data in cache")
+    if journal:
+        replay(journal, issued, keys)
+    return issued, keys
+
+
+def is_binary(blob):
+    return isinstance(blob, (bytes, bytearray)) and bytes(blob[:3]) == CACHE_MAGIC
@@ -0,0 +1,316 @@
+"""
+Coin selection - choosing which spendables fund a transaction.
+
+All strategies implement :meth:`CoinSelector.select` over a :class:`UTXOPool`, which keeps the
+spendables sorted by value.  Fees are computed by a :class:`FeeModel` from the number of inputs
+and whether the transaction has a change output.  Sizes are computed arithmetically, assuming that
+inputs are signed, so that the fee of each candidate selection costs O(1).
+"""
+import bisect
+import collections
+import math
+import random
+
+__author__ = 'devrandom'
+
+DUST = 546
+TX_FEE_PER_THOUSAND_BYTES = 1000
+SIGNATURE_SIZE = 72
+"""An upper bound on the size of a low S DER signature with its sighash byte"""
+
+Selection = collections.namedtuple('Selection', ['spendables', 'fee', 'change'])
+"""The chosen spendables, the fee, and the change amount (zero if there is no change output)"""
+
+
+def varint_size(n):
+    if n < 0xfd:
+        return 1
+    if n <= 0xffff:
+        return 3
+    return 5
+
+
+def push_size(n):
+    """The size of the opcode and length prefix that push n bytes"""
+    if n < 76:
+        return 1
+    if n <= 0xff:
+        return 2
+    if n <= 0xffff:
+        return 3
+    return 5
+
+
+def output_size(script):
+    """The serialized size of an output with the script"""
+    return 8 + varint_size(len(script)) + len(script)
+
+
+def input_size(script_size):
+    """The serialized size of an input with a script of script_size bytes"""
+    return 32 + 4 + varint_size(script_size) + script_size + 4
+
+
+def p2pkh_input_size():
+    """The size of a signed pay to address input, with a compressed public key"""
+    return input_size(1 + SIGNATURE_SIZE + 1 + 33)
+
+
+def p2sh_multisig_input_size(num_sigs, num_keys):
+    """
+    The size of a signed pay to script input for an m-of-n multisig redeem script with compressed public keys
+
+    :param int num_sigs: m
+    :param int num_keys: n
+    """
+    redeem_script_size = 1 + num_keys * (1 + 33) + 1 + 1
+    # OP_0, the signatures and the redeem script
+    script_size = 1 + num_sigs * (1 + SIGNATURE_SIZE) + push_size(redeem_script_size) + redeem_script_size
+    return input_size(script_size)
+
+
+def tx_size(tx):
+    """The serialized size of the transaction, computed from its parts without streaming it"""
+    return (4 + varint_size(len(tx.txs_in)) + sum(input_size(len(tx_in.script)) for tx_in in tx.txs_in) +
+            varint_size(len(tx.txs_out)) + sum(output_size(tx_out.script) for tx_out in tx.txs_out) + 4)
+
+
+class FeeModel(object):
+    """
+    Transaction fee as a function of the number of inputs and whether there is a change output.
+
+    If fee_rate is None, the fee is TX_FEE_PER_THOUSAND_BYTES for each started thousand bytes.
+    """
+
+    def __init__(self, base_size, input_size, change_size, fee_rate=None):
+        """
+        :param int base_size: size of the transaction without inputs or change, including the payee outputs
+        :param int input_size: size of each input, once signed
+        :param int change_size: size of the change output
+        :param fee_rate: fee rate in satoshis per byte, or None for the legacy per kilobyte fee.  There is no
+            witness data, so virtual bytes and bytes are the same.
+        """
+        self.base_size = base_size
+        self.input_size = input_size
+        self.change_size = change_size
+        self.fee_rate = fee_rate
+
+    def size(self, num_inputs, with_change):
+        size = self.base_size + varint_size(num_inputs) + num_inputs * self.input_size
+        return size + self.change_size if with_change else size
+
+    def fee_for_size(self, size):
+        if self.fee_rate is None:
+            return TX_FEE_PER_THOUSAND_BYTES * ((999 + size) // 1000)
+        return int(math.ceil(self.fee_rate * size))
+
+    def fee(self, num_inputs, with_change):
+        return self.fee_for_size(self.size(num_inputs, with_change))
+
+    @property
+    def input_fee(self):
+        """The marginal fee of one input, used to rank spendables by effective value"""
+        if self.fee_rate is None:
+            return self.input_size * TX_FEE_PER_THOUSAND_BYTES / 1000.0
+        return self.input_size * self.fee_rate
+
+
+def finish(spendables, total, target, fee_model):
+    """
+    Decide on the fee and change for selected spendables
+
+    :return: the selection, or None if the spendables do not cover target plus fee
+    :rtype: Selection
+    """
+    fee_with_change = fee_model.fee(len(spendables), True)
+    if total > target + fee_with_change + DUST:
+        return Selection(spendables, fee_with_change, total - target - fee_with_change)
+    if total >= target + fee_model.fee(len(spendables), False):
+        return Selection(spendables, total - target, 0)
+    return None
+
+
+class UTXOPool(object):
+    """Spendables indexed by coin value"""
+
+    def __init__(self, spendables):
+        self._spendables = sorted(spendables, key=lambda s: s.coin_value)
+        self._values = [s.coin_value for s in self._spendables]
+        self.total = sum(self._values)
+
+    def __len__(self):
+        return len(self._spendables)
+
+    def ascending(self):
+        return self._spendables
+
+    def descending(self):
+        return self._spendables[::-1]
+
+    def smallest_at_least(self, value):
+        """The smallest spendable worth at least value, or None"""
+        idx = bisect.bisect_left(self._values, value)
+        if idx == len(self._values):
+            return None
+        return self._spendables[idx]
+
+
+class CoinSelector(object):
+    """A base class for coin selection strategies"""
+
+    def select(self, pool, target, fee_model):
+        """
+        :type pool: UTXOPool
+        :param int target: the amount to pay, excluding fees
+        :type fee_model: FeeModel
+        :return: the selection, or None if the pool is insufficient
+        :rtype: Selection
+        """
+        raise NotImplementedError()
+
+
+class _Accumulate(CoinSelector):
+    """Add spendables in a fixed order until the target plus fee is covered"""
+
+    def order(self, pool):
+        raise NotImplementedError()
+
+    def select(self, pool, target, fee_model):
+        selected = []
+        total = 0
+        for spend in self.order(pool):
+            selected.append(spend)
+            total += spend.coin_value
+            if total >= target + fee_model.fee(len(selected), False):
+                return finish(selected, total, target, fee_model)
+        return None
+
+
+class LargestFirst(_Accumulate):
+    """
+    Spend the largest spendables first.  Uses the fewest inputs, but leaves small spendables behind.
+    A single spendable that covers the target on its own is preferred.
+    """
+
+    def order(self, pool):
+        return pool.descending()
+
+    def select(self, pool, target, fee_model):
+        single = pool.smallest_at_least(target + fee_model.fee(1, False))
+        if single is not None:
+            return finish([single], single.coin_value, target, fee_model)
+        return super(LargestFirst, self).select(pool, target, fee_model)
+
+
+class SmallestFirst(_Accumulate):
+    """Spend the smallest spendables first, consolidating them into the change output"""
+
+    def order(self, pool):
+        return pool.ascending()
+
+
+class RandomImprove(CoinSelector):
+    """
+    Pick spendables at random until the target is covered, then keep adding random spendables while
+    that brings the total closer to twice the target, without exceeding three times the target.
+    This tends to create change outputs similar in size to the payments.
+    """
+
+    def __init__(self, rng=None):
+        self.rng = rng or random.Random()
+
+    def select(self, pool, target, fee_model):
+        candidates = list(pool.ascending())
+        self.rng.shuffle(candidates)
+        selected = []
+        total = 0
+        while candidates and total < target + fee_model.fee(len(selected), False):
+            spend = candidates.pop()
+            selected.append(spend)
+            total += spend.coin_value
+        if total < target + fee_model.fee(len(selected), False):
+            return None
+        ideal = 2 * target
+        for spend in candidates:
+            new_total = total + spend.coin_value
+            if new_total > 3 * target or abs(ideal - new_total) >= abs(ideal - total):
+                continue
+            selected.append(spend)
+            total = new_total
+        return finish(selected, total, target, fee_model)
+
+
+class BranchAndBound(CoinSelector):
+    """
+    Search for a set of spendables that pays the target and fee with no change output, wasting at most the
+    cost of creating and spending a change output.  Falls back to another strategy if there is none.
+    """
+
+    def __init__(self, fallback=None, max_tries=100000):
+        """
+        :param fallback: strategy used if no exact match is found, defaults to :class:`LargestFirst`
+        :type fallback: CoinSelector
+        :param int max_tries: bound on the number of search steps
+        """
+        self.fallback = fallback or LargestFirst()
+        self.max_tries = max_tries
+
+    def select(self, pool, target, fee_model):
+        # a single spendable without change is the cheapest possible match, and is found by bisection
+        single = pool.smallest_at_least(target + fee_model.fee(1, False))
+        if single is not None and single.coin_value <= target + fee_model.fee(1, True) + DUST:
+            return finish([single], single.coin_value, target, fee_model)
+        selected = self._search(pool, target, fee_model)
+        if selected is not None:
+            result = finish(selected, sum(s.coin_value for s in selected), target, fee_model)
+            if result is not None:
+                return result
+        return self.fallback.select(pool, target, fee_model)
+
+    def _search(self, pool, target, fee_model):
+        input_fee = fee_model.input_fee
+        # spendables that cost more to spend than they are worth are never useful
+        spendables = [s for s in pool.descending() if s.coin_value > input_fee]
+        values = [s.coin_value - input_fee for s in spendables]
+        low = target + fee_model.fee(0, False)
+        high = low + (fee_model.fee(0, True) - fee_model.fee(0, False)) + DUST
+        remaining = [0] * (len(values) + 1)
+        for idx in range(len(values) - 1, -1, -1):
+            remaining[idx] = remaining[idx + 1] + values[idx]
+        if remaining[0] < low:
+            return None
+
+        # iterative depth first search - at each depth, include the spendable first, then exclude it
+        best = None
+        chosen = []
+        total = 0
+        idx = 0
+        tries = 0
+        while tries < self.max_tries:
+            tries += 1
+            backtrack = False
+            if total + remaining[idx] < low or total > high:
+                backtrack = True
+            elif total >= low:
+                if best is None or total < best[0]:
+                    best = (total, list(chosen))
+                if total == low:
+                    break
+                backtrack = True
+            elif idx == len(values):
+                backtrack = True
+
+            if backtrack:
+                # undo the most recent inclusion and try excluding it instead
+                if not chosen:
+                    break
+                last = chosen.pop()
+                total -= values[last]
+                idx = last + 1
+            else:
+                chosen.append(idx)
+                total += values[idx]
+                idx += 1
+        if best is None:
+            return None
+        return [spendables[i] for i in best[1]]
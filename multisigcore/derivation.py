@@ -0,0 +1,268 @@
+"""
+Public leaf derivation with cached intermediate chain nodes.
+"""
+import collections
+import hashlib
+import hmac
+import multiprocessing
+import struct
+
+from pycoin import ecdsa
+from pycoin.encoding import from_bytes_32, public_pair_to_sec, public_pair_to_hash160_sec, hash160, \
+    hash160_sec_to_bitcoin_address
+from pycoin.networks import address_prefix_for_netcode, pay_to_script_prefix_for_netcode
+from pycoin.tx.script import opcodes
+from pycoin.key.bip32 import DerivationError
+from . import secp256k1
+
+__author__ = 'devrandom'
+
+ORDER = ecdsa.generator_secp256k1.order()
+
+
+def split_leaf_path(path):
+    """
+    Split a derivation path into the path of the parent node and the leaf index
+
+    :param str path: a path such as "0/123" or "0/0/123"
+    :return: the parent path and the leaf index, or None if the leaf is hardened
+    :rtype: (str, int) or None
+    """
+    prefix, _, leaf = path.rpartition('/')
+    if not leaf or leaf[-1] in "'pH":
+        return None
+    return prefix, int(leaf)
+
+
+def _hmac_tweaks(parent_sec, chain_code, indices):
+    """The I_L tweaks and child chain codes for each index"""
+    result = []
+    for i in indices:
+        I64 = hmac.HMAC(key=chain_code, msg=parent_sec + struct.pack(">L", i), digestmod=hashlib.sha512).digest()
+        I_left_as_exponent = from_bytes_32(I64[:32])
+        if I_left_as_exponent >= ORDER:
+            raise DerivationError('I_L >= {}'.format(ORDER))
+        result.append((I_left_as_exponent, I64[32:]))
+    return result
+
+
+def ckd_pub_batch(parent_sec, parent_pair, chain_code, indices):
+    """
+    Public child key derivation (BIP32 CKDpub) for many non-hardened indices of one parent.
+    The points are computed in a batch - see :mod:`multisigcore.secp256k1`.
+
+    :param bytes parent_sec: the compressed SEC encoding of the parent public key
+    :param parent_pair: the parent public pair
+    :param bytes chain_code: the parent chain code
+    :param list[int] indices: the child indices
+    :return: list of child public pair and chain code tuples
+    """
+    tweaks = _hmac_tweaks(parent_sec, chain_code, indices)
+    pairs = secp256k1.batch_tweak_add([tweak for tweak, _ in tweaks], parent_pair)
+    for i, pair in zip(indices, pairs):
+        if pair is None:
+            raise DerivationError('K_{} == infinity'.format(i))
+    return [(pair, child_chain_code) for pair, (_, child_chain_code) in zip(pairs, tweaks)]
+
+
+class ChainNode(object):
+    """A public node whose children are derived repeatedly - keeps the values needed for CKDpub"""
+    __slots__ = ['node', 'public_pair', 'sec', 'chain_code', 'fingerprint']
+
+    def __init__(self, node):
+        """
+        :type node: pycoin.key.BIP32Node.BIP32Node
+        """
+        self.node = node
+        self.public_pair = node.public_pair()
+        self.sec = public_pair_to_sec(self.public_pair, compressed=True)
+        self.chain_code = node.chain_code()
+        self.fingerprint = public_pair_to_hash160_sec(self.public_pair, compressed=True)[:4]
+
+    def child(self, i):
+        """
+        :param int i: non-hardened child index
+        :return: the public child node, of the same class as the chain node
+        """
+        return self.children([i])[0]
+
+    def children(self, indices):
+        """
+        :param list[int] indices: non-hardened child indices
+        :return: the public child nodes, derived in a batch
+        """
+        node = self.node
+        return [node.__class__(netcode=node.netcode(), chain_code=chain_code, depth=node.tree_depth() + 1,
+                               parent_fingerprint=self.fingerprint, child_index=i, public_pair=public_pair)
+                for i, (public_pair, chain_code)
+                in zip(indices, ckd_pub_batch(self.sec, self.public_pair, self.chain_code, indices))]
+
+
+class KeyDeriver(object):
+    """
+    Derive public leaf keys below a BIP32 key.
+
+    The parent of each leaf (e.g. the "0" and "1" subchain nodes of an account) is derived once and cached,
+    so each additional leaf costs a single CKD step.  Leaves are not retained.
+    """
+    __slots__ = ['_key', '_nodes']
+
+    def __init__(self, key):
+        """
+        :type key: pycoin.key.BIP32Node.BIP32Node
+        """
+        self._key = key
+        self._nodes = {}
+
+    @property
+    def key(self):
+        return self._key
+
+    def chain_node(self, prefix):
+        """
+        :param str prefix: path of the parent node, relative to the key
+        :rtype: ChainNode
+        """
+        chain_node = self._nodes.get(prefix)
+        if chain_node is None:
+            chain_node = ChainNode(self._key.subkey_for_path(prefix + ".pub"))
+            self._nodes[prefix] = chain_node
+        return chain_node
+
+    def leaf(self, n, change=False):
+        return self.chain_node('1' if change else '0').child(n)
+
+    def leaves(self, start, stop, change=False):
+        """The public leaves start .. stop-1 of the receive or change subchain, derived in a batch"""
+        return self.chain_node('1' if change else '0').children(list(range(start, stop)))
+
+    def chain_for_prefix(self, prefix):
+        """The (sec, public_pair, chain_code) of the parent node, as stored in :class:`LeafSpec`"""
+        chain_node = self.chain_node(prefix)
+        return chain_node.sec, chain_node.public_pair, chain_node.chain_code
+
+    def leaf_for_path(self, path):
+        """
+        The public key for the path, equivalent to `key.subkey_for_path(path + ".pub")`
+
+        :param str path: the derivation path relative to the key
+        :rtype: pycoin.key.BIP32Node.BIP32Node
+        """
+        split = split_leaf_path(path)
+        if split is None:
+            return self._key.subkey_for_path(path + ".pub")
+        prefix, n = split
+        return self.chain_node(prefix).child(n)
+
+    def sec_for_path(self, path):
+        """
+        The compressed sec of the public key for the path, without building a key object for a leaf
+
+        :param str path: the derivation path relative to the key
+        :rtype: bytes
+        """
+        split = split_leaf_path(path)
+        if split is None:
+            return self._key.subkey_for_path(path + ".pub").sec()
+        prefix, n = split
+        chain_node = self.chain_node(prefix)
+        public_pair, _ = ckd_pub_batch(chain_node.sec, chain_node.public_pair, chain_node.chain_code, [n])[0]
+        return public_pair_to_sec(public_pair, compressed=True)
+
+
+Leaf = collections.namedtuple('Leaf', ['path', 'script', 'hash160', 'address'])
+"""A derived leaf - the redeem script is None for single key (pay to address) leaves"""
+
+LeafSpec = collections.namedtuple('LeafSpec', ['netcode', 'num_sigs', 'sort', 'chains'])
+"""
+Everything needed to derive leaves below a parent path, in a form that can be sent to a worker process.
+`chains` holds a (sec, public_pair, chain_code) tuple for each key.  `num_sigs` is None for single key leaves.
+"""
+
+DEFAULT_CHUNK_SIZE = 1000
+
+
+def multisig_script(num_sigs, secs):
+    """
+    Serialize an m-of-n multisig redeem script, byte for byte identical to ScriptMultisig.script()
+
+    :param int num_sigs: m
+    :param list[bytes] secs: the public keys, in script order
+    :rtype: bytes
+    """
+    ba = bytearray([opcodes.OP_1 + num_sigs - 1])
+    for sec in secs:
+        ba.append(len(sec))
+        ba.extend(sec)
+    ba.append(opcodes.OP_1 + len(secs) - 1)
+    ba.append(opcodes.OP_CHECKMULTISIG)
+    return bytes(ba)
+
+
+def derive_leaves(spec, prefix, start, stop):
+    """
+    Derive the leaves prefix/start .. prefix/(stop-1).  Module level, so that it can run in a worker process.
+
+    :type spec: LeafSpec
+    :rtype: list[Leaf]
+    """
+    if spec.num_sigs is None:
+        address_prefix = address_prefix_for_netcode(spec.netcode)
+    else:
+        address_prefix = pay_to_script_prefix_for_netcode(spec.netcode)
+    indices = list(range(start, stop))
+    chain_secs = [[public_pair_to_sec(child_pair, compressed=True)
+                   for child_pair, _ in ckd_pub_batch(sec, pair, chain_code, indices)]
+                  for sec, pair, chain_code in spec.chains]
+    result = []
+    for n, secs in zip(indices, zip(*chain_secs)):
+        secs = list(secs)
+        if spec.num_sigs is None:
+            script = None
+            h160 = hash160(secs[0])
+        else:
+            if spec.sort:
+                secs.sort()
+            script = multisig_script(spec.num_sigs, secs)
+            h160 = hash160(script)
+        address = hash160_sec_to_bitcoin_address(h160, address_prefix=address_prefix)
+        result.append(Leaf("%s/%d" % (prefix, n) if prefix else str(n), script, h160, address))
+    return result
+
+
+def _derive_leaves_star(args):
+    return derive_leaves(*args)
+
+
+def iter_leaves(spec, prefix, start, stop, processes=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Stream the leaves prefix/start .. prefix/(stop-1) in order, deriving chunks on a process pool.
+
+    At most two chunks per worker are in flight, so the output is not buffered if the consumer is slow.
+
+    :type spec: LeafSpec
+    :param int processes: number of worker processes, defaults to the number of CPUs.  1 derives in-process.
+    :param int chunk_size: number of leaves per unit of work
+    :rtype: collections.Iterable[Leaf]
+    """
+    chunks = ((spec, prefix, s, min(s + chunk_size, stop)) for s in range(start, stop, chunk_size))
+    if processes == 1 or stop - start <= chunk_size:
+        for chunk in chunks:
+            for leaf in _derive_leaves_star(chunk):
+                yield leaf
+        return
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        window = 2 * (processes or multiprocessing.cpu_count())
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(_derive_leaves_star, (chunk,)))
+            if len(pending) >= window:
+                for leaf in pending.popleft().get():
+                    yield leaf
+        while pending:
+            for leaf in pending.popleft().get():
+                yield leaf
+    finally:
+        pool.terminate()
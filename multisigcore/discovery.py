@@ -0,0 +1,82 @@
+"""
+Gap limit (BIP44 style) discovery of used addresses.
+"""
+from . import rawscript
+from .providers import BatchService
+
+__author__ = 'devrandom'
+
+
+class GapLimitScanner(object):
+    """
+    Find the used addresses of an account by scanning both subchains in windows.
+
+    Each round derives the next window of addresses on every subchain that is still being scanned and
+    queries all of them with a single provider batch.  A subchain is finished once gap_limit consecutive
+    addresses after the last used one have been seen.  An address is used if it has spendables, or if the
+    provider reports history for it (see :meth:`multisigcore.providers.BatchService.used_addresses`).
+    """
+
+    def __init__(self, account, gap_limit, window=None):
+        """
+        :type account: multisigcore.hierarchy.Account
+        :param int gap_limit: number of consecutive unused addresses that ends the scan of a subchain
+        :param int window: number of addresses per subchain queried in each round, defaults to gap_limit
+        """
+        self.account = account
+        self.gap_limit = gap_limit
+        self.window = window or gap_limit
+        self.rounds = 0
+
+    def _used(self, window, hash160s, spendables):
+        """
+        :param dict[str, str] window: the paths of the queried addresses
+        :param dict[bytes, str] hash160s: the paths of the queried hash160s
+        :return: the paths of the used addresses
+        :rtype: set[str]
+        """
+        provider = self.account._provider
+        used = set(hash160s.get(rawscript.output_hash160(spend.script)) for spend in spendables)
+        if isinstance(provider, BatchService):
+            history = provider.used_addresses(list(window.keys()))
+            if history:
+                used.update(window.get(address) for address in history)
+        used.discard(None)
+        return used
+
+    def scan(self):
+        """
+        Run the scan and advance the issued counters of the account past the last used address on each subchain
+
+        :return: the spendables found
+        :rtype: list[pycoin.tx.Spendable.Spendable]
+        """
+        account = self.account
+        last_used = {'0': -1, '1': -1}
+        scanned = {'0': 0, '1': 0}
+        spendables = []
+        while True:
+            window = {}
+            hash160s = {}
+            for subchain in ('0', '1'):
+                if scanned[subchain] - (last_used[subchain] + 1) >= self.gap_limit:
+                    continue
+                start = scanned[subchain]
+                for leaf in account.leaves(start, start + self.window, subchain == '1', processes=1):
+                    window[leaf.address] = leaf.path
+                    hash160s[leaf.hash160] = leaf.path
+                scanned[subchain] = start + self.window
+            if not window:
+                break
+            self.rounds += 1
+            found = account.spendables_for_addresses(list(window.keys()))
+            spendables.extend(found)
+            for path in self._used(window, hash160s, found):
+                subchain, n = path.split('/')
+                last_used[subchain] = max(last_used[subchain], int(n))
+
+        for subchain in ('0', '1'):
+            # the current address is the first unused one
+            if last_used[subchain] + 2 > account._cache['issued'][subchain]:
+                account._set_issued(subchain, last_used[subchain] + 2)
+        return spendables
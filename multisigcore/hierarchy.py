@@ -1,17 +1,25 @@
 from __future__ import print_function
+import collections
 import io
 import json
 from functools import reduce
 
 import multisigcore
 from .providers import BatchService
+from . import cache as account_cache
+from . import rawscript
+from .coinselect import BranchAndBound, FeeModel, UTXOPool, output_size, input_size, tx_size, varint_size, \
+    p2pkh_input_size, p2sh_multisig_input_size, DUST, TX_FEE_PER_THOUSAND_BYTES
+from .discovery import GapLimitScanner
+from .derivation import KeyDeriver, LeafSpec, iter_leaves, multisig_script, DEFAULT_CHUNK_SIZE
 from pycoin import encoding
 from pycoin.key.BIP32Node import BIP32Node
+from pycoin.networks import address_prefix_for_netcode, pay_to_script_prefix_for_netcode
 from pycoin.scripts.tx import DEFAULT_VERSION
 from pycoin.serialize import h2b, b2h
 from pycoin.serialize.bitcoin_streamer import parse_struct
 from pycoin.services import providers
-from pycoin.tx import Tx, TxOut, TxIn
+from pycoin.tx import Tx, TxOut, TxIn, Spendable
 from pycoin.tx.TxOut import standard_tx_out_script
 from pycoin.tx.pay_to import ScriptMultisig, ScriptPayToScript, ScriptPayToAddress
 
@@ -19,7 +27,25 @@ from pycoin.tx.pay_to import ScriptMultisig, ScriptPayToScript, ScriptPayToAddre
 __author__ = 'devrandom'
 
 LOOKAHEAD = 20
-DUST = 546
+DEFAULT_LEAF_CACHE_SIZE = 10000
+
+MultisigLeaf = collections.namedtuple('MultisigLeaf', ['secs', 'script', 'hash160', 'address'])
+"""Memoized redeem script data for a multisig path"""
+
+
+class SerializedScriptMultisig(ScriptMultisig):
+    """A multisig redeem script that was already serialized, e.g. by :func:`multisig_script`"""
+    def __init__(self, n, sec_keys, script):
+        """
+        :param int n: number of required signatures
+        :param list[bytes] sec_keys: the public keys, in script order
+        :param bytes script: the serialized script
+        """
+        super(SerializedScriptMultisig, self).__init__(n, sec_keys)
+        self._serialized = script
+
+    def script(self):
+        return self._serialized
 
 
 class InsufficientBalanceException(ValueError):
@@ -32,12 +58,36 @@ class AccountKey(BIP32Node):
     def from_key(cls, key):
         return cls.from_hwif(key)
 
+    @classmethod
+    def from_node(cls, node, as_private=True):
+        """
+        Build an account key directly from a derived node, without a round trip through the hwif encoding
+
+        :type node: BIP32Node
+        :param as_private: whether to keep the private key, if the node has one
+        """
+        d = dict(netcode=node.netcode(), chain_code=node.chain_code(), depth=node.tree_depth(),
+                 parent_fingerprint=node.parent_fingerprint(), child_index=node.child_index())
+        if as_private and node.is_private():
+            d['secret_exponent'] = node.secret_exponent()
+        else:
+            d['public_pair'] = node.public_pair()
+        return cls(**d)
+
     def leaf(self, n, change=False):
         return self.leaf_for_path("%s/%s" % (1 if change else 0, n))
 
     def leaf_for_path(self, path):
         return self.subkey_for_path(path)
 
+    def public_leaves(self, start, stop, change=False):
+        """
+        The public leaf keys start .. stop-1 of the receive or change subchain, derived in a batch
+
+        :rtype: list[AccountKey]
+        """
+        return KeyDeriver(self).leaves(start, stop, change)
+
 
 class MasterKey(BIP32Node):
     """Master key (m or M)"""
@@ -54,7 +104,7 @@ class MasterKey(BIP32Node):
         return cls.from_hwif(key)
 
     def account_for_path(self, path):
-        return AccountKey.from_key(self.subkey_for_path(path).hwif(as_private=self.is_private()))
+        return AccountKey.from_node(self.subkey_for_path(path), as_private=self.is_private())
 
     def electrum_account(self, n):
         return self.account_for_path("0H/%s" % (n,))
@@ -66,22 +116,13 @@ class MasterKey(BIP32Node):
         return self.account_for_path("%sH/%sH/%sH" % (purpose, coin, n))
 
 
-TX_FEE_PER_THOUSAND_BYTES = 1000
-
-
 def recommended_fee_for_tx(tx):
     """
-    Return the recommended transaction fee in satoshis.
-    This is a grossly simplified version of this function.
-    TODO: improve to consider TxOut sizes.
-      - whether the transaction contains "dust"
-      - whether any outputs are less than 0.001
+    Return the recommended transaction fee in satoshis, for the transaction as it is.
+    Input scripts are counted at their current size, so this undercounts unsigned transactions -
+    see :meth:`Account.estimate_fee` for an estimate of the signed transaction.
     """
-    # FIXME review
-    s = io.BytesIO()
-    tx.stream(s)
-    tx_byte_count = len(s.getvalue())
-    tx_fee = TX_FEE_PER_THOUSAND_BYTES * ((999+tx_byte_count)//1000)
+    tx_fee = TX_FEE_PER_THOUSAND_BYTES * ((999+tx_size(tx))//1000)
     return tx_fee
 
 
@@ -98,8 +139,43 @@ class AccountTxOut(TxOut):
 
 
 class AccountTx(Tx):
+    """
+    A transaction with the chain paths of its inputs and change outputs.
+
+    The serialized transaction is memoized, and serialized again only if a field changed - e.g. after signing.
+    """
     def __init__(self, version, txs_in, txs_out, locktime=0, unspents=[]):
         super(AccountTx, self).__init__(version, txs_in, txs_out, locktime, unspents)
+        self._bin = None
+
+    def _bin_key(self):
+        """The fields that are serialized.  Scripts and hashes are immutable bytes, so comparing keys is cheap."""
+        return (self.version, self.lock_time,
+                tuple((t.previous_hash, t.previous_index, t.script, t.sequence) for t in self.txs_in),
+                tuple((t.coin_value, t.script) for t in self.txs_out))
+
+    def as_bin(self, include_unspents=False):
+        key = self._bin_key()
+        if self._bin is None or self._bin[0] != key:
+            f = io.BytesIO()
+            super(AccountTx, self).stream(f)
+            self._bin = (key, f.getvalue())
+        if include_unspents and not self.missing_unspents():
+            f = io.BytesIO()
+            self.stream_unspents(f)
+            return self._bin[1] + f.getvalue()
+        return self._bin[1]
+
+    def stream(self, f, blank_solutions=False):
+        if blank_solutions:
+            super(AccountTx, self).stream(f, blank_solutions=True)
+        else:
+            f.write(self.as_bin())
+
+    def hash(self, hash_type=None):
+        if hash_type:
+            return super(AccountTx, self).hash(hash_type)
+        return encoding.double_sha256(self.as_bin())
 
     def input_chain_paths(self):
         return [tin.path for tin in self.txs_in]
@@ -156,42 +232,94 @@ class AccountTx(Tx):
         return tx
 
 class Account(object):
-    __slots__ = ['netcode', 'lookahead', 'address_map', '_provider', '_cache']
+    __slots__ = ['netcode', 'lookahead', 'address_map', '_provider', '_cache', '_indexed', '_journal',
+                 '_coin_selector', '_fee_rate', '_utxo_store', '_script_map', '_hash160_map']
 
-    def __init__(self, netcode='BTC', cache=None):
+    def __init__(self, netcode='BTC', cache=None, journal=None):
         """
         :param netcode: network code
-        :param str cache: the JSON formatted cache - see the cache property
+        :param cache: the binary cache - see the cache property.  A JSON formatted cache from earlier versions
+            is also accepted.
+        :type cache: bytes or str
+        :param bytes journal: journal records emitted since the cache snapshot was taken - see the journal property
         """
         object.__setattr__(self, 'netcode', netcode)
         object.__setattr__(self, 'lookahead', LOOKAHEAD)
         self._provider = providers
         self.address_map = None
+        self._script_map = None
+        self._hash160_map = None
+        self._indexed = None
+        self._journal = account_cache.CacheJournal()
+        self._coin_selector = BranchAndBound()
+        self._fee_rate = None
+        self._utxo_store = None
 
-        def decode_key(dct):
-            if 'hwif' in dct:
-                return BIP32Node.from_hwif(dct['hwif'])
-            return dct
         if cache:
-            self._cache = json.loads(cache, object_hook=decode_key)
+            issued, keys = account_cache.loads(cache, netcode, journal)
+            self._cache = {'keys': keys, 'issued': issued}
         else:
-            self._cache = {'keys': {}, 'issued': {'0': 1, '1': 1}}
+            self._cache = {'keys': account_cache.SecStore(netcode), 'issued': {'0': 1, '1': 1}}
+            if journal:
+                account_cache.replay(journal, self._cache['issued'], self._cache['keys'])
 
     def set_lookahead(self, lookahead):
         """Set the lookahead for looking for spendables"""
         object.__setattr__(self, 'lookahead', lookahead)
+        self._update_address_map()
+
+    def set_key_cache_size(self, size):
+        """Set the number of leaf public keys kept in memory, or None for unbounded.  Keys are evicted in blocks
+        of :data:`multisigcore.cache.LEAF_BLOCK` leaves, least recently used first, and are derived again
+        on the next use.  Evicted keys are not written to :attr:`cache` snapshots."""
+        self._cache['keys'].max_leaves = size
 
     @property
     def cache(self):
-        """A JSON encoded cache.
+        """A compact binary cache.
         Save this cache in a database in order to speed up public key and address derivation in the future.
         Also stores the number of issued keys on the internal (change) and external (receive) subchains.
+        Keys loaded from a previous cache are written back without being decoded.
+        :rtype: bytes
+        """
+        return account_cache.dumps(self.netcode, self._cache['issued'], self._cache['keys'])
+
+    @property
+    def journal(self):
+        """Receives a record for each newly cached path and issued counter change, so that the cache can be
+        persisted incrementally.  Append the records after the last saved cache snapshot, and pass both
+        to the constructor to reload.  See also :func:`multisigcore.cache.compact`.
+        :rtype: multisigcore.cache.CacheJournal"""
+        return self._journal
+
+    @journal.setter
+    def journal(self, journal):
+        """:type journal: multisigcore.cache.CacheJournal"""
+        self._journal = journal
+
+    def _cache_keys(self, path, secs):
+        """Cache the secs of the derived public keys for the path, and journal them"""
+        keys = self._cache['keys']
+        keys[path] = secs
+        self._journal.append(account_cache.keys_journal_record(path, keys))
+
+    def _issue(self, subchain):
+        """Bump an issued counter"""
+        self._set_issued(subchain, self._cache['issued'][subchain] + 1)
+
+    def _set_issued(self, subchain, value):
+        """Set an issued counter, and journal the new value"""
+        self._cache['issued'][subchain] = value
+        self._journal.append(account_cache.issued_journal_record(subchain, value))
+        self._update_address_map()
+
+    def script_pubkey_for_path(self, path):
+        """
+        The output script that pays to the path
+        :param str path: sub-path (e.g. "0/123")
+        :rtype: bytes
         """
-        def encode_key(obj):
-            if isinstance(obj, BIP32Node):
-                return {'hwif': obj.hwif()}
-            raise TypeError()
-        return json.dumps(self._cache, default=encode_key)
+        raise NotImplementedError()
 
     def address(self, n, change=False):
         """
@@ -237,56 +365,286 @@ class Account(object):
         address_map.update({self.address(n, True): "1/%d"%(n,) for n in range(0, self.num_int_keys + lookahead)})
         return address_map
 
-    def spendables(self):
+    def leaf_spec(self, prefix):
+        """
+        The data needed to derive leaves below prefix in a worker process.
+
+        :param str prefix: path of the parent of the leaves (e.g. "0" for the receive subchain)
+        :rtype: multisigcore.derivation.LeafSpec
+        """
+        raise NotImplementedError()
+
+    def leaves_for_prefix(self, prefix, start, stop, processes=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Stream the leaves prefix/start .. prefix/(stop-1), derived in parallel on a process pool.
+
+        :param str prefix: path of the parent of the leaves
+        :param int processes: number of worker processes, defaults to the number of CPUs.  1 derives in-process.
+        :param int chunk_size: number of leaves per unit of work
+        :return: generator of leaves, in order
+        :rtype: collections.Iterable[multisigcore.derivation.Leaf]
+        """
+        return iter_leaves(self.leaf_spec(prefix), prefix, start, stop, processes, chunk_size)
+
+    def leaves(self, start, stop, change=False, processes=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Stream leaves start .. stop-1 of either the receive subchain or the change subchain.
+        See :meth:`leaves_for_prefix`.
+
+        :rtype: collections.Iterable[multisigcore.derivation.Leaf]
+        """
+        return self.leaves_for_prefix('1' if change else '0', start, stop, processes, chunk_size)
+
+    def _update_address_map(self):
+        """
+        Bring the persistent address map in line with the issued counters and the lookahead.
+        Only addresses that entered or left the lookahead window are derived, so the cost
+        is proportional to the change in the counters rather than to the number of issued addresses.
+        The output scripts and hash160s of the addresses are indexed alongside, for :meth:`path_for_script`
+        and :meth:`path_for_hash160`.
+        """
+        if self.address_map is None:
+            return
+        for subchain in ('0', '1'):
+            change = subchain == '1'
+            indexed = self._indexed[subchain]
+            target = self._cache['issued'][subchain] + self.lookahead
+            for n in range(indexed, target):
+                path = "%s/%d" % (subchain, n)
+                script = self.script_pubkey_for_path(path)
+                self.address_map[self.address(n, change)] = path
+                self._script_map[script] = path
+                self._hash160_map[rawscript.output_hash160(script)] = path
+            for n in range(target, indexed):
+                script = self.script_pubkey_for_path("%s/%d" % (subchain, n))
+                del self.address_map[self.address(n, change)]
+                del self._script_map[script]
+                del self._hash160_map[rawscript.output_hash160(script)]
+            self._indexed[subchain] = target
+
+    def _ensure_address_map(self):
+        """Build the persistent address map on first use, including the lookahead"""
+        if self.address_map is None:
+            self.address_map = {}
+            self._script_map = {}
+            self._hash160_map = {}
+            self._indexed = {'0': 0, '1': 0}
+            self._update_address_map()
+        return self.address_map
+
+    @property
+    def utxo_store(self):
+        """A local store of unspent outputs.  If set, :meth:`spendables` and :meth:`balance` are served from the
+        store, which is filled by :meth:`sync` and updated as we sign transactions.
+        :rtype: multisigcore.utxo.UTXOStore"""
+        return self._utxo_store
+
+    @utxo_store.setter
+    def utxo_store(self, utxo_store):
+        """:type utxo_store: multisigcore.utxo.UTXOStore"""
+        self._utxo_store = utxo_store
+
+    def spendables(self, prefetch=False):
         """
         A list of Spendables - unspent transaction outputs
+        :param bool prefetch: start looking up the transactions that created the spendables, for signing
         :return: dict of spendables for our addresses
         """
-        self.address_map = self.make_address_map(True)
+        if self._utxo_store is not None:
+            if self._utxo_store.last_sync is None:
+                self.sync()
+            spendables = self._utxo_store.spendables()
+        else:
+            self._ensure_address_map()
+            spendables = self.spendables_for_addresses(list(self.address_map.keys()))
+        if prefetch:
+            self.prefetch_input_txs(spendables)
+        return spendables
+
+    def prefetch_input_txs(self, spendables):
+        """
+        Start looking up the transactions that created the spendables, for co-signers that need them.
+        Does nothing for accounts without such co-signers.
+
+        :type spendables: list[pycoin.tx.Spendable.Spendable]
+        """
+        pass
+
+    def sync(self, addresses=None):
+        """
+        Reconcile the UTXO store with the provider
+
+        :param addresses: the addresses to query, by default all addresses including the lookahead
+        :type addresses: list[str]
+        """
+        if self._utxo_store is None:
+            raise ValueError("no UTXO store")
+        self._ensure_address_map()
+        paths = None
+        if addresses is None:
+            addresses = list(self.address_map.keys())
+        else:
+            paths = [self.path_for_check(addr) for addr in addresses]
+        spendables = self.spendables_for_addresses(addresses)
+        self._utxo_store.update([(spend, self.path_for_script_check(spend.script)) for spend in spendables], paths)
+
+    def record_tx(self, tx):
+        """
+        Update the UTXO store after we spent - mark the inputs spent and add the outputs to our addresses.
+        Call this with the final transaction, since the hash of the outputs changes as signatures are added.
+
+        :type tx: Tx
+        """
+        if self._utxo_store is None:
+            return
+        self._utxo_store.mark_spent([(tx_in.previous_hash, tx_in.previous_index) for tx_in in tx.txs_in])
+        tx_hash = tx.hash()
+        for idx, tx_out in enumerate(tx.txs_out):
+            path = self.path_for_script(tx_out.script)
+            if path is not None:
+                self._utxo_store.add(Spendable(tx_out.coin_value, tx_out.script, tx_hash, idx), path)
+
+    def spendables_for_addresses(self, addresses):
+        """
+        Query the provider for spendables, in one batch if the provider supports it
+        :param list[str] addresses:
+        :rtype: list[pycoin.tx.Spendable.Spendable]
+        """
         spendables = None
         if isinstance(self._provider, BatchService):
             provider = self._provider
             """:type: BatchService"""
-            spendables = provider.spendables_for_addresses(self.address_map.keys())
+            spendables = provider.spendables_for_addresses(addresses)
         else:
             spendables = []
-            for addr in self.address_map.keys():
+            for addr in addresses:
                 spends = self._provider.spendables_for_address(addr)
                 if spends:
                     spendables.extend(spends)
 
         return spendables
 
+    def _invalidate(self, addresses):
+        """Tell a caching provider that the spendables of the addresses are changing"""
+        if addresses and getattr(self._provider, 'invalidates', False):
+            self._provider.invalidate(addresses)
+
+    def _invalidate_paths(self, paths):
+        """Like :meth:`_invalidate`, but the addresses are only derived if the provider caches"""
+        if paths and getattr(self._provider, 'invalidates', False):
+            self._provider.invalidate([self.address_for_path(path) for path in paths])
+
+    def discover(self, gap_limit=LOOKAHEAD, window=None):
+        """
+        Scan both subchains until gap_limit consecutive unused addresses are seen on each, and advance the
+        issued counters past the last used address.  Use this when restoring an account from its keys.
+
+        :param int gap_limit: number of consecutive unused addresses that ends the scan of a subchain
+        :param int window: number of addresses per subchain queried in each round, defaults to gap_limit
+        :return: the spendables found
+        :rtype: list[pycoin.tx.Spendable.Spendable]
+        """
+        return GapLimitScanner(self, gap_limit, window).scan()
+
     def balance(self):
         """Total balance in spendables for our keys"""
+        if self._utxo_store is not None and self._utxo_store.last_sync is not None:
+            return self._utxo_store.balance()
         spendables = self.spendables()
         total = reduce(lambda x,y: x+y, [s.coin_value for s in spendables], 0)
         return total
 
     def address_from_spend(self, spend):
-        script = None
-        """:type: ScriptType"""
-        try:
-            script = ScriptPayToScript.from_script(spend.script)
-        except Exception:
-            script = ScriptPayToAddress.from_script(spend.script)
-
-        # explicitly call info() because pycoin script.address(netcode) disregards the netcode
-        addr = script.info(self.netcode)['address']
-        return addr
+        """
+        :param spend: a Spendable or TxOut paying to a P2SH or P2PKH address
+        :return: the address
+        :raises ValueError: for other scripts
+        """
+        hash160 = rawscript.p2sh_hash160(spend.script)
+        if hash160 is not None:
+            return encoding.hash160_sec_to_bitcoin_address(
+                hash160, address_prefix=pay_to_script_prefix_for_netcode(self.netcode))
+        hash160 = rawscript.p2pkh_hash160(spend.script)
+        if hash160 is not None:
+            return encoding.hash160_sec_to_bitcoin_address(
+                hash160, address_prefix=address_prefix_for_netcode(self.netcode))
+        raise ValueError("not a P2SH or P2PKH script")
 
     def add_spend(self, spend, spendables, txs_in):
-        addr = self.address_from_spend(spend)
+        path = self.path_for_script_check(spend.script)
         spendables.append(spend)
-        txs_in.append(AccountTxIn(spend.tx_hash, spend.tx_out_index, script=b'', sequence=4294967295, path=self.path_for_check(addr)))
+        txs_in.append(AccountTxIn(spend.tx_hash, spend.tx_out_index, script=b'', sequence=4294967295, path=path))
+
+    @property
+    def coin_selector(self):
+        """The strategy that chooses spendables in :meth:`tx`, by default branch and bound with a largest first
+        fallback.  See :mod:`multisigcore.coinselect`.
+        :rtype: multisigcore.coinselect.CoinSelector"""
+        return self._coin_selector
+
+    @coin_selector.setter
+    def coin_selector(self, coin_selector):
+        """:type coin_selector: multisigcore.coinselect.CoinSelector"""
+        self._coin_selector = coin_selector
+
+    @property
+    def fee_rate(self):
+        """The fee rate in satoshis per byte used by :meth:`tx`, or None for TX_FEE_PER_THOUSAND_BYTES for each
+        started thousand bytes"""
+        return self._fee_rate
+
+    @fee_rate.setter
+    def fee_rate(self, fee_rate):
+        self._fee_rate = fee_rate
+
+    def estimated_input_size(self):
+        """The size in bytes of an input spending one of our outputs, once signed"""
+        # the script is unknown - count it as empty
+        return input_size(0)
+
+    def fee_model(self, txs_out, change_script, fee_rate=None):
+        """
+        :param list[TxOut] txs_out: the payee outputs
+        :param bytes change_script: the script of the change output, if there is one
+        :param fee_rate: fee rate in satoshis per byte, defaults to :attr:`fee_rate`
+        :rtype: multisigcore.coinselect.FeeModel
+        """
+        # version, locktime, output count including change, and outputs
+        base_size = 4 + 4 + varint_size(len(txs_out) + 1) + sum(output_size(tx_out.script) for tx_out in txs_out)
+        if fee_rate is None:
+            fee_rate = self._fee_rate
+        return FeeModel(base_size, self.estimated_input_size(), output_size(change_script), fee_rate)
+
+    def estimate_size(self, num_inputs, output_scripts):
+        """
+        The size of a signed transaction spending num_inputs of our outputs
+
+        :param int num_inputs: the number of inputs
+        :param list[bytes] output_scripts: the scripts of all outputs, including change
+        :rtype: int
+        """
+        return self.fee_model([TxOut(0, script) for script in output_scripts], b'').size(num_inputs, False)
 
-    def tx(self, payables, change_address=None):
+    def estimate_fee(self, num_inputs, output_scripts, fee_rate=None):
+        """
+        The fee of a signed transaction spending num_inputs of our outputs - see :meth:`estimate_size`
+
+        :param fee_rate: fee rate in satoshis per byte, defaults to :attr:`fee_rate`
+        :rtype: int
+        """
+        txs_out = [TxOut(0, script) for script in output_scripts]
+        return self.fee_model(txs_out, b'', fee_rate).fee(num_inputs, False)
+
+    def tx(self, payables, change_address=None, fee_rate=None, coin_selector=None):
         """
         Construct a transaction with available spendables
         :param list[(str, int)] payables: tuple of address and amount
+        :param fee_rate: fee rate in satoshis per byte, defaults to :attr:`fee_rate`
+        :param coin_selector: overrides :attr:`coin_selector` for this transaction
+        :type coin_selector: multisigcore.coinselect.CoinSelector
         :return Tx or None: the transaction or None if not enough balance
         """
-        all_spendables = self.spendables()
+        pool = UTXOPool(self.spendables())
 
         send_amount = 0
         for address, coin_value in payables:
@@ -297,30 +655,24 @@ class Account(object):
             script = standard_tx_out_script(address)
             txs_out.append(TxOut(coin_value, script))
 
-        total = 0
+        change_address = change_address or self.current_change_address()
+        change_script = standard_tx_out_script(change_address)
+        fee_model = self.fee_model(txs_out, change_script, fee_rate)
+        selection = (coin_selector or self._coin_selector).select(pool, send_amount, fee_model)
+        if selection is None:
+            raise InsufficientBalanceException(pool.total)
+
+        self.prefetch_input_txs(selection.spendables)
         txs_in = []
         spendables = []
-        while total < send_amount and all_spendables:
-            spend = all_spendables.pop(0)
+        for spend in selection.spendables:
             self.add_spend(spend, spendables, txs_in)
-            total += spend.coin_value
 
-        tx_for_fee = Tx(txs_in=txs_in, txs_out=txs_out, version=DEFAULT_VERSION, unspents=spendables)
-        fee = recommended_fee_for_tx(tx_for_fee)
+        if selection.change:
+            txs_out.append(AccountTxOut(selection.change, change_script, self.path_for_check(change_address)))
+            self._invalidate([change_address])
+        self._invalidate_paths([tx_in.path for tx_in in txs_in])
 
-        while total < send_amount + fee and all_spendables:
-            spend = all_spendables.pop(0)
-            self.add_spend(spend, spendables, txs_in)
-            total += spend.coin_value
-
-        if total > send_amount + fee + DUST:
-            addr = change_address or self.current_change_address()
-            script = standard_tx_out_script(addr)
-            txs_out.append(AccountTxOut(total - send_amount - fee, script, self.path_for_check(addr)))
-        elif total < send_amount + fee:
-            raise InsufficientBalanceException(total)
-
-        # check total >= amount + fee
         tx = AccountTx(version=DEFAULT_VERSION, txs_in=txs_in, txs_out=txs_out, unspents=spendables)
         return tx
 
@@ -331,6 +683,31 @@ class Account(object):
         keys = self.keys_for_tx(tx)
 
         multisigcore.local_sign(tx, self.collect_redeem_scripts(tx), keys)
+        self.record_signed(tx)
+
+    def record_signed(self, tx):
+        """
+        Update the UTXO store after signing a transaction locally - see :meth:`sign`
+
+        :type tx: Tx
+        """
+        if self._utxo_store is not None:
+            if tx.bad_signature_count() == 0:
+                self.record_tx(tx)
+            else:
+                # more signatures are needed - the outputs are recorded when the transaction is complete,
+                # and the inputs are released if it is not
+                self._utxo_store.mark_spent([(tx_in.previous_hash, tx_in.previous_index) for tx_in in tx.txs_in])
+
+    def release_tx(self, tx):
+        """
+        Make the inputs of a transaction spendable again in the UTXO store, after :meth:`record_signed` when the
+        transaction will not be completed - e.g. the oracle rejected or deferred it
+
+        :type tx: Tx
+        """
+        if self._utxo_store is not None:
+            self._utxo_store.release([(tx_in.previous_hash, tx_in.previous_index) for tx_in in tx.txs_in])
 
     def current_address(self):
         """
@@ -347,11 +724,11 @@ class Account(object):
         return self.address(self.num_int_keys - 1, True)
 
     def next_address(self):
-        self._cache['issued']['0'] += 1
+        self._issue('0')
         return self.current_address()
 
     def next_change_address(self):
-        self._cache['issued']['1'] += 1
+        self._issue('1')
         return self.current_change_address()
 
     def path_for(self, addr):
@@ -360,7 +737,7 @@ class Account(object):
         :return: sub-path (e.g. "0/123" or "1/456")
         :rtype: str
         """
-        return self.address_map[addr]
+        return self._ensure_address_map()[addr]
 
     def path_for_check(self, addr):
         """
@@ -369,11 +746,49 @@ class Account(object):
         :rtype: str
         :raise: if we haven't issued this address
         """
-        path = self.address_map[addr]
+        path = self._ensure_address_map().get(addr)
         if path is None:
             raise ValueError("unknown address %s"%(addr,))
         return path
 
+    def address_for_path(self, path):
+        """
+        :param str path: sub-path (e.g. "0/123" or "1/456")
+        :rtype: str
+        """
+        subchain, n = path.split('/')
+        return self.address(int(n), subchain == '1')
+
+    def path_for_script(self, script):
+        """
+        :param bytes script: an output script
+        :return: sub-path (e.g. "0/123" or "1/456") if the script pays to one of our addresses, else None
+        :rtype: str
+        """
+        self._ensure_address_map()
+        return self._script_map.get(script)
+
+    def path_for_script_check(self, script):
+        """
+        :param bytes script: an output script
+        :return: sub-path (e.g. "0/123" or "1/456")
+        :rtype: str
+        :raise: if the script does not pay to an address we have issued
+        """
+        path = self.path_for_script(script)
+        if path is None:
+            raise ValueError("unknown script %s" % (b2h(script),))
+        return path
+
+    def path_for_hash160(self, hash160):
+        """
+        :param bytes hash160: the script hash (multisig) or public key hash (single key) of one of our addresses
+        :return: sub-path (e.g. "0/123" or "1/456"), or None
+        :rtype: str
+        """
+        self._ensure_address_map()
+        return self._hash160_map.get(hash160)
+
     def keys_for_tx(self, tx):
         """
         A list of private keys, matching each input
@@ -382,6 +797,12 @@ class Account(object):
         """
         raise NotImplementedError()
 
+    @property
+    def signing_key(self):
+        """The private key from which :meth:`keys_for_tx` derives the key of each input by path, or None
+        :rtype: BIP32Node"""
+        return None
+
     def collect_redeem_scripts(self, tx):
         """
         :type tx: Tx
@@ -396,35 +817,63 @@ class Account(object):
         :return: whether any addresses were rotated due to incoming coins
         :rtype: bool
         """
-        scripts = [o.script for o in tx.txs_out]
-        rotated = False
-        while standard_tx_out_script(self.current_address()) in scripts:
-            self.next_address()
-            rotated = True
+        return self.rotate_addresses_for_scripts([o.script for o in tx.txs_out])
 
-        while standard_tx_out_script(self.current_change_address()) in scripts:
-            self.next_change_address()
-            rotated = True
-        return rotated
+    def rotate_addresses_for_scripts(self, scripts):
+        """
+        Rotate receiving and change addresses if coins were sent to any of the output scripts.
+        :param list[bytes] scripts: output scripts that received coins
+        :return: whether any addresses were rotated
+        :rtype: bool
+        """
+        self._ensure_address_map()
+        paid_paths = set(self._script_map.get(script) for script in scripts)
+        paid = []
+        for subchain in ('0', '1'):
+            while "%s/%d" % (subchain, self._cache['issued'][subchain] - 1) in paid_paths:
+                paid.append("%s/%d" % (subchain, self._cache['issued'][subchain] - 1))
+                self._issue(subchain)
+        self._invalidate_paths(paid)
+        return len(paid) > 0
 
 
 class SimpleAccount(Account):
-    __slots__ = ['_key']
+    __slots__ = ['_key', '_deriver']
 
-    def __init__(self, key, cache=None):
+    def __init__(self, key, cache=None, journal=None):
         """
         :type key: AccountKey
-        :param str cache: JSON formatted cache
+        :param bytes cache: cache - see :attr:`Account.cache`
+        :param bytes journal: cache journal - see :attr:`Account.journal`
         """
-        super(SimpleAccount, self).__init__(key._netcode, cache)
+        super(SimpleAccount, self).__init__(key._netcode, cache, journal)
         self._key = key
+        self._deriver = KeyDeriver(key)
+
+    def _sec(self, path):
+        """The cached sec of the public key for the path"""
+        if path not in self._cache['keys']:
+            self._cache_keys(path, [self._deriver.sec_for_path(path)])
+        return self._cache['keys'][path][0]
 
     def address(self, n, change=False):
         subchain_index = '1' if change else '0'
-        path = "%s/%s" % (subchain_index, n)
-        if path not in self._cache['keys']:
-            self._cache['keys'][path] = self._key.subkey_for_path(path + ".pub")
-        return self._cache['keys'][path].address()
+        sec = self._sec("%s/%s" % (subchain_index, n))
+        return encoding.hash160_sec_to_bitcoin_address(
+            encoding.hash160(sec), address_prefix=address_prefix_for_netcode(self.netcode))
+
+    def script_pubkey_for_path(self, path):
+        return ScriptPayToAddress(encoding.hash160(self._sec(path))).script()
+
+    def leaf_spec(self, prefix):
+        return LeafSpec(self.netcode, None, False, [self._deriver.chain_for_prefix(prefix)])
+
+    def estimated_input_size(self):
+        return p2pkh_input_size()
+
+    @property
+    def signing_key(self):
+        return self._key
 
     def keys_for_tx(self, tx):
         result = []
@@ -438,7 +887,8 @@ class SimpleAccount(Account):
 
 
 class MultisigAccount(Account):
-    def __init__(self, keys, num_sigs=None, sort=True, complete=True, netcode='BTC', cache=None):
+    def __init__(self, keys, num_sigs=None, sort=True, complete=True, netcode='BTC', cache=None, journal=None,
+                 leaf_cache_size=DEFAULT_LEAF_CACHE_SIZE):
         """
         Create a multisig account with multiple participating keys
 
@@ -446,9 +896,13 @@ class MultisigAccount(Account):
         :type keys: list[BIP32Node]
         :param num_sigs: number of required signatures
         :param complete: whether we need additional keys to complete the configuration of this account
+        :param leaf_cache_size: number of paths for which scripts and addresses are kept in memory,
+            or None for unbounded
         """
-        super(MultisigAccount, self).__init__(netcode, cache)
+        super(MultisigAccount, self).__init__(netcode, cache, journal)
+        self._leaf_cache = account_cache.LRUCache(leaf_cache_size)
         self._keys = keys
+        self._derivers = [KeyDeriver(key) for key in keys]
         self._local_key = next(iter([key for key in keys if key.is_private()]), None)  # first private key
         self._public_keys = [str(key.wallet_key(as_private=False)) for key in self._keys]
         self._num_sigs = num_sigs if num_sigs else len(keys) - (1 if complete else 0)
@@ -475,10 +929,16 @@ class MultisigAccount(Account):
     def add_oracle(self, oracle):
         self._oracles.append(oracle)
 
+    def prefetch_input_txs(self, spendables):
+        tx_hashes = [spend.tx_hash for spend in spendables]
+        for oracle in self._oracles:
+            oracle.prefetch_input_txs(tx_hashes)
+
     def add_key(self, key):
         if self._complete:
             raise Exception("account already complete")
         self._keys.append(key)
+        self._derivers.append(KeyDeriver(key))
         self._public_keys.append(key.wallet_key(as_private=False))
 
     def add_keys(self, keys):
@@ -490,6 +950,17 @@ class MultisigAccount(Account):
             raise Exception("account already complete")
         self._complete = True
 
+    def set_leaf_cache_size(self, size):
+        """Set the number of paths for which scripts and addresses are kept in memory"""
+        self._leaf_cache.max_size = size
+        self._leaf_cache.trim()
+
+    @property
+    def leaf_cache_stats(self):
+        """Size, hit, miss and eviction counts of the script and address memo
+        :rtype: dict"""
+        return self._leaf_cache.stats()
+
     def leaf_script(self, n, change=False):
         return self.script_for_path("%s/%s" % (1 if change else 0, n))
 
@@ -497,7 +968,31 @@ class MultisigAccount(Account):
         return self.payto_for_path("%s/%s" % (1 if change else 0, n))
 
     def address(self, n, change=False):
-        return self.leaf_payto(n, change).address(self.netcode)
+        return self._leaf("%s/%s" % (1 if change else 0, n)).address
+
+    def _leaf(self, path):
+        """
+        The memoized script bytes, hash160 and address for the path
+
+        :rtype: MultisigLeaf
+        """
+        leaf = self._leaf_cache.get(path)
+        if leaf is None:
+            if not self._complete:
+                raise Exception("account not complete")
+            if path not in self._cache['keys']:
+                self._cache_keys(path, [deriver.sec_for_path(path) for deriver in self._derivers])
+
+            secs = list(self._cache['keys'][path])
+            if self._sort:
+                secs.sort()
+            script = multisig_script(self._num_sigs, secs)
+            hash160 = encoding.hash160(script)
+            address = encoding.hash160_sec_to_bitcoin_address(
+                hash160, address_prefix=pay_to_script_prefix_for_netcode(self.netcode))
+            leaf = MultisigLeaf(tuple(secs), script, hash160, address)
+            self._leaf_cache[path] = leaf
+        return leaf
 
     def script_for_path(self, path):
         """Get the redeem script for the path.  The multisig format is (n-1) of n, but can be overridden.
@@ -507,18 +1002,24 @@ class MultisigAccount(Account):
         :return: the script
         :rtype: ScriptMultisig
         """
+        leaf = self._leaf(path)
+        return SerializedScriptMultisig(self._num_sigs, list(leaf.secs), leaf.script)
+
+    def leaf_spec(self, prefix):
         if not self._complete:
             raise Exception("account not complete")
-        if path not in self._cache['keys']:
-            self._cache['keys'][path] =\
-                [key.subkey_for_path(path + ".pub") for key in self.keys]
+        return LeafSpec(self.netcode, self._num_sigs, self._sort,
+                        [deriver.chain_for_prefix(prefix) for deriver in self._derivers])
 
-        subkeys = self._cache['keys'][path]
-        secs = [key.sec() for key in subkeys]
-        if self._sort:
-            secs.sort()
-        script = ScriptMultisig(self._num_sigs, secs)
-        return script
+    def estimated_input_size(self):
+        """The size of an input with num_sigs signatures and the redeem script over all cosigner keys.
+        The number of keys is only known once the account is complete."""
+        if not self._complete:
+            raise Exception("account not complete")
+        return p2sh_multisig_input_size(self._num_sigs, len(self._keys))
+
+    def script_pubkey_for_path(self, path):
+        return ScriptPayToScript(self._leaf(path).hash160).script()
 
     def payto_for_path(self, path):
         """Get the payto script for the path.  See also :meth:`.script`
@@ -528,10 +1029,13 @@ class MultisigAccount(Account):
         :return: the script
         :rtype: LeafPayTo
         """
-        script = self.script_for_path(path)
-        payto = LeafPayTo(hash160=encoding.hash160(script.script()), path=path)
+        payto = LeafPayTo(hash160=self._leaf(path).hash160, path=path)
         return payto
 
+    @property
+    def signing_key(self):
+        return self._local_key
+
     def keys_for_tx(self, tx):
         if self._local_key is None:
             raise ValueError("no private key supplied - can't sign")
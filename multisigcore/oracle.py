@@ -1,19 +1,59 @@
 from __future__ import print_function
+import random
+import threading
+import time
 import uuid
-from copy import deepcopy
 
 import dateutil.tz
 import dateutil.parser
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 from pycoin.tx import Tx
 from pycoin.ecdsa import generator_secp256k1
-from pycoin.serialize import stream_to_bytes
 from .hierarchy import *
+from . import rawscript
+from .txdb import InputTxResolver
 from pycoin.tx.script.tools import *
 from pycoin.tx.script import der
 
 __author__ = 'sserrano, devrandom'
 
+DEFAULT_TIMEOUT = (10, 60)
+"""Connect and read timeouts of oracle requests, in seconds"""
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+MAX_BACKOFF = 8.0
+DEFAULT_POOL_SIZE = 10
+RETRY_STATUS_CODES = (502, 503, 504)
+
+_shared_session = None
+_shared_session_lock = threading.Lock()
+
+
+def make_session(pool_size=DEFAULT_POOL_SIZE):
+    """
+    Create an HTTP session with a pool of keep-alive connections, which can be shared by many Oracle objects
+
+    :param int pool_size: maximum number of connections kept per host
+    :rtype: requests.Session
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def shared_session():
+    """The HTTP session used by Oracle objects by default
+    :rtype: requests.Session"""
+    global _shared_session
+    with _shared_session_lock:
+        if _shared_session is None:
+            _shared_session = make_session()
+        return _shared_session
+
 
 class Error(Exception):
     pass
@@ -115,10 +155,32 @@ class RequestLogger(dict):
     def after(self, method, url, response, request_headers=None, request_body=None, **kwargs):
         pass
 
+def _not_connected(e):
+    """Whether a requests exception means that the connection could not be established, so that the request
+    was not sent - a connect timeout, or e.g. a refused connection"""
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    seen = set()
+    causes = [e]
+    while causes:
+        cause = causes.pop()
+        if cause is None or id(cause) in seen:
+            continue
+        seen.add(id(cause))
+        if isinstance(cause, NewConnectionError):
+            return True
+        # requests wraps urllib3's MaxRetryError, which holds the original error as its reason
+        causes.append(getattr(cause, 'reason', None))
+        causes.append(getattr(cause, '__cause__', None))
+        causes.extend(arg for arg in getattr(cause, 'args', ()) if isinstance(arg, BaseException))
+    return False
+
+
 class Oracle(object):
     """Keep track of a single Oracle account, including user keys and oracle master public key"""
 
-    def __init__(self, account, tx_db=None, manager=None, base_url=None, num_oracle_keys=1):
+    def __init__(self, account, tx_db=None, manager=None, base_url=None, num_oracle_keys=1, session=None,
+                 timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF):
         """
         Create an Oracle object
 
@@ -126,17 +188,27 @@ class Oracle(object):
         :type account: MultisigAccount
         :param tx_db: lookup database for transactions - see pycoin.services.get_tx_db()
         :param manager: the manager identifier for this wallet (only used on creation for now)
+        :param session: the HTTP session, by default one shared by all Oracle objects - see :func:`make_session`
+        :type session: requests.Session
+        :param timeout: seconds to wait for each request, or a (connect, read) tuple
+        :param int retries: number of retries of transient failures
+        :param float backoff: base delay between retries in seconds, doubled on each retry
         """
         self._account = account
         self.manager = manager
         self._wallet_agent = 'multisig-core-0.01'
-        self.tx_db = tx_db
+        self._tx_db = tx_db
+        self._input_tx_resolver = None
         self.base_url = base_url or 'https://s.digitaloracle.co/'
         self.num_oracle_keys = num_oracle_keys
         self.verbose = 0
         self._account.add_oracle(self)
         self._request_logger = RequestLogger()
         self._default_headers = {'content-type': 'application/json'}
+        self._session = session
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
 
     @property
     def account(self):
@@ -144,6 +216,47 @@ class Oracle(object):
         :returns hierarchy.MultisigAccount"""
         return self._account
 
+    @property
+    def tx_db(self):
+        """The lookup database for transactions"""
+        return self._tx_db
+
+    @tx_db.setter
+    def tx_db(self, tx_db):
+        if self._input_tx_resolver is not None:
+            self._input_tx_resolver.close()
+            self._input_tx_resolver = None
+        self._tx_db = tx_db
+
+    @property
+    def input_tx_resolver(self):
+        """Looks up the previous transactions of the transactions we sign, through tx_db
+        :returns txdb.InputTxResolver"""
+        if self._input_tx_resolver is None:
+            self._input_tx_resolver = InputTxResolver(self._tx_db)
+        return self._input_tx_resolver
+
+    def prefetch_input_txs(self, tx_hashes):
+        """
+        Start looking up previous transactions in the background, so that they are ready when we sign
+
+        :param tx_hashes: the hashes of the transactions that will be spent
+        """
+        if self._tx_db is not None:
+            self.input_tx_resolver.prefetch(tx_hashes)
+
+    @property
+    def session(self):
+        """The HTTP session, by default one shared by all Oracle objects
+        :returns requests.Session"""
+        if self._session is None:
+            self._session = shared_session()
+        return self._session
+
+    @session.setter
+    def session(self, session):
+        self._session = session
+
     @property
     def wallet_agent(self):
         return self._wallet_agent
@@ -161,15 +274,45 @@ class Oracle(object):
         """:type _logger: RequestLogger"""
         self._request_logger = _logger
 
+    def _backoff(self, attempt):
+        """Full jitter - a random delay up to the exponential backoff, so that clients do not retry in lockstep"""
+        return random.uniform(0, min(MAX_BACKOFF, self.backoff * 2 ** attempt))
+
+    def _request(self, method, url, body=None, idempotent=False):
+        """
+        Send a request to the oracle, retrying transient failures with backoff.
+
+        Idempotent requests are retried on timeouts, connection errors and 502/503/504 responses.  Other requests
+        are only retried if the connection could not be established, so that they cannot take effect twice.
+
+        :rtype: requests.Response
+        """
+        headers = self._default_headers if body is not None else None
+        attempt = 0
+        while True:
+            self._request_logger.before(method, url, headers, body)
+            try:
+                response = self.session.request(method, url, data=body, headers=headers, timeout=self.timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt >= self.retries or not (idempotent or _not_connected(e)):
+                    raise
+            else:
+                self._request_logger.after(method, url, response, headers, body)
+                if not idempotent or response.status_code not in RETRY_STATUS_CODES or attempt >= self.retries:
+                    return response
+            time.sleep(self._backoff(attempt))
+            attempt += 1
+
     def _create_oracle_request(self, input_chain_paths, output_chain_paths, spend_id, tx, verifications=None, callback=None):
         """:nodoc:"""
-        tx = deepcopy(tx)  # keep original Tx object intact, so that it is not mutated by fix_input_scripts below.
-        # Have the Oracle sign the tx
+        # Have the Oracle sign the tx.  Input scripts are fixed in a shallow view, so that tx is not mutated.
+        txs_in = list(tx.txs_in)
         chain_paths = []
         input_scripts = []
         input_txs = []
+        resolved = self.input_tx_resolver.resolve([inp.previous_hash for inp in tx.txs_in])
         for i, inp in enumerate(tx.txs_in):
-            input_tx = self.tx_db.get(inp.previous_hash)
+            input_tx = resolved[inp.previous_hash]
             if input_tx is None:
                 raise Error("could not look up tx for %s" % (b2h(inp.previous_hash)))
             input_txs.append(input_tx)
@@ -177,16 +320,16 @@ class Oracle(object):
                 redeem_script = self._account.script_for_path(input_chain_paths[i]).script()
                 input_scripts.append(redeem_script)
                 chain_paths.append(input_chain_paths[i])
-                fix_input_script(inp, redeem_script)
+                txs_in[i] = TxIn(inp.previous_hash, inp.previous_index, fixed_input_script(inp.script), inp.sequence)
             else:
                 input_scripts.append(None)
                 chain_paths.append(None)
         req = {
             "walletAgent": self._wallet_agent,
             "transaction": {
-                "bytes": b2h(stream_to_bytes(tx.stream)),
+                "bytes": b2h(Tx(tx.version, txs_in, tx.txs_out, tx.lock_time).as_bin()),
                 "inputScripts": [(b2h(script) if script else None) for script in input_scripts],
-                "inputTransactions": [b2h(stream_to_bytes(tx.stream)) for tx in input_txs],
+                "inputTransactions": input_txs,
                 "chainPaths": chain_paths,
                 "outputChainPaths": output_chain_paths,
                 "masterKeys": self._account.public_keys[0:-self.num_oracle_keys],
@@ -213,9 +356,15 @@ class Oracle(object):
         :return: a dictionary with the transaction in 'transaction' if successful
         :rtype: dict
         """
+        input_chain_paths, output_chain_paths = self._chain_paths(tx)
+        return self.sign_with_paths(tx, input_chain_paths, output_chain_paths, spend_id, verifications, callback=callback)
+
+    @staticmethod
+    def _chain_paths(tx):
+        """:return: the paths of the inputs and of the change outputs of an AccountTx"""
         input_chain_paths = [x.path if isinstance(x, AccountTxIn) else None for x in tx.txs_in]
         output_chain_paths = [x.path if isinstance(x, AccountTxOut) else None for x in tx.txs_out]
-        return self.sign_with_paths(tx, input_chain_paths, output_chain_paths, spend_id, verifications, callback=callback)
+        return input_chain_paths, output_chain_paths
 
     def sign_with_paths(self, tx, input_chain_paths, output_chain_paths, spend_id=None, verifications=None, callback=None):
         """
@@ -234,21 +383,35 @@ class Oracle(object):
         :return: a dictionary with the transaction in 'transaction' if successful
         :rtype: dict
         """
+        try:
+            url, body = self._sign_request(tx, input_chain_paths, output_chain_paths, spend_id, verifications,
+                                           callback)
+            # the oracle recognizes a repeated spend id, so only such requests are safe to retry
+            response = self._request('post', url, body, idempotent=bool(spend_id))
+            return self._sign_result(response.status_code, response.content)
+        except Exception:
+            # the transaction is not complete, so its inputs are spendable again
+            self._account.release_tx(tx)
+            raise
+
+    def _sign_request(self, tx, input_chain_paths, output_chain_paths, spend_id, verifications, callback):
+        """:return: the URL and body of a sign request"""
         req = self._create_oracle_request(input_chain_paths, output_chain_paths, spend_id, tx, verifications, callback=callback)
         body = json.dumps(req)
-        url = self._url() + "/transactions"
         if self.verbose > 0:
             print(body)
-        self._request_logger.before('post', url, self._default_headers, body)
-        response = requests.post(url, body, headers=self._default_headers)
-        self._request_logger.after('post', url, response, self._default_headers, body)
-        if response.status_code >= 500:
-            raise OracleInternalError(response.content)
-        result = response.json()
-        if response.status_code == 200 and result.get('result', None) == 'success':
+        return self._url() + "/transactions", body
+
+    def _sign_result(self, status_code, content):
+        """Interpret the response to a sign request"""
+        if status_code >= 500:
+            raise OracleInternalError(content)
+        result = json.loads(content.decode('utf8'))
+        if status_code == 200 and result.get('result', None) == 'success':
             tx = None
             if 'transaction' in result:
                 tx = Tx.tx_from_hex(result['transaction']['bytes'])
+                self._account.record_tx(tx)
             return SignatureResult({
                 'transaction': tx,
                 'now': result['now'],
@@ -269,10 +432,10 @@ class Oracle(object):
             raise OracleLockoutException()
         elif result.get('error') == 'Platform  velocity  hard-limit  exceeded':
             raise OraclePlatformVelocityHardLimitException('Platform  velocity  hard-limit  exceeded')
-        elif response.status_code == 200 or response.status_code == 400:
-            raise OracleError(response.content)
+        elif status_code == 200 or status_code == 400:
+            raise OracleError(content)
         else:
-            raise IOError("Unknown response %d" % (response.status_code,))
+            raise IOError("Unknown response %d" % (status_code,))
 
     def _uuid(self):
         """Get oracle keychain identifier"""
@@ -284,23 +447,32 @@ class Oracle(object):
 
     def get(self):
         """Retrieve the oracle public key from the Oracle"""
+        url = self._get_request()
+        response = self._request('get', url, idempotent=True)
+        self._get_result(url, response.status_code, response.content)
+
+    def _get_request(self):
+        """:return: the URL of a keychain request"""
         if self._account.complete:
             raise Exception("the account for this Oracle is already complete")
-        url = self._url()
-        self._request_logger.before('get', url)
-        response = requests.get(url)
-        self._request_logger.after('get', url, response)
-        result = response.json()
-        if response.status_code == 200 and result.get('result', None) == 'success':
-            self._account.add_keys([AccountKey.from_key(s) for s in result['keys']['default']])
-            self.num_oracle_keys = len(result['keys']['default'])
-            self._account.set_complete()
-        elif response.status_code == 200 or response.status_code == 400:
-            raise OracleError(response.content)
-        elif response.status_code == 404:
+        return self._url()
+
+    def _get_result(self, url, status_code, content):
+        """Interpret the response to a keychain request"""
+        result = json.loads(content.decode('utf8'))
+        if status_code == 200 and result.get('result', None) == 'success':
+            self._add_oracle_keys(result)
+        elif status_code == 200 or status_code == 400:
+            raise OracleError(content)
+        elif status_code == 404:
             raise OracleUnknownKeychainException("No keychain found on %s" % (url,))
         else:
-            raise Error("Unknown response %d" % (response.status_code,))
+            raise Error("Unknown response %d" % (status_code,))
+
+    def _add_oracle_keys(self, result):
+        self._account.add_keys([AccountKey.from_key(s) for s in result['keys']['default']])
+        self.num_oracle_keys = len(result['keys']['default'])
+        self._account.set_complete()
 
     @staticmethod
     def populate_pii(personal_info):
@@ -340,6 +512,12 @@ class Oracle(object):
                 }
            }
         """
+        url, body = self._create_request(parameters, personal_info)
+        response = self._request('post', url, body)
+        self._create_result(body, response.status_code, response.content)
+
+    def _create_request(self, parameters, personal_info):
+        """:return: the URL and body of a keychain creation request"""
         if self._account.complete:
             raise Exception("account already complete")
         r = {'walletAgent': self._wallet_agent, 'rulesetId': 'default'}
@@ -348,25 +526,21 @@ class Oracle(object):
         r['pii'] = self.populate_pii(personal_info)
         r['parameters'] = parameters
         r['keys'] = [k.hwif() for k in self._account.keys]
-        body = json.dumps(r)
-        url = self._url()
-        self._request_logger.before('post', url, self._default_headers, body)
-        response = requests.post(url, body, headers=self._default_headers)
-        self._request_logger.after('post', url, response, self._default_headers, body)
-
-        result = response.json()
-        if response.status_code == 200 and result.get('result', None) == 'success':
-            self._account.add_keys([AccountKey.from_key(s) for s in result['keys']['default']])
-            self.num_oracle_keys = len(result['keys']['default'])
-            self._account.set_complete()
-        elif response.status_code == 400 and result.get('error', None) == 'already exists':
+        return self._url(), json.dumps(r)
+
+    def _create_result(self, body, status_code, content):
+        """Interpret the response to a keychain creation request"""
+        result = json.loads(content.decode('utf8'))
+        if status_code == 200 and result.get('result', None) == 'success':
+            self._add_oracle_keys(result)
+        elif status_code == 400 and result.get('error', None) == 'already exists':
             raise OracleAccountExistsException("already exists")
-        elif response.status_code == 200 or response.status_code == 400:
-            raise OracleError(response.content)
+        elif status_code == 200 or status_code == 400:
+            raise OracleError(content)
         else:
             print(body)
-            print(response.content)
-            raise Error("Unknown response %d" % (response.status_code,))
+            print(content)
+            raise Error("Unknown response %d" % (status_code,))
 
     def verify_personal_information(self, personal_info, call=None, callback=None):
         """
@@ -379,6 +553,12 @@ class Oracle(object):
         :param callback: URL where Oracle can inform the app about asynchronous results
         :type callback: str
         """
+        url, body = self._verify_request(personal_info, call, callback)
+        response = self._request('post', url, body)
+        self._verify_result(body, response.status_code, response.content)
+
+    def _verify_request(self, personal_info, call, callback):
+        """:return: the URL and body of a personal information verification request"""
         r = {'walletAgent': self._wallet_agent}
         if self.manager:
             r['managerUsername'] = self.manager
@@ -387,25 +567,23 @@ class Oracle(object):
             r['callback'] = callback
         if call:
             r['call'] = call
-        body = json.dumps(r)
-        url = self._url() + "/verifyPii"
-        self._request_logger.before('post', url, self._default_headers, body)
-        response = requests.post(url, body, headers=self._default_headers)
-        self._request_logger.after('post', url, response, self._default_headers, body)
-
-        result = response.json()
-        if response.status_code == 200 and result.get('result', None) == 'success':
+        return self._url() + "/verifyPii", json.dumps(r)
+
+    def _verify_result(self, body, status_code, content):
+        """Interpret the response to a personal information verification request"""
+        result = json.loads(content.decode('utf8'))
+        if status_code == 200 and result.get('result', None) == 'success':
             pass
-        elif response.status_code == 400 and result.get('error', None) == 'phone type not yet known':
+        elif status_code == 400 and result.get('error', None) == 'phone type not yet known':
             raise OracleCannotCallException(result['error'])
-        elif response.status_code == 400 and result.get('error', None) == 'phone is not a landline':
+        elif status_code == 400 and result.get('error', None) == 'phone is not a landline':
             raise OracleCannotCallException(result['error'])
-        elif response.status_code == 200 or response.status_code == 400:
-            raise OracleError(response.content)
+        elif status_code == 200 or status_code == 400:
+            raise OracleError(content)
         else:
             print(body)
-            print(response.content)
-            raise Error("Unknown response %d" % (response.status_code,))
+            print(content)
+            raise Error("Unknown response %d" % (status_code,))
 
 def dummy_signature(sig_type):
     order = generator_secp256k1.order()
@@ -415,10 +593,12 @@ def dummy_signature(sig_type):
 
 def fix_input_script(inp, redeem_script):
     """replace dummy signatures with OP_0 and add redeem script for digitaloracle compatibility"""
-    dummy = b2h(dummy_signature(1))
-    ops1 = []
-    for op in opcode_list(inp.script):
-        if op == dummy:
-            op = 'OP_0'
-        ops1.append(op)
-    inp.script = compile(' '.join(ops1))
+    inp.script = fixed_input_script(inp.script)
+
+
+DUMMY_SIGNATURE = dummy_signature(1)
+
+
+def fixed_input_script(script):
+    """:return: the input script with dummy signatures replaced by OP_0 - see :func:`fix_input_script`"""
+    return rawscript.replace_pushes(script, DUMMY_SIGNATURE, bytes_from_int(rawscript.OP_0))
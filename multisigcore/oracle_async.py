@@ -0,0 +1,150 @@
+"""
+An asyncio client for the digitaloracle API.  Requires Python 3.5 or later and aiohttp.
+
+Requests are constructed and responses interpreted as in :class:`multisigcore.oracle.Oracle`, and raise the same
+exceptions.  A session - a pool of keep-alive connections - can be shared by any number of AsyncOracle objects,
+for example one per account, and the number of requests in flight is bounded.
+"""
+import asyncio
+
+import aiohttp
+
+from .oracle import Oracle, DEFAULT_TIMEOUT, DEFAULT_RETRIES, DEFAULT_BACKOFF, DEFAULT_POOL_SIZE, \
+    RETRY_STATUS_CODES
+
+__author__ = 'devrandom'
+
+DEFAULT_CONCURRENCY = 50
+
+
+def make_session(pool_size=DEFAULT_POOL_SIZE):
+    """
+    Create an HTTP session with a pool of keep-alive connections, which can be shared by many AsyncOracle objects.
+    Call from a coroutine, and close it when done.
+
+    :param int pool_size: maximum number of connections kept per host
+    :rtype: aiohttp.ClientSession
+    """
+    return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit_per_host=pool_size))
+
+
+def client_timeout(timeout):
+    """:param timeout: seconds for the whole request, or a (connect, read) tuple"""
+    if isinstance(timeout, tuple):
+        return aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+    return aiohttp.ClientTimeout(total=timeout)
+
+
+class AsyncOracle(Oracle):
+    """
+    Keep track of a single Oracle account, with coroutines for the requests to the oracle.
+
+    Looking up the input transactions of a transaction to sign may block, so it is done in the default executor -
+    see :meth:`Oracle.prefetch_input_txs`.
+    """
+    def __init__(self, account, tx_db=None, manager=None, base_url=None, num_oracle_keys=1, session=None,
+                 timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF,
+                 concurrency=DEFAULT_CONCURRENCY, semaphore=None):
+        """
+        See :class:`Oracle`
+
+        :param session: the HTTP session, by default a new one closed by :meth:`close` - see :func:`make_session`
+        :type session: aiohttp.ClientSession
+        :param int concurrency: maximum number of requests in flight
+        :param semaphore: limits the requests in flight, and can be shared with other AsyncOracle objects.
+            Overrides concurrency.
+        :type semaphore: asyncio.Semaphore
+        """
+        super(AsyncOracle, self).__init__(account, tx_db, manager, base_url, num_oracle_keys, session,
+                                          timeout, retries, backoff)
+        self._own_session = session is None
+        self.concurrency = concurrency
+        self._semaphore = semaphore
+
+    @property
+    def session(self):
+        """The HTTP session
+        :returns aiohttp.ClientSession"""
+        if self._session is None:
+            self._session = make_session()
+        return self._session
+
+    @session.setter
+    def session(self, session):
+        self._session = session
+        self._own_session = False
+
+    async def close(self):
+        """Close the session, unless it was passed in"""
+        if self._own_session and self._session is not None:
+            await self._session.close()
+        self._session = None
+
+    async def _request(self, method, url, body=None, idempotent=False):
+        """
+        Send a request to the oracle, retrying transient failures with backoff - see :meth:`Oracle._request`
+
+        :return: the status code and the content of the response
+        :rtype: (int, bytes)
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        headers = self._default_headers if body is not None else None
+        attempt = 0
+        while True:
+            self._request_logger.before(method, url, headers, body)
+            try:
+                async with self._semaphore:
+                    async with self.session.request(method, url, data=body, headers=headers,
+                                                    timeout=client_timeout(self.timeout)) as response:
+                        content = await response.read()
+            except aiohttp.ClientConnectorError:
+                # the request was not sent
+                if attempt >= self.retries:
+                    raise
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt >= self.retries or not idempotent:
+                    raise
+            else:
+                self._request_logger.after(method, url, response, headers, body)
+                if not idempotent or response.status not in RETRY_STATUS_CODES or attempt >= self.retries:
+                    return response.status, content
+            await asyncio.sleep(self._backoff(attempt))
+            attempt += 1
+
+    async def sign(self, tx, spend_id=None, verifications=None, callback=None):
+        """See :meth:`Oracle.sign`"""
+        input_chain_paths, output_chain_paths = self._chain_paths(tx)
+        return await self.sign_with_paths(tx, input_chain_paths, output_chain_paths, spend_id, verifications,
+                                          callback=callback)
+
+    async def sign_with_paths(self, tx, input_chain_paths, output_chain_paths, spend_id=None, verifications=None,
+                              callback=None):
+        """See :meth:`Oracle.sign_with_paths`"""
+        loop = asyncio.get_event_loop()
+        try:
+            url, body = await loop.run_in_executor(None, self._sign_request, tx, input_chain_paths,
+                                                   output_chain_paths, spend_id, verifications, callback)
+            status_code, content = await self._request('post', url, body, idempotent=bool(spend_id))
+            return self._sign_result(status_code, content)
+        except Exception:
+            self._account.release_tx(tx)
+            raise
+
+    async def get(self):
+        """See :meth:`Oracle.get`"""
+        url = self._get_request()
+        status_code, content = await self._request('get', url, idempotent=True)
+        self._get_result(url, status_code, content)
+
+    async def create(self, parameters, personal_info):
+        """See :meth:`Oracle.create`"""
+        url, body = self._create_request(parameters, personal_info)
+        status_code, content = await self._request('post', url, body)
+        self._create_result(body, status_code, content)
+
+    async def verify_personal_information(self, personal_info, call=None, callback=None):
+        """See :meth:`Oracle.verify_personal_information`"""
+        url, body = self._verify_request(personal_info, call, callback)
+        status_code, content = await self._request('post', url, body)
+        self._verify_result(body, status_code, content)
@@ -0,0 +1,288 @@
+"""
+Sign many transactions in two overlapping stages - local signing on a process pool, and oracle signing on a
+thread pool.
+
+CPU bound local signing and I/O bound oracle round trips of different transactions overlap, and results are
+returned in completion order.  The number of transactions in flight is bounded, so that a long or endless
+stream of transactions is consumed no faster than it is signed.
+"""
+import collections
+import multiprocessing
+import pickle
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from pycoin.key.BIP32Node import BIP32Node
+
+from . import local_sign
+
+__author__ = 'devrandom'
+
+DEFAULT_THREADS = 8
+DEFAULT_MAX_IN_FLIGHT = 64
+DEFAULT_STATS_WINDOW = 1000
+
+STAGE_LOCAL = 'local'
+STAGE_ORACLE = 'oracle'
+
+SigningResult = collections.namedtuple('SigningResult', ['index', 'tx', 'signature', 'error', 'stage'])
+"""
+The outcome for one transaction.
+
+index is the position of the transaction in the input stream, tx the locally signed transaction,
+signature the :class:`multisigcore.oracle.SignatureResult` if the oracle signed, error the exception if a stage
+failed - e.g. :class:`multisigcore.oracle.OracleDeferralException` - and stage the name of the failed stage.
+"""
+
+
+class StageStats(object):
+    """Counts and latencies of one pipeline stage"""
+    __slots__ = ['count', 'errors', 'latencies']
+
+    def __init__(self, window=DEFAULT_STATS_WINDOW):
+        """
+        :param int window: number of recent latencies kept
+        """
+        self.count = 0
+        self.errors = 0
+        self.latencies = collections.deque(maxlen=window)
+
+    def record(self, elapsed, failed=False):
+        self.count += 1
+        if failed:
+            self.errors += 1
+        self.latencies.append(elapsed)
+
+    def as_dict(self):
+        ordered = sorted(self.latencies)
+
+        def percentile(p):
+            return ordered[min(int(p * len(ordered)), len(ordered) - 1)] if ordered else None
+        return {'count': self.count, 'errors': self.errors,
+                'mean': sum(ordered) / len(ordered) if ordered else None,
+                'p50': percentile(0.5), 'p95': percentile(0.95), 'max': ordered[-1] if ordered else None}
+
+
+_worker_signing_key = {}
+"""The parsed signing key of a worker process, so that its public key is computed once.  Only used in pool
+workers - they exit when the pipeline is closed."""
+
+
+def _parse_signing_key(hwif):
+    root = _worker_signing_key.get(hwif)
+    if root is None:
+        _worker_signing_key.clear()
+        root = _worker_signing_key[hwif] = BIP32Node.from_hwif(hwif)
+    return root
+
+
+def _local_sign_job(args):
+    """Sign a transaction locally, in a worker process.  Private keys are derived here, since that is CPU bound too.
+    The signing key is the account key when signing in-process, and its serialization when sent to a worker.
+
+    :return: the signed transaction, the elapsed time and the exception if signing failed
+    """
+    tx, redeem_scripts, signing_key, paths, keys = args
+    start = time.time()
+    try:
+        if signing_key is not None:
+            if not isinstance(signing_key, BIP32Node):
+                signing_key = _parse_signing_key(signing_key)
+            keys = [signing_key.subkey_for_path(path) if path else None for path in paths]
+        local_sign(tx, redeem_scripts, [key for key in keys if key is not None])
+        return tx, time.time() - start, None
+    except Exception as e:
+        return tx, time.time() - start, e
+
+
+def _apply_async(pool, func, args, callback, error_callback):
+    """
+    Pool.apply_async, with error_callback also reporting failures outside func - e.g. arguments that cannot be
+    pickled.  Python 2 pools have no error callback, so there the arguments are checked up front.
+    """
+    if sys.version_info >= (3,):
+        pool.apply_async(func, args, callback=callback, error_callback=error_callback)
+        return
+    try:
+        pickle.dumps(args, pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        error_callback(e)
+        return
+    pool.apply_async(func, args, callback=callback)
+
+
+class SigningPipeline(object):
+    """
+    Sign transactions of an account locally, and then with an oracle if one is given.
+
+    Local signing works on copies of the transactions when it runs on a process pool - the signed transactions
+    are in the results.  The UTXO store of the account is updated as in :meth:`Account.sign`, and the inputs of
+    transactions that the oracle did not sign are released.
+    """
+    def __init__(self, account, oracle=None, processes=None, threads=DEFAULT_THREADS,
+                 max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+        """
+        :param account: the account that owns the inputs
+        :type account: multisigcore.hierarchy.Account
+        :param oracle: the oracle that co-signs, or None to only sign locally
+        :type oracle: multisigcore.oracle.Oracle
+        :param int processes: number of local signing processes, defaults to the number of CPUs.  1 signs in-process.
+        :param int threads: maximum number of concurrent oracle requests
+        :param int max_in_flight: maximum number of transactions taken from the input and not yet returned
+        """
+        self.account = account
+        self.oracle = oracle
+        self.processes = processes
+        self.threads = threads
+        self.max_in_flight = max_in_flight
+        self._stats = {STAGE_LOCAL: StageStats(), STAGE_ORACLE: StageStats(), 'total': StageStats()}
+        self._lock = threading.Lock()
+        self._process_pool = None
+        self._thread_pool = None
+
+    def stats(self):
+        """
+        :return: count, errors and latency statistics in seconds of each stage, and of whole transactions
+        :rtype: dict[str, dict]
+        """
+        with self._lock:
+            return dict((stage, stats.as_dict()) for stage, stats in self._stats.items())
+
+    def _record(self, stage, elapsed, failed=False):
+        with self._lock:
+            self._stats[stage].record(elapsed, failed)
+
+    def _local_args(self, tx):
+        signing_key = self.account.signing_key
+        if signing_key is not None:
+            if self.processes != 1:
+                signing_key = signing_key.hwif(as_private=True)
+            return (tx, self.account.collect_redeem_scripts(tx), signing_key,
+                    [getattr(tx_in, 'path', None) for tx_in in tx.txs_in], None)
+        return tx, self.account.collect_redeem_scripts(tx), None, None, self.account.keys_for_tx(tx)
+
+    def _oracle_sign(self, tx):
+        start = time.time()
+        try:
+            signature = self.oracle.sign(tx)
+        except Exception as e:
+            self._record(STAGE_ORACLE, time.time() - start, True)
+            self.account.release_tx(tx)
+            return None, e
+        self._record(STAGE_ORACLE, time.time() - start)
+        return signature, None
+
+    def sign(self, txs):
+        """
+        Sign a stream of transactions.  Failures of one transaction do not stop the others.
+
+        :param txs: the transactions to sign, e.g. from :meth:`Account.tx`
+        :type txs: collections.Iterable[multisigcore.hierarchy.AccountTx]
+        :return: the results, in completion order
+        :rtype: collections.Iterator[SigningResult]
+        """
+        results = queue.Queue()
+        tokens = queue.Queue(self.max_in_flight)
+        stop = threading.Event()
+
+        def finish(start, result):
+            self._record('total', time.time() - start, result.error is not None)
+            results.put(result)
+
+        def on_oracle(index, start, tx, outcome):
+            signature, error = outcome
+            finish(start, SigningResult(index, tx, signature, error, STAGE_ORACLE if error else None))
+
+        def on_local(index, start, outcome):
+            tx, elapsed, error = outcome
+            self._record(STAGE_LOCAL, elapsed, error is not None)
+            if error is not None:
+                finish(start, SigningResult(index, tx, None, error, STAGE_LOCAL))
+                return
+            try:
+                self.account.record_signed(tx)
+            except Exception as e:
+                finish(start, SigningResult(index, tx, None, e, STAGE_LOCAL))
+                return
+            if self.oracle is None:
+                finish(start, SigningResult(index, tx, None, None, None))
+                return
+            # _oracle_sign returns failures as its outcome
+            self._threads().apply_async(self._oracle_sign, (tx,),
+                                        callback=lambda outcome: on_oracle(index, start, tx, outcome))
+
+        def submit(index, tx):
+            start = time.time()
+            try:
+                args = self._local_args(tx)
+            except Exception as e:
+                on_local(index, start, (tx, 0.0, e))
+                return
+            if self.processes == 1:
+                on_local(index, start, _local_sign_job(args))
+            else:
+                _apply_async(self._processes(), _local_sign_job, (args,),
+                             lambda outcome: on_local(index, start, outcome),
+                             lambda e: on_local(index, start, (tx, 0.0, e)))
+
+        def feed():
+            count = 0
+            try:
+                for tx in txs:
+                    while True:
+                        try:
+                            tokens.put(None, timeout=0.1)
+                            break
+                        except queue.Full:
+                            if stop.is_set():
+                                return
+                    submit(count, tx)
+                    count += 1
+            except Exception as e:
+                results.put(e)
+            results.put(count)
+
+        feeder = threading.Thread(target=feed)
+        feeder.daemon = True
+        feeder.start()
+        returned = 0
+        total = None
+        try:
+            while total is None or returned < total:
+                item = results.get()
+                if isinstance(item, SigningResult):
+                    tokens.get()
+                    returned += 1
+                    yield item
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    total = item
+        finally:
+            stop.set()
+
+    def _processes(self):
+        with self._lock:
+            if self._process_pool is None:
+                self._process_pool = multiprocessing.Pool(self.processes)
+            return self._process_pool
+
+    def _threads(self):
+        with self._lock:
+            if self._thread_pool is None:
+                self._thread_pool = ThreadPool(self.threads)
+            return self._thread_pool
+
+    def close(self):
+        with self._lock:
+            pools = [pool for pool in (self._process_pool, self._thread_pool) if pool is not None]
+            self._process_pool = self._thread_pool = None
+        for pool in pools:
+            pool.terminate()
+            pool.join()
@@ -3,9 +3,47 @@ __author__ = 'devrandom'
 
 class BatchService(object):
     """Marker class for providers that implement spendables_for_addresses"""
+    invalidates = False
+    """Whether :meth:`invalidate` does anything, so that callers need not derive the addresses otherwise"""
     def spendables_for_addresses(self, addresses):
         """
         :param list[str] addresses:
         :rtype: list[pycoin.tx.Spendable.Spendable]
         """
-        raise NotImplementedError()
\ No newline at end of file
+        raise NotImplementedError()
+
+    def used_addresses(self, addresses):
+        """
+        The addresses that appear in any transaction, including spent ones.  Used for gap limit discovery.
+        Providers that cannot answer this return None, and only addresses with spendables count as used.
+
+        :param list[str] addresses:
+        :rtype: set[str] or None
+        """
+        return None
+
+    def invalidate(self, addresses=None):
+        """
+        Called when the spendables of the addresses changed, for providers that cache them
+
+        :param addresses: the addresses, or None for all
+        :type addresses: list[str]
+        """
+        pass
+
+
+class AsyncBatchService(object):
+    """Marker class for asyncio providers.  The methods are coroutines, otherwise as in :class:`BatchService`."""
+    def spendables_for_addresses(self, addresses):
+        """
+        :param list[str] addresses:
+        :return: a coroutine returning list[pycoin.tx.Spendable.Spendable]
+        """
+        raise NotImplementedError()
+
+    def used_addresses(self, addresses):
+        """
+        :param list[str] addresses:
+        :return: a coroutine returning set[str] or None
+        """
+        raise NotImplementedError()
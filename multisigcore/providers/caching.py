@@ -0,0 +1,127 @@
+import threading
+import time
+
+from pycoin.tx.TxOut import standard_tx_out_script
+from . import BatchService
+
+__author__ = 'devrandom'
+
+DEFAULT_TTL = 30
+
+
+class CachingService(BatchService):
+    """
+    A read-through cache of spendables in front of another provider.
+
+    Spendables are cached per address for ttl seconds.  A batch only queries the provider for the addresses
+    that are not cached or expired, in one call.  Accounts invalidate the addresses they spend from or
+    receive to - see :meth:`BatchService.invalidate`.  A fetch that was in flight when its address was
+    invalidated is returned, but not cached.
+    """
+    invalidates = True
+    def __init__(self, provider, ttl=DEFAULT_TTL, clock=time.time):
+        """
+        :param provider: a BatchService, or a provider with spendables_for_address
+        :param float ttl: seconds to keep the spendables of an address
+        :param clock: returns the current time in seconds
+        """
+        self.provider = provider
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+        # invalidation generations, for fetches in flight
+        self._generation = 0
+        self._cleared = 0
+        self._invalidated = {}
+        self._fetching = 0
+
+    def _fetch(self, addresses):
+        """Query the provider, and group the spendables by address"""
+        if isinstance(self.provider, BatchService):
+            spendables = self.provider.spendables_for_addresses(addresses)
+        else:
+            spendables = []
+            for address in addresses:
+                spendables.extend(self.provider.spendables_for_address(address) or [])
+        by_script = dict((standard_tx_out_script(address), address) for address in addresses)
+        result = dict((address, []) for address in addresses)
+        unmatched = []
+        for spend in spendables:
+            address = by_script.get(spend.script)
+            if address is None:
+                unmatched.append(spend)
+            else:
+                result[address].append(spend)
+        return result, unmatched
+
+    def spendables_for_addresses(self, addresses):
+        now = self.clock()
+        result = {}
+        with self._lock:
+            for address in addresses:
+                entry = self._entries.get(address)
+                if entry is not None and entry[0] > now:
+                    result[address] = entry[1]
+            self.hits += len(result)
+            self.misses += len(addresses) - len(result)
+            missing = [address for address in addresses if address not in result]
+            if missing:
+                generation = self._generation
+                self._fetching += 1
+        unmatched = []
+        if missing:
+            try:
+                fetched, unmatched = self._fetch(missing)
+            except Exception:
+                self._store(generation, None)
+                raise
+            result.update(fetched)
+            # unrecognized scripts cannot be attributed to an address, so such a batch is not cached
+            self._store(generation, None if unmatched else dict(
+                (address, (now + self.ttl, spendables)) for address, spendables in fetched.items()))
+        return [spend for address in addresses for spend in result[address]] + unmatched
+
+    def _store(self, generation, entries):
+        """End a fetch that started at the generation, and cache the entries of addresses that were not
+        invalidated since"""
+        with self._lock:
+            self._fetching -= 1
+            if entries is not None and self._cleared <= generation:
+                for address, entry in entries.items():
+                    if self._invalidated.get(address, 0) <= generation:
+                        self._entries[address] = entry
+            if not self._fetching:
+                self._invalidated = {}
+
+    def spendables_for_address(self, address):
+        return self.spendables_for_addresses([address])
+
+    def used_addresses(self, addresses):
+        if isinstance(self.provider, BatchService):
+            return self.provider.used_addresses(addresses)
+        return None
+
+    def invalidate(self, addresses=None):
+        with self._lock:
+            self._generation += 1
+            if addresses is None:
+                self._entries.clear()
+                self._cleared = self._generation
+            else:
+                for address in addresses:
+                    self._entries.pop(address, None)
+                    if self._fetching:
+                        self._invalidated[address] = self._generation
+
+    def stats(self):
+        """
+        :return: size, hits, misses and hit rate of the cache
+        :rtype: dict
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': float(self.hits) / lookups if lookups else 0.0}
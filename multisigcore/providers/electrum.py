@@ -1,12 +1,15 @@
 from __future__ import print_function
+import itertools
 import json
 import ssl
 import socket
 import threading
+import time
+from multiprocessing.pool import ThreadPool
 from multisigcore.providers import BatchService
 from pycoin.serialize import h2b_rev
 from pycoin.tx import Spendable
-from pycoin.tx.pay_to import ScriptPayToAddress
+from pycoin.tx.TxOut import standard_tx_out_script
 
 __author__ = 'devrandom'
 
@@ -38,8 +41,9 @@ class ElectrumService(BatchService):
 
     @staticmethod
     def decode_spendables(address, results):
+        script = standard_tx_out_script(address)
         spendables = [
-            Spendable(r['value'], ScriptPayToAddress(address), h2b_rev(r['tx_hash']), r['tx_pos'])
+            Spendable(r['value'], script, h2b_rev(r['tx_hash']), r['tx_pos'])
             for r in results['result']
         ]
         return spendables
@@ -56,8 +60,9 @@ class ElectrumService(BatchService):
         spendables = self.decode_spendables(address, res)
         return spendables
 
-    def spendables_for_addresses(self, addresses):
-        payload = [json.dumps({"id": self.current_id + idx, "method": "blockchain.address.listunspent", "params": [address]})
+    def _batch_call(self, method, addresses):
+        """Pipeline one request per address and return the responses, in order"""
+        payload = [json.dumps({"id": self.current_id + idx, "method": method, "params": [address]})
                    for idx, address in enumerate(addresses)]
         self.current_id += len(addresses)
 
@@ -72,12 +77,282 @@ class ElectrumService(BatchService):
 
         thread = MyThread(self.sock)
         thread.start()
-        results = []
-        for address in addresses:
-            results.extend(self.decode_spendables(address, json.loads(self.sock_file.readline())))
+        results = [json.loads(self.sock_file.readline()) for _ in addresses]
         thread.join()
         return results
 
+    def spendables_for_addresses(self, addresses):
+        results = []
+        for address, res in zip(addresses, self._batch_call("blockchain.address.listunspent", addresses)):
+            results.extend(self.decode_spendables(address, res))
+        return results
+
+    def used_addresses(self, addresses):
+        return used_addresses_from_history(addresses, self._batch_call("blockchain.address.get_history", addresses))
+
+
+def used_addresses_from_history(addresses, responses):
+    """
+    :param list[str] addresses: the addresses
+    :param list[dict] responses: the get_history response for each address
+    :return: the addresses with history, or None if the server returned an error, e.g. because it does not
+        support the method - see :meth:`BatchService.used_addresses`
+    :rtype: set[str]
+    """
+    if any(res.get('error') is not None for res in responses):
+        return None
+    return set(address for address, res in zip(addresses, responses) if res['result'])
+
+
+DEFAULT_TIMEOUT = 30
+DEFAULT_KEEPALIVE = 60
+DEFAULT_SHARD_SIZE = 100
+
+
+def default_ssl_context():
+    context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_CLIENT', ssl.PROTOCOL_SSLv23))
+    #  Electrum servers have self-signed certs
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+class ElectrumConnectError(IOError):
+    """A connection to a server could not be established"""
+    pass
+
+
+class ElectrumConnection(object):
+    """
+    A connection to an Electrum server that connects on first use and reconnects after it is dropped.
+    Responses are matched to requests by id.  Thread safe - requests are serialized on the connection.
+    """
+    def __init__(self, host, port, use_ssl=True, timeout=DEFAULT_TIMEOUT, context=None):
+        """
+        :param context: the SSL context, shared by the connections of a pool
+        :type context: ssl.SSLContext
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.last_used = None
+        self._context = (context or default_ssl_context()) if use_ssl else None
+        self._session = None
+        self._sock = None
+        self._sock_file = None
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    @property
+    def connected(self):
+        return self._sock is not None
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+        if self._context is not None:
+            kwargs = {}
+            if self._session is not None:
+                kwargs['session'] = self._session  # resume the TLS session of the previous connection
+            sock = self._context.wrap_socket(sock, server_hostname=self.host, **kwargs)
+            self._session = getattr(sock, 'session', None)
+        self._sock = sock
+        self._sock_file = sock.makefile('rb')
+        self._call_many("server.version", [[]])
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        if self._sock is not None:
+            try:
+                self._sock_file.close()
+                self._sock.close()
+            except (IOError, OSError):
+                pass
+        self._sock = None
+        self._sock_file = None
+
+    def call_many(self, method, params_list):
+        """
+        Pipeline one request for each set of params, connecting first if needed.
+        The connection is closed if it fails, and reopened by the next call.
+
+        :param str method: the method
+        :param list[list] params_list: the params of each request
+        :return: the responses, in request order
+        :raise ElectrumConnectError: if the connection cannot be established
+        :raise IOError: if the connection fails
+        """
+        with self._lock:
+            if self._sock is None:
+                try:
+                    self._connect()
+                except (IOError, OSError, ValueError) as e:
+                    self._close()
+                    raise ElectrumConnectError("cannot connect to %s:%d: %s" % (self.host, self.port, e))
+            try:
+                return self._call_many(method, params_list)
+            except (IOError, OSError, ValueError):
+                self._close()
+                raise
+
+    def _call_many(self, method, params_list):
+        ids = [next(self._ids) for _ in params_list]
+        payload = b''.join(
+            (json.dumps({"id": request_id, "method": method, "params": params}) + "\n").encode('utf8')
+            for request_id, params in zip(ids, params_list))
+        # write from another thread, so that a server that answers before reading everything cannot deadlock us
+        writer = threading.Thread(target=self._sock.sendall, args=(payload,))
+        writer.daemon = True
+        writer.start()
+        pending = set(ids)
+        responses = {}
+        try:
+            while pending:
+                line = self._sock_file.readline()
+                if not line:
+                    raise IOError("connection to %s:%d lost" % (self.host, self.port))
+                response = json.loads(line.decode('utf8'))
+                # skip notifications, and replies to requests of an earlier call that failed
+                if response.get('id') not in pending:
+                    continue
+                pending.discard(response['id'])
+                responses[response['id']] = response
+        finally:
+            writer.join()
+        self.last_used = time.time()
+        return [responses[request_id] for request_id in ids]
+
+    def ping(self):
+        """Send a keepalive, if connected"""
+        with self._lock:
+            if self._sock is None:
+                return
+            try:
+                self._call_many("server.ping", [[]])
+            except (IOError, OSError, ValueError):
+                self._close()
+
+
+class ElectrumPool(BatchService):
+    """
+    A pool of connections to one or more Electrum servers.
+
+    Large batches are split into shards, and each connection takes the next shard when it is done with the
+    previous one, so a slow server handles fewer shards.  A shard whose connection fails is retried on
+    another connection.  A connection that cannot be established takes no further part in the batch, and its
+    shard is left to the others without counting as a retry.  Connections are opened on first use, and idle
+    connections get keepalives.
+    """
+    def __init__(self, servers, connections_per_server=2, use_ssl=True, shard_size=DEFAULT_SHARD_SIZE,
+                 keepalive=DEFAULT_KEEPALIVE, retries=2, timeout=DEFAULT_TIMEOUT):
+        """
+        :param servers: host and port of each server
+        :type servers: list[(str, int)]
+        :param int connections_per_server: number of connections to each server
+        :param int shard_size: number of addresses per request batch
+        :param keepalive: seconds of idle time before a ping, or None for no keepalive
+        :param int retries: number of times a shard is retried after an established connection fails
+        """
+        context = default_ssl_context() if use_ssl else None
+        self.connections = [ElectrumConnection(host, port, use_ssl, timeout, context)
+                            for host, port in servers for _ in range(connections_per_server)]
+        self.shard_size = shard_size
+        self.keepalive = keepalive
+        self.retries = retries
+        self._pool = None
+        self._keepalive_thread = None
+        self._closed = threading.Event()
+        self._start_lock = threading.Lock()
+
+    def _start(self):
+        with self._start_lock:
+            if self._pool is None:
+                self._pool = ThreadPool(len(self.connections))
+                if self.keepalive:
+                    self._keepalive_thread = threading.Thread(target=self._keepalive_loop)
+                    self._keepalive_thread.daemon = True
+                    self._keepalive_thread.start()
+
+    def _keepalive_loop(self):
+        while not self._closed.wait(self.keepalive / 2.0):
+            now = time.time()
+            for connection in self.connections:
+                if connection.connected and now - (connection.last_used or 0) >= self.keepalive:
+                    connection.ping()
+
+    def close(self):
+        self._closed.set()
+        if self._pool is not None:
+            self._pool.terminate()
+        for connection in self.connections:
+            connection.close()
+
+    def _batch_call(self, method, addresses):
+        """One request per address, sharded across the connections.  Returns the responses in address order."""
+        self._start()
+        shards = [addresses[i:i + self.shard_size] for i in range(0, len(addresses), self.shard_size)]
+        queue = [(idx, 0) for idx in range(len(shards))]
+        results = {}
+        errors = []
+        unreachable = []
+        in_flight = [0]
+        condition = threading.Condition()
+
+        def work(connection):
+            while True:
+                with condition:
+                    # a shard in flight on another connection may come back to the queue
+                    while not queue and in_flight[0] and not errors:
+                        condition.wait()
+                    if not queue or errors:
+                        return
+                    idx, attempts = queue.pop(0)
+                    in_flight[0] += 1
+                try:
+                    responses = connection.call_many(method, [[address] for address in shards[idx]])
+                except ElectrumConnectError as e:
+                    with condition:
+                        unreachable.append(e)
+                        queue.append((idx, attempts))
+                        in_flight[0] -= 1
+                        condition.notify_all()
+                    return
+                except (IOError, OSError, ValueError) as e:
+                    with condition:
+                        if attempts < self.retries:
+                            queue.append((idx, attempts + 1))
+                        else:
+                            errors.append(e)
+                        in_flight[0] -= 1
+                        condition.notify_all()
+                    continue
+                with condition:
+                    results[idx] = responses
+                    in_flight[0] -= 1
+                    condition.notify_all()
+
+        self._pool.map(work, self.connections, chunksize=1)
+        if errors or len(results) < len(shards):
+            if errors:
+                raise errors[0]
+            raise unreachable[-1] if unreachable else IOError("no connection available")
+        return [response for idx in range(len(shards)) for response in results[idx]]
+
+    def spendables_for_address(self, address):
+        return self.spendables_for_addresses([address])
+
+    def spendables_for_addresses(self, addresses):
+        results = []
+        for address, res in zip(addresses, self._batch_call("blockchain.address.listunspent", addresses)):
+            results.extend(ElectrumService.decode_spendables(address, res))
+        return results
+
+    def used_addresses(self, addresses):
+        return used_addresses_from_history(addresses, self._batch_call("blockchain.address.get_history", addresses))
+
+
 if __name__ == '__main__':
     s = ElectrumService("electrum.no-ip.org", 50002)
     print(s.spendables_for_address("14ksRqziHHKdvoHSqM63HktrdjVAQembe1"))
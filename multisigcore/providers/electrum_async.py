@@ -0,0 +1,264 @@
+"""
+An asyncio Electrum provider.  Requires Python 3.5 or later.
+
+Requests are pipelined on one connection and responses are matched to requests by JSON-RPC id, so they
+may arrive in any order.  The number of requests in flight is bounded by a window, and any number of
+coroutines - for example for several accounts - can share the connection concurrently.
+
+:class:`AccountSubscription` keeps an account up to date from scripthash notifications.
+"""
+import asyncio
+import hashlib
+import itertools
+import json
+import ssl as ssl_module
+
+from multisigcore.providers import AsyncBatchService
+from multisigcore.providers.electrum import ElectrumService
+from pycoin.serialize import b2h_rev, h2b_rev
+from pycoin.tx import Spendable
+
+__author__ = 'devrandom'
+
+DEFAULT_WINDOW = 100
+
+
+class ElectrumError(IOError):
+    """The server returned an error for a request"""
+    def __init__(self, error):
+        super(ElectrumError, self).__init__(error)
+        self.error = error
+
+
+def scripthash(script):
+    """The Electrum scripthash of an output script - the reversed hex of its sha256"""
+    return b2h_rev(hashlib.sha256(script).digest())
+
+
+def default_ssl_context():
+    context = ssl_module.SSLContext(ssl_module.PROTOCOL_TLS_CLIENT)
+    #  Electrum servers have self-signed certs
+    context.check_hostname = False
+    context.verify_mode = ssl_module.CERT_NONE
+    return context
+
+
+class AsyncElectrumService(AsyncBatchService):
+    def __init__(self, host, port, ssl=True, window=DEFAULT_WINDOW):
+        """
+        :param str host: the server
+        :param int port: the server port
+        :param ssl: True for TLS without certificate verification, False for a plain connection, or an SSLContext
+        :param int window: maximum number of requests in flight
+        """
+        self.host = host
+        self.port = port
+        self.ssl = default_ssl_context() if ssl is True else (ssl or None)
+        self.window = window
+        self.server_version = None
+        self._ids = itertools.count()
+        self._pending = {}
+        self._reader = None
+        self._writer = None
+        self._read_task = None
+        self._connect_lock = None
+        self._slots = None
+        self._subscriptions = {}
+
+    @property
+    def in_flight(self):
+        """The number of requests awaiting a response"""
+        return len(self._pending)
+
+    async def connect(self):
+        """Connect, if not connected yet.  Called implicitly by the first request."""
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+            self._slots = asyncio.Semaphore(self.window)
+        async with self._connect_lock:
+            if self._writer is not None:
+                return
+            self._reader, self._writer = await asyncio.open_connection(
+                self.host, self.port, ssl=self.ssl, server_hostname=self.host if self.ssl else None)
+            self._read_task = asyncio.ensure_future(self._read_loop())
+        self.server_version = await self.call("server.version", [])
+        if self._subscriptions:
+            # subscriptions do not survive the connection - renew them, and report changes missed meanwhile
+            hashes = list(self._subscriptions.keys())
+            statuses = await asyncio.gather(*[self.call("blockchain.scripthash.subscribe", [h]) for h in hashes])
+            for h, status in zip(hashes, statuses):
+                self._subscriptions[h](h, status)
+
+    async def close(self):
+        if self._writer is None:
+            return
+        self._writer.close()
+        self._read_task.cancel()
+        try:
+            await self._read_task
+        except asyncio.CancelledError:
+            pass
+        self._fail_pending(ConnectionError("connection closed"))
+        self._writer = None
+
+    def _fail_pending(self, exception):
+        pending = self._pending
+        self._pending = {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(exception)
+
+    async def _read_loop(self):
+        try:
+            while True:
+                line = await self._reader.readline()
+                if not line:
+                    break
+                response = json.loads(line.decode('utf8'))
+                if response.get('id') is None and response.get('method') == "blockchain.scripthash.subscribe":
+                    callback = self._subscriptions.get(response['params'][0])
+                    if callback is not None:
+                        callback(*response['params'])
+                    continue
+                future = self._pending.pop(response.get('id'), None)
+                if future is None or future.done():
+                    continue  # another notification, or a request that was cancelled
+                if response.get('error') is not None:
+                    future.set_exception(ElectrumError(response['error']))
+                else:
+                    future.set_result(response.get('result'))
+        finally:
+            self._writer = None
+            self._fail_pending(ConnectionError("connection to %s:%d lost" % (self.host, self.port)))
+
+    async def call(self, method, params):
+        """
+        Send a request and wait for its response.  Waits for a free slot if the window is full.
+
+        :return: the result
+        :raise ElectrumError: if the server returns an error
+        """
+        if self._writer is None:
+            await self.connect()
+        async with self._slots:
+            writer = self._writer
+            if writer is None:
+                raise ConnectionError("connection to %s:%d lost" % (self.host, self.port))
+            request_id = next(self._ids)
+            future = asyncio.get_event_loop().create_future()
+            self._pending[request_id] = future
+            try:
+                request = json.dumps({"id": request_id, "method": method, "params": params}) + "\n"
+                writer.write(request.encode('utf8'))
+                await writer.drain()
+                return await future
+            finally:
+                self._pending.pop(request_id, None)
+
+    async def _batch_call(self, method, addresses):
+        """One request per address, pipelined.  Returns the results in address order."""
+        return await asyncio.gather(*[self.call(method, [address]) for address in addresses])
+
+    async def spendables_for_address(self, address):
+        return await self.spendables_for_addresses([address])
+
+    async def spendables_for_addresses(self, addresses):
+        results = []
+        for address, result in zip(addresses, await self._batch_call("blockchain.address.listunspent", addresses)):
+            results.extend(ElectrumService.decode_spendables(address, {'result': result}))
+        return results
+
+    async def used_addresses(self, addresses):
+        results = await self._batch_call("blockchain.address.get_history", addresses)
+        return set(address for address, result in zip(addresses, results) if result)
+
+    async def subscribe_scripthash(self, scripthash, callback):
+        """
+        Subscribe to status changes of an output script
+
+        :param str scripthash: see :func:`scripthash`
+        :param callback: called with the scripthash and the new status on each change, and after reconnecting
+        :return: the current status, or None if the script has no history
+        """
+        if self._writer is None:
+            await self.connect()  # so that the callback is not called when renewing subscriptions
+        self._subscriptions[scripthash] = callback
+        return await self.call("blockchain.scripthash.subscribe", [scripthash])
+
+    async def spendables_for_script(self, script):
+        """
+        :param bytes script: an output script
+        :rtype: list[pycoin.tx.Spendable.Spendable]
+        """
+        results = await self.call("blockchain.scripthash.listunspent", [scripthash(script)])
+        return [Spendable(r['value'], script, h2b_rev(r['tx_hash']), r['tx_pos']) for r in results]
+
+
+class AccountSubscription(object):
+    """
+    Track the scripts of an account, including the lookahead, through scripthash subscriptions.
+
+    When the status of a script changes, only that script is re-fetched.  Its spendables go to the account's
+    UTXO store, if it has one, and the receive and change addresses are rotated if they have history - even if
+    the coins were spent again before the script was re-fetched.
+    Scripts that enter the lookahead window are subscribed as well.
+    """
+    def __init__(self, account, service, on_change=None):
+        """
+        :type account: multisigcore.hierarchy.Account
+        :type service: AsyncElectrumService
+        :param on_change: called with the path and its spendables after a script was re-fetched
+        """
+        self.account = account
+        self.service = service
+        self.on_change = on_change
+        self._scripts = {}
+        self._statuses = {}
+        self._refreshes = set()
+
+    @property
+    def paths(self):
+        """The subscribed paths
+        :rtype: list[str]"""
+        return [path for path, _ in self._scripts.values()]
+
+    async def start(self):
+        """Subscribe to all scripts.  The statuses found are the baseline for later changes."""
+        await self._subscribe_new()
+
+    async def _subscribe_new(self):
+        subscribed = set(self.paths)
+        new = [path for path in self.account._ensure_address_map().values() if path not in subscribed]
+        hashes = []
+        for path in new:
+            script = self.account.script_pubkey_for_path(path)
+            h = scripthash(script)
+            self._scripts[h] = (path, script)
+            hashes.append(h)
+        statuses = await asyncio.gather(*[self.service.subscribe_scripthash(h, self._notified) for h in hashes])
+        for h, status in zip(hashes, statuses):
+            self._statuses.setdefault(h, status)
+
+    def _notified(self, h, status):
+        if h not in self._scripts or self._statuses.get(h) == status:
+            return
+        self._statuses[h] = status
+        task = asyncio.ensure_future(self._refresh(h, status))
+        self._refreshes.add(task)
+        task.add_done_callback(self._refreshes.discard)
+
+    async def _refresh(self, h, status):
+        path, script = self._scripts[h]
+        spendables = await self.service.spendables_for_script(script)
+        if self.account.utxo_store is not None:
+            self.account.utxo_store.update([(spend, path) for spend in spendables], [path])
+        # the status is None only for scripts without history
+        if status is not None and self.account.rotate_addresses_for_scripts([script]):
+            await self._subscribe_new()
+        if self.on_change is not None:
+            self.on_change(path, spendables)
+
+    async def wait(self):
+        """Wait for the refreshes that are in progress"""
+        while self._refreshes:
+            await asyncio.gather(*list(self._refreshes))
@@ -0,0 +1,219 @@
+import collections
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from . import BatchService
+
+__author__ = 'devrandom'
+
+DEFAULT_HEDGE_DELAY = 1.0
+DEFAULT_TIMEOUT = 60
+DEFAULT_STATS_WINDOW = 100
+
+
+class ProviderStats(object):
+    """Latency and error statistics of one provider, and its circuit breaker state"""
+    def __init__(self, window=DEFAULT_STATS_WINDOW):
+        """
+        :param int window: number of recent latencies kept
+        """
+        self.latencies = collections.deque(maxlen=window)
+        self.successes = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.open_until = None
+
+    def percentile(self, p):
+        """
+        :param float p: between 0 and 1
+        :return: the latency percentile in seconds, or None if there were no successful requests
+        """
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(int(p * len(ordered)), len(ordered) - 1)]
+
+    def as_dict(self):
+        return {'successes': self.successes, 'errors': self.errors, 'p50': self.percentile(0.5),
+                'p95': self.percentile(0.95), 'open': self.open_until is not None}
+
+
+class HedgedService(BatchService):
+    """
+    Query several providers for the same addresses, and return the first answer that enough of them agree on.
+
+    When hedging, providers are tried in order of their median latency, and the next one is started if there is
+    no answer within the hedge percentile of the previous one's latency, or as soon as it fails.  When racing,
+    all providers are started at once.
+
+    A provider that fails failure_threshold times in a row is skipped for reset_timeout seconds (the circuit
+    is open), and then gets a trial request.  If all circuits are open, all providers are tried.
+    """
+    def __init__(self, providers, race=False, quorum=1, hedge_percentile=0.95, default_hedge_delay=DEFAULT_HEDGE_DELAY,
+                 failure_threshold=3, reset_timeout=30.0, timeout=DEFAULT_TIMEOUT):
+        """
+        :param providers: BatchService instances, or providers with spendables_for_address
+        :param bool race: whether to start all providers at once
+        :param int quorum: number of providers that must return the same answer
+        :param float hedge_percentile: latency percentile of a provider after which the next one is started
+        :param float default_hedge_delay: hedge delay for a provider without latency statistics
+        :param int failure_threshold: consecutive failures that open the circuit of a provider
+        :param float reset_timeout: seconds before a provider with an open circuit is tried again
+        :param float timeout: seconds before giving up on all providers
+        """
+        self.providers = list(providers)
+        self.race = race
+        self.quorum = quorum
+        self.hedge_percentile = hedge_percentile
+        self.default_hedge_delay = default_hedge_delay
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.timeout = timeout
+        self._stats = [ProviderStats() for _ in self.providers]
+        self._lock = threading.Lock()
+
+    def stats(self):
+        """
+        :return: the statistics of each provider
+        :rtype: list[dict]
+        """
+        with self._lock:
+            return [stats.as_dict() for stats in self._stats]
+
+    def _order(self):
+        """The providers to try, fastest and healthiest first"""
+        now = time.time()
+        with self._lock:
+            def key(idx):
+                stats = self._stats[idx]
+                median = stats.percentile(0.5)
+                return stats.consecutive_errors > 0, self.default_hedge_delay if median is None else median
+            closed = [idx for idx, stats in enumerate(self._stats)
+                      if stats.open_until is None or stats.open_until <= now]
+            return sorted(closed or range(len(self.providers)), key=key)
+
+    def _hedge_delay(self, idx):
+        with self._lock:
+            delay = self._stats[idx].percentile(self.hedge_percentile)
+        return self.default_hedge_delay if delay is None else delay
+
+    def _record(self, idx, elapsed, failed):
+        with self._lock:
+            stats = self._stats[idx]
+            if failed:
+                stats.errors += 1
+                stats.consecutive_errors += 1
+                if stats.consecutive_errors >= self.failure_threshold:
+                    stats.open_until = time.time() + self.reset_timeout
+            else:
+                stats.successes += 1
+                stats.consecutive_errors = 0
+                stats.open_until = None
+                stats.latencies.append(elapsed)
+
+    def _query(self, call, key):
+        """
+        :param call: queries one provider, returns an answer or None if the provider cannot answer
+        :param key: maps an answer to a hashable value, for comparing answers
+        :return: the agreed answer, or None if no provider could answer
+        """
+        order = self._order()
+        results = queue.Queue()
+        started = []
+
+        def run(idx):
+            start = time.time()
+            try:
+                answer = call(self.providers[idx])
+            except Exception as e:
+                self._record(idx, time.time() - start, True)
+                results.put((e, None))
+                return
+            self._record(idx, time.time() - start, False)
+            results.put((None, answer))
+
+        def start_next():
+            idx = order[len(started)]
+            started.append(idx)
+            thread = threading.Thread(target=run, args=(idx,))
+            thread.daemon = True  # a stalled provider cannot be interrupted
+            thread.start()
+
+        for _ in range(len(order) if self.race else min(self.quorum, len(order))):
+            start_next()
+        deadline = time.time() + self.timeout
+        votes = collections.defaultdict(int)
+        finished = 0
+        error = None
+        while finished < len(started):
+            wait = deadline - time.time()
+            if len(started) < len(order):
+                wait = min(wait, self._hedge_delay(started[-1]))
+            try:
+                failure, answer = results.get(timeout=max(wait, 0))
+            except queue.Empty:
+                if time.time() >= deadline:
+                    break
+                start_next()  # hedge
+                continue
+            finished += 1
+            if failure is not None or answer is None:
+                error = failure or error
+                if len(started) < len(order):
+                    start_next()
+                continue
+            answer_key = key(answer)
+            votes[answer_key] += 1
+            if votes[answer_key] >= self.quorum:
+                return answer
+            # start enough providers for the quorum to still be reachable
+            if len(started) - finished < self.quorum - votes[answer_key] and len(started) < len(order):
+                start_next()
+        if votes:
+            raise IOError("providers did not agree")
+        if error is not None:
+            raise error
+        if finished < len(started):
+            raise IOError("no answer from providers within %s seconds" % (self.timeout,))
+        return None
+
+    def spendables_for_addresses(self, addresses):
+        def call(provider):
+            if isinstance(provider, BatchService):
+                return provider.spendables_for_addresses(addresses)
+            spendables = []
+            for address in addresses:
+                spendables.extend(provider.spendables_for_address(address) or [])
+            return spendables
+
+        def key(spendables):
+            return frozenset((bytes(s.tx_hash), s.tx_out_index, s.coin_value) for s in spendables)
+
+        spendables = self._query(call, key)
+        if spendables is None:
+            raise IOError("no provider returned spendables")
+        return spendables
+
+    def spendables_for_address(self, address):
+        return self.spendables_for_addresses([address])
+
+    def used_addresses(self, addresses):
+        def call(provider):
+            if isinstance(provider, BatchService):
+                return provider.used_addresses(addresses)
+            return None
+
+        return self._query(call, frozenset)
+
+    @property
+    def invalidates(self):
+        return any(getattr(provider, 'invalidates', False) for provider in self.providers)
+
+    def invalidate(self, addresses=None):
+        for provider in self.providers:
+            if isinstance(provider, BatchService):
+                provider.invalidate(addresses)
@@ -1,5 +1,13 @@
-import json
-from urllib2 import urlopen
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+from multiprocessing.pool import ThreadPool
+
+import requests
+from requests.adapters import HTTPAdapter
 from pycoin.convention import btc_to_satoshi
 from pycoin.serialize import h2b, h2b_rev
 from pycoin.services.insight import InsightService
@@ -9,27 +17,146 @@ from . import BatchService
 __author__ = 'devrandom'
 
 CHUNK_SIZE = 100
+MAX_CHUNK_SIZE = 1000
+MAX_URL_LENGTH = 2000
+DEFAULT_THREADS = 4
+DEFAULT_TIMEOUT = 30
+TARGET_LATENCY = 2.0
+"""Chunks grow while requests take less than half of this, and shrink when requests take longer"""
+
+
+def decode_spendables(utxos):
+    """
+    :param list[dict] utxos: the JSON decoded response of the utxo API call
+    :rtype: list[pycoin.tx.Spendable.Spendable]
+    """
+    spendables = []
+    for u in utxos:
+        coin_value = btc_to_satoshi(str(u.get("amount")))
+        script = h2b(u.get("scriptPubKey"))
+        previous_hash = h2b_rev(u.get("txid"))
+        previous_index = u.get("vout")
+        spendables.append(Spendable(coin_value, script, previous_hash, previous_index))
+    return spendables
 
 
 class InsightBatchService(InsightService, BatchService):
-    def __init__(self, base_url):
+    """
+    Chunks of addresses are fetched concurrently on a thread pool, over a pool of keep-alive connections.
+    Chunks are limited by URL length, and their size adapts to the server latency.
+    """
+    def __init__(self, base_url, threads=DEFAULT_THREADS, max_url_length=MAX_URL_LENGTH,
+                 target_latency=TARGET_LATENCY, timeout=DEFAULT_TIMEOUT, session=None):
+        """
+        :param int threads: number of concurrent requests
+        :param int max_url_length: chunks are limited so that the request URL is at most this long
+        :param float target_latency: seconds - see TARGET_LATENCY
+        :param session: the HTTP session, by default a new one with a connection pool for the threads
+        :type session: requests.Session
+        """
         InsightService.__init__(self, base_url)
+        self.threads = threads
+        self.max_url_length = max_url_length
+        self.target_latency = target_latency
+        self.timeout = timeout
+        self.chunk_size = CHUNK_SIZE
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=threads)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _url(self, addresses):
+        return "%s/api/addrs/%s/utxo" % (self.base_url, ",".join(addresses))
+
+    def _chunks(self, addresses):
+        """Generate chunks of the current chunk size, limited by URL length.  Not thread safe."""
+        start = 0
+        while start < len(addresses):
+            length = len(self._url([]))
+            end = start
+            while end < len(addresses) and end - start < self.chunk_size:
+                length += len(addresses[end]) + (1 if end > start else 0)
+                if length > self.max_url_length and end > start:
+                    break
+                end += 1
+            yield addresses[start:end]
+            start = end
+
+    def _adapt(self, elapsed):
+        """Adjust the chunk size after a request that took elapsed seconds"""
+        if elapsed < self.target_latency / 2:
+            self.chunk_size = min(self.chunk_size * 2, MAX_CHUNK_SIZE)
+        elif elapsed > self.target_latency:
+            self.chunk_size = max(self.chunk_size // 2, 1)
+
+    def _fetch(self, addresses):
+        start = time.time()
+        response = self.session.get(self._url(addresses), timeout=self.timeout)
+        response.raise_for_status()
+        spendables = decode_spendables(response.json())
+        with self._lock:
+            self._adapt(time.time() - start)
+        return spendables
+
+    def iter_spendables_for_addresses(self, bitcoin_addresses):
+        """
+        Stream Spendable objects for the given bitcoin addresses, decoded as each chunk arrives.
+        Chunks are yielded in completion order.
+
+        :rtype: collections.Iterable[pycoin.tx.Spendable.Spendable]
+        """
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.threads)
+        results = queue.Queue()
+        lock = threading.Lock()
+        chunks = self._chunks(bitcoin_addresses)
+        failed = []
+        stopped = []
+
+        def work(_):
+            # chunks are cut when a thread is ready for one, so they follow the latest chunk size
+            try:
+                while not failed and not stopped:
+                    with lock:
+                        chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+                    results.put(self._fetch(chunk))
+            except Exception as e:
+                failed.append(e)
+            finally:
+                results.put(None)
+
+        self._pool.map_async(work, range(self.threads))
+        finished = 0
+        try:
+            while finished < self.threads:
+                spendables = results.get()
+                if spendables is None:
+                    finished += 1
+                    continue
+                for spendable in spendables:
+                    yield spendable
+        finally:
+            # if the consumer abandons us, workers stop after their current chunk
+            stopped.append(True)
+        if failed:
+            raise failed[0]
 
     def spendables_for_addresses(self, bitcoin_addresses):
         """
         Return a list of Spendable objects for the
         given bitcoin address.
         """
-        r = []
-        for i in xrange(0, len(bitcoin_addresses), CHUNK_SIZE):
-            addresses = bitcoin_addresses[i:i+CHUNK_SIZE]
-            url = "%s/api/addrs/%s/utxo" % (self.base_url, ",".join(addresses))
-            r.extend(json.loads(urlopen(url).read().decode("utf8")))
-        spendables = []
-        for u in r:
-            coin_value = btc_to_satoshi(str(u.get("amount")))
-            script = h2b(u.get("scriptPubKey"))
-            previous_hash = h2b_rev(u.get("txid"))
-            previous_index = u.get("vout")
-            spendables.append(Spendable(coin_value, script, previous_hash, previous_index))
-        return spendables
\ No newline at end of file
+        return list(self.iter_spendables_for_addresses(bitcoin_addresses))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+        self.session.close()
@@ -0,0 +1,171 @@
+"""
+Bitcoin scripts as bytes - parsing and rewriting push data, and recognizing standard output scripts by template.
+
+Unlike :mod:`pycoin.tx.script.tools`, scripts are not disassembled to text, and recognizing a script type
+does not raise for scripts of other types.  Functions take bytes, bytearrays or memoryviews.
+"""
+import struct
+
+__author__ = 'devrandom'
+
+OP_0 = 0x00
+OP_PUSHDATA1 = 0x4c
+OP_PUSHDATA2 = 0x4d
+OP_PUSHDATA4 = 0x4e
+OP_1 = 0x51
+OP_16 = 0x60
+OP_DUP = 0x76
+OP_EQUAL = 0x87
+OP_EQUALVERIFY = 0x88
+OP_HASH160 = 0xa9
+OP_CHECKSIG = 0xac
+OP_CHECKMULTISIG = 0xae
+
+P2SH = 'p2sh'
+P2PKH = 'p2pkh'
+MULTISIG = 'multisig'
+
+
+def _bytes(data):
+    """bytes(data), except that on Python 2 that returns the repr of a memoryview"""
+    return data.tobytes() if isinstance(data, memoryview) else bytes(data)
+
+
+def iter_ops(script):
+    """
+    Iterate over the operations of a script
+
+    :param script: the script
+    :return: for each operation the opcode, the pushed data or None, and the end offset of the operation.
+        Stops early at a truncated push, so that the last end offset is short of the script length.
+    :rtype: collections.Iterator[(int, memoryview or None, int)]
+    """
+    view = memoryview(script)
+    end = len(view)
+    offset = 0
+    while offset < end:
+        opcode = view[offset]
+        if not isinstance(opcode, int):  # python 2 memoryviews index to bytes
+            opcode = ord(opcode)
+        offset += 1
+        if opcode > OP_PUSHDATA4:
+            yield opcode, None, offset
+            continue
+        if opcode < OP_PUSHDATA1:
+            size = opcode
+        else:
+            width = {OP_PUSHDATA1: 1, OP_PUSHDATA2: 2, OP_PUSHDATA4: 4}[opcode]
+            if offset + width > end:
+                return
+            size = struct.unpack("<" + {1: "B", 2: "H", 4: "L"}[width], view[offset:offset + width].tobytes())[0]
+            offset += width
+        if offset + size > end:
+            return
+        yield opcode, view[offset:offset + size], offset + size
+        offset += size
+
+
+def pushes(script):
+    """
+    :return: the data pushed by the script, or None if the script contains other operations or is truncated
+    :rtype: list[memoryview]
+    """
+    result = []
+    end = 0
+    for opcode, data, end in iter_ops(script):
+        if data is None:
+            return None
+        result.append(data)
+    return result if end == len(script) else None
+
+
+def push(data):
+    """:return: the operation that pushes data, with the shortest encoding"""
+    data = _bytes(data)
+    size = len(data)
+    if size < OP_PUSHDATA1:
+        return struct.pack("B", size) + data
+    if size <= 0xff:
+        return struct.pack("<BB", OP_PUSHDATA1, size) + data
+    if size <= 0xffff:
+        return struct.pack("<BH", OP_PUSHDATA2, size) + data
+    return struct.pack("<BL", OP_PUSHDATA4, size) + data
+
+
+def replace_pushes(script, old, new):
+    """
+    Replace each push of some data by other operations.  Other operations are copied as they are encoded.
+
+    :param bytes old: the pushed data to replace
+    :param bytes new: the encoded replacement, e.g. a push or OP_0
+    :return: the rewritten script, or the script itself if nothing was replaced
+    """
+    parts = []
+    start = 0
+    op_start = 0
+    view = memoryview(script)
+    for opcode, data, end in iter_ops(view):
+        if data is not None and data == old:
+            parts.append(view[start:op_start].tobytes())
+            parts.append(new)
+            start = end
+        op_start = end
+    if not parts:
+        return script
+    parts.append(view[start:].tobytes())
+    return b''.join(parts)
+
+
+def p2sh_hash160(script):
+    """:return: the script hash of a pay to script hash output script, or None for other scripts
+    :rtype: bytes"""
+    if len(script) == 23 and script[0:2] == b'\xa9\x14' and script[22:23] == b'\x87':
+        return _bytes(script[2:22])
+    return None
+
+
+def p2pkh_hash160(script):
+    """:return: the public key hash of a pay to public key hash output script, or None for other scripts
+    :rtype: bytes"""
+    if len(script) == 25 and script[0:3] == b'\x76\xa9\x14' and script[23:25] == b'\x88\xac':
+        return _bytes(script[3:23])
+    return None
+
+
+def output_hash160(script):
+    """:return: the hash160 paid to by a pay to script hash or pay to public key hash output script, or None for
+        other scripts
+    :rtype: bytes"""
+    hash160 = p2sh_hash160(script)
+    if hash160 is None:
+        hash160 = p2pkh_hash160(script)
+    return hash160
+
+
+def multisig_info(script):
+    """
+    :return: the number of required signatures and the public keys of a bare multisig script, or None for other
+        scripts
+    :rtype: (int, list[bytes])
+    """
+    ops = list(iter_ops(script))
+    if len(ops) < 4 or ops[-1][2] != len(script):
+        return None
+    (m, _, _), (n, _, _), (last, _, _) = ops[0], ops[-2], ops[-1]
+    keys = ops[1:-2]
+    if last != OP_CHECKMULTISIG or not (OP_1 <= m <= n <= OP_16) or n - OP_1 + 1 != len(keys):
+        return None
+    if any(data is None or len(data) not in (33, 65) for _, data, _ in keys):
+        return None
+    return m - OP_1 + 1, [data.tobytes() for _, data, _ in keys]
+
+
+def script_type(script):
+    """:return: P2SH, P2PKH or MULTISIG, or None for other scripts"""
+    if p2sh_hash160(script) is not None:
+        return P2SH
+    if p2pkh_hash160(script) is not None:
+        return P2PKH
+    if multisig_info(script) is not None:
+        return MULTISIG
+    return None
@@ -2,6 +2,7 @@
 
 from __future__ import print_function
 import io
+import json
 import sys
 import argparse
 import textwrap
@@ -42,6 +43,14 @@ def main():
                         help='an additional hex string to disambiguate spends to the same address')
     parser.add_argument('-u', "--baseurl",
                         help='the API endpoint, defaults to the sandbox - https://s.digitaloracle.co/')
+    parser.add_argument("--start", type=int, default=0,
+                        help='first leaf index for export-addresses')
+    parser.add_argument("--count", type=int, default=1000,
+                        help='number of leaves for export-addresses')
+    parser.add_argument("--format", default='csv', choices=['csv', 'jsonl'],
+                        help='output format for export-addresses')
+    parser.add_argument("--processes", type=int,
+                        help='number of worker processes for export-addresses, defaults to the number of CPUs')
     parser.add_argument('-v', "--verbose", default=0, action="count",
                         help="Verbosity, use more -v flags for more verbosity")
     parser.add_argument('command',
@@ -60,6 +69,8 @@ def main():
      * create - create Oracle account based on the supplied leading key with with any additional keys
      * address - get the deposit address for a subkey path
      * sign - sign a transaction, tx.bin or tx.hex must be supplied. Only one subkey path is supported.
+     * export-addresses - stream addresses below a subkey path (default 0) as CSV or JSON lines,
+       see --start, --count, --format and --processes
 
     Notes:
      * --subkey is applicable for the address and sign actions, but not the create action
@@ -151,6 +162,18 @@ def main():
             if 'transaction' in result:
                 print("Hex serialized transaction:")
                 print(b2h(stream_to_bytes(result['transaction'].stream)))
+    elif args.command == 'export-addresses':
+        oracle.get()
+        prefix = args.inputpath[0] if args.inputpath else "0"
+        leaves = account.leaves_for_prefix(prefix, args.start, args.start + args.count, processes=args.processes)
+        if args.format == 'csv':
+            print("path,address,hash160,redeem_script")
+        for leaf in leaves:
+            if args.format == 'csv':
+                print("%s,%s,%s,%s" % (leaf.path, leaf.address, b2h(leaf.hash160), b2h(leaf.script)))
+            else:
+                print(json.dumps({'path': leaf.path, 'address': leaf.address,
+                                  'hash160': b2h(leaf.hash160), 'redeemScript': b2h(leaf.script)}))
     else:
         print('unknown command %s' % (args.command,), file=sys.stderr)
 
@@ -0,0 +1,156 @@
+"""
+Batched secp256k1 arithmetic for public key derivation.
+
+Multiples of the generator are computed from a precomputed fixed-base window table, so
+k*G costs one mixed point addition per 8 bit window and no doublings.  Points are kept in
+Jacobian coordinates and normalized together with a single modular inversion
+(Montgomery's trick) before they are encoded.
+"""
+import threading
+
+from pycoin import ecdsa
+
+__author__ = 'devrandom'
+
+P = ecdsa.generator_secp256k1.curve().p()
+ORDER = ecdsa.generator_secp256k1.order()
+G = (ecdsa.generator_secp256k1.x(), ecdsa.generator_secp256k1.y())
+
+WINDOW_BITS = 8
+WINDOWS = (256 + WINDOW_BITS - 1) // WINDOW_BITS
+WINDOW_MASK = (1 << WINDOW_BITS) - 1
+
+INFINITY = (1, 1, 0)
+"""The point at infinity in Jacobian coordinates (any point with Z == 0)"""
+
+_table = None
+_table_lock = threading.Lock()
+
+
+def inverse(a):
+    return pow(a, P - 2, P)
+
+
+def jacobian_double(p1):
+    X1, Y1, Z1 = p1
+    if Z1 == 0 or Y1 == 0:
+        return INFINITY
+    YY = Y1 * Y1 % P
+    S = 4 * X1 * YY % P
+    M = 3 * X1 * X1 % P
+    X3 = (M * M - 2 * S) % P
+    Y3 = (M * (S - X3) - 8 * YY * YY) % P
+    Z3 = 2 * Y1 * Z1 % P
+    return X3, Y3, Z3
+
+
+def jacobian_add_affine(p1, p2):
+    """
+    Add an affine point to a Jacobian point
+
+    :param p1: (X, Y, Z) Jacobian point
+    :param p2: (x, y) affine point, not infinity
+    :return: Jacobian point
+    """
+    X1, Y1, Z1 = p1
+    x2, y2 = p2
+    if Z1 == 0:
+        return x2, y2, 1
+    Z1Z1 = Z1 * Z1 % P
+    U2 = x2 * Z1Z1 % P
+    S2 = y2 * Z1 * Z1Z1 % P
+    H = (U2 - X1) % P
+    R = (S2 - Y1) % P
+    if H == 0:
+        if R == 0:
+            return jacobian_double(p1)
+        return INFINITY
+    HH = H * H % P
+    HHH = H * HH % P
+    V = X1 * HH % P
+    X3 = (R * R - HHH - 2 * V) % P
+    Y3 = (R * (V - X3) - Y1 * HHH) % P
+    Z3 = Z1 * H % P
+    return X3, Y3, Z3
+
+
+def batch_to_affine(points):
+    """
+    Normalize Jacobian points with a single modular inversion
+
+    :param list points: Jacobian points
+    :return: list of affine (x, y) pairs, or None for the point at infinity
+    """
+    prefix = []
+    acc = 1
+    for X, Y, Z in points:
+        prefix.append(acc)
+        if Z:
+            acc = acc * Z % P
+    acc_inv = inverse(acc)
+    result = [None] * len(points)
+    for idx in range(len(points) - 1, -1, -1):
+        X, Y, Z = points[idx]
+        if not Z:
+            continue
+        z_inv = acc_inv * prefix[idx] % P
+        acc_inv = acc_inv * Z % P
+        z_inv2 = z_inv * z_inv % P
+        result[idx] = (X * z_inv2 % P, Y * z_inv2 * z_inv % P)
+    return result
+
+
+def _build_table():
+    """table[w][d-1] = d * 2^(WINDOW_BITS*w) * G, in affine coordinates"""
+    points = []
+    base = (G[0], G[1], 1)
+    for w in range(WINDOWS):
+        base_affine = batch_to_affine([base])[0]
+        acc = base
+        points.append(acc)
+        for d in range(2, WINDOW_MASK + 1):
+            acc = jacobian_add_affine(acc, base_affine)
+            points.append(acc)
+        base = acc
+        base = jacobian_add_affine(base, base_affine)  # 2^WINDOW_BITS * previous base
+    affine = batch_to_affine(points)
+    return [affine[w * WINDOW_MASK:(w + 1) * WINDOW_MASK] for w in range(WINDOWS)]
+
+
+def generator_table():
+    """The fixed-base table, built on first use"""
+    global _table
+    if _table is None:
+        with _table_lock:
+            if _table is None:
+                _table = _build_table()
+    return _table
+
+
+def base_multiply(k):
+    """
+    k*G in Jacobian coordinates
+
+    :param int k: scalar, 0 <= k < ORDER
+    """
+    table = generator_table()
+    result = INFINITY
+    w = 0
+    while k:
+        d = k & WINDOW_MASK
+        if d:
+            result = jacobian_add_affine(result, table[w][d - 1])
+        k >>= WINDOW_BITS
+        w += 1
+    return result
+
+
+def batch_tweak_add(scalars, pair):
+    """
+    Compute scalar*G + pair for each scalar, as affine points
+
+    :param list[int] scalars: the tweaks, each 0 <= scalar < ORDER
+    :param pair: the affine point added to each multiple of G
+    :return: list of affine points, None where the sum is the point at infinity
+    """
+    return batch_to_affine([jacobian_add_affine(base_multiply(k), pair) for k in scalars])
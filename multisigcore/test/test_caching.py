@@ -0,0 +1,72 @@
+from unittest import TestCase
+
+from multisigcore.hierarchy import MasterKey, SimpleAccount
+from multisigcore.providers.caching import CachingService
+from pycoin.serialize import h2b
+from pycoin.tx import Spendable
+from pycoin.tx.TxOut import standard_tx_out_script
+
+__author__ = 'devrandom'
+
+
+class CountingProvider(object):
+    def __init__(self, funded):
+        self.funded = funded
+        self.queries = []
+
+    def spendables_for_address(self, address):
+        self.queries.append(address)
+        if address in self.funded:
+            return [Spendable(coin_value=10000, script=standard_tx_out_script(address), tx_out_index=0,
+                              tx_hash=b'2'*32)]
+        return []
+
+
+class CachingServiceTest(TestCase):
+    def setUp(self):
+        master_key = MasterKey.from_seed(h2b("000102030405060708090a0b0c0d0e0f"))
+        self.account = SimpleAccount(master_key.account_for_path("0H/1/2H"))
+        self.account.set_lookahead(2)
+        self.funded = self.account.address(0)
+        self.provider = CountingProvider([self.funded])
+        self.now = 1000
+        self.service = CachingService(self.provider, ttl=30, clock=lambda: self.now)
+        self.account._provider = self.service
+
+    def test_ttl(self):
+        self.assertEqual(10000, self.account.balance())
+        self.assertEqual(6, len(self.provider.queries))
+        self.assertEqual(10000, self.account.balance())
+        self.assertEqual(6, len(self.provider.queries))
+        self.assertEqual({'size': 6, 'hits': 6, 'misses': 6, 'hit_rate': 0.5}, self.service.stats())
+        self.now += 31
+        self.assertEqual(10000, self.account.balance())
+        self.assertEqual(12, len(self.provider.queries))
+
+    def test_invalidation(self):
+        self.account.balance()
+        del self.provider.queries[:]
+        self.account.tx([("3FfiLhj1yXkXRFRRb9CMsMXBNZXQEv23Pi", 2000)])
+        # only the spent and change addresses are queried again
+        self.account.balance()
+        self.assertEqual(sorted([self.funded, self.account.current_change_address()]), sorted(self.provider.queries))
+
+        del self.provider.queries[:]
+        self.service.invalidate()
+        self.account.balance()
+        self.assertEqual(6, len(self.provider.queries))
+
+    def test_invalidated_during_fetch(self):
+        service = self.service
+
+        class InvalidatingProvider(CountingProvider):
+            def spendables_for_address(self, address):
+                # the account spends from the address while the fetch is in flight
+                service.invalidate([address])
+                return super(InvalidatingProvider, self).spendables_for_address(address)
+        service.provider = InvalidatingProvider([self.funded])
+        self.assertEqual(1, len(service.spendables_for_address(self.funded)))
+        self.assertEqual(0, service.stats()['size'])
+        service.provider = self.provider
+        service.spendables_for_address(self.funded)
+        self.assertEqual(1, service.stats()['size'])
@@ -0,0 +1,79 @@
+import random
+from unittest import TestCase
+
+from multisigcore.coinselect import UTXOPool, FeeModel, BranchAndBound, LargestFirst, SmallestFirst, \
+    RandomImprove, DUST, p2sh_multisig_input_size, p2pkh_input_size
+from pycoin.tx import Spendable
+
+__author__ = 'devrandom'
+
+
+def make_pool(values):
+    return UTXOPool([Spendable(value, b'', bytes(bytearray([n % 256] * 32)), n) for n, value in enumerate(values)])
+
+
+class CoinSelectTest(TestCase):
+    def setUp(self):
+        # 10 byte base, 100 byte inputs, 30 byte change output, 1 sat/byte
+        self.fee_model = FeeModel(10, 100, 30, 1)
+
+    def check(self, selection, target):
+        total = sum(s.coin_value for s in selection.spendables)
+        self.assertEqual(total, target + selection.fee + selection.change)
+        self.assertGreaterEqual(selection.fee, self.fee_model.fee(len(selection.spendables), bool(selection.change)))
+        self.assertTrue(selection.change == 0 or selection.change > DUST)
+
+    def test_fee_model(self):
+        self.assertEqual(10 + 1 + 200, self.fee_model.size(2, False))
+        self.assertEqual(10 + 1 + 200 + 30, self.fee_model.size(2, True))
+        self.assertEqual(1000, FeeModel(10, 100, 30).fee(2, True))
+        self.assertEqual(2000, FeeModel(10, 100, 30).fee(10, True))
+        self.assertEqual(317, FeeModel(10, 100, 30, 1.5).fee(2, False))
+
+    def test_input_sizes(self):
+        self.assertEqual(148, p2pkh_input_size())
+        self.assertEqual(297, p2sh_multisig_input_size(2, 3))
+        # the 15 key redeem script needs OP_PUSHDATA2
+        self.assertEqual(32 + 4 + 3 + 1 + 15 * 73 + 3 + 513 + 4, p2sh_multisig_input_size(15, 15))
+
+    def test_largest_first(self):
+        pool = make_pool([1000, 50000, 20000, 30000])
+        selection = LargestFirst().select(pool, 40000, self.fee_model)
+        self.check(selection, 40000)
+        self.assertEqual([50000], [s.coin_value for s in selection.spendables])
+        selection = LargestFirst().select(pool, 70000, self.fee_model)
+        self.check(selection, 70000)
+        self.assertEqual([50000, 30000], [s.coin_value for s in selection.spendables])
+        self.assertIsNone(LargestFirst().select(pool, 101000, self.fee_model))
+
+    def test_smallest_first(self):
+        pool = make_pool([1000, 50000, 20000, 30000])
+        selection = SmallestFirst().select(pool, 40000, self.fee_model)
+        self.check(selection, 40000)
+        self.assertEqual([1000, 20000, 30000], [s.coin_value for s in selection.spendables])
+
+    def test_branch_and_bound_exact(self):
+        # 20000 + 7000 pays 26000 plus the fee for two inputs with no change
+        fee = self.fee_model.fee(2, False)
+        pool = make_pool([100000, 20000, 5000, 7000, 3000])
+        selection = BranchAndBound().select(pool, 27000 - fee, self.fee_model)
+        self.check(selection, 27000 - fee)
+        self.assertEqual([20000, 7000], [s.coin_value for s in selection.spendables])
+        self.assertEqual(0, selection.change)
+        self.assertEqual(fee, selection.fee)
+
+    def test_branch_and_bound_fallback(self):
+        pool = make_pool([100000, 20000])
+        selection = BranchAndBound().select(pool, 50000, self.fee_model)
+        self.check(selection, 50000)
+        self.assertEqual([100000], [s.coin_value for s in selection.spendables])
+        self.assertIsNone(BranchAndBound().select(pool, 200000, self.fee_model))
+
+    def test_random_improve(self):
+        rng = random.Random(1)
+        pool = make_pool([rng.randint(1000, 100000) for _ in range(200)])
+        selector = RandomImprove(random.Random(2))
+        for target in [5000, 50000, 500000]:
+            selection = selector.select(pool, target, self.fee_model)
+            self.check(selection, target)
+        self.assertIsNone(selector.select(pool, pool.total, self.fee_model))
@@ -0,0 +1,46 @@
+from unittest import TestCase
+
+from multisigcore import secp256k1
+from multisigcore.derivation import KeyDeriver
+from multisigcore.hierarchy import MasterKey, AccountKey
+from pycoin.ecdsa import generator_secp256k1
+from pycoin.serialize import h2b
+
+__author__ = 'devrandom'
+
+
+class DerivationTest(TestCase):
+    def setUp(self):
+        self.master_key = MasterKey.from_seed(h2b("000102030405060708090a0b0c0d0e0f"))
+
+    def test_leaf_matches_subkey_for_path(self):
+        account_key = self.master_key.account_for_path("0H/1/2H")
+        self.assertIsInstance(account_key, AccountKey)
+        for key in [account_key, account_key.public_copy()]:
+            deriver = KeyDeriver(key)
+            for path in ["0/0", "0/1", "1/0", "2/1000000000", "0/0/1", "5"]:
+                self.assertEqual(key.subkey_for_path(path + ".pub").hwif(), deriver.leaf_for_path(path).hwif())
+            self.assertEqual(key.subkey_for_path("1/7.pub").hwif(), deriver.leaf(7, True).hwif())
+
+    def test_hardened_leaf(self):
+        deriver = KeyDeriver(self.master_key)
+        self.assertEqual(self.master_key.subkey_for_path("0H/1H.pub").hwif(), deriver.leaf_for_path("0H/1H").hwif())
+
+    def test_batch_matches_vectors(self):
+        account_key = self.master_key.account_for_path("0H/1/2H")
+        leaves = account_key.public_leaves(0, 5, change=True)
+        self.assertEqual([account_key.subkey_for_path("1/%d.pub" % n).hwif() for n in range(5)],
+                         [leaf.hwif() for leaf in leaves])
+        leaf = KeyDeriver(account_key).chain_node("2").children([1000000000])[0]
+        self.assertEqual("xpub6H1LXWLaKsWFhvm6RVpEL9P4KfRZSW7abD2ttkWP3SSQvnyA8FSVqNTEcYFgJS2UaFcxupHiYkro49S8yGasTvXEYBVPamhGW6cFJodrTHy", leaf.hwif())
+
+
+class Secp256k1Test(TestCase):
+    def test_base_multiply(self):
+        for k in [1, 2, 255, 256, 257, 2 ** 200 + 12345, secp256k1.ORDER - 1]:
+            self.assertEqual((k * generator_secp256k1).pair(), secp256k1.batch_to_affine([secp256k1.base_multiply(k)])[0])
+
+    def test_batch_tweak_add(self):
+        pair = (7 * generator_secp256k1).pair()
+        self.assertEqual([(10 * generator_secp256k1).pair(), (8 * generator_secp256k1).pair(), None],
+                         secp256k1.batch_tweak_add([3, 1, secp256k1.ORDER - 7], pair))
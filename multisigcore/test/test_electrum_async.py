@@ -0,0 +1,82 @@
+import sys
+from unittest import TestCase, skipIf
+
+from multisigcore.testing import make_multisig_account
+from pycoin.tx.TxOut import standard_tx_out_script
+
+from multisigcore.utxo import UTXOStore
+
+if sys.version_info >= (3, 5):
+    import asyncio
+    from multisigcore.providers.electrum_async import AsyncElectrumService, AccountSubscription, ElectrumError, \
+        scripthash
+    from multisigcore.testing.electrum_server import StandInElectrumServer
+
+__author__ = 'devrandom'
+
+
+@skipIf(sys.version_info < (3, 5), "requires asyncio")
+class AsyncElectrumTest(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        account = make_multisig_account()
+        self.addresses = [account.address(n) for n in range(50)]
+        self.server = StandInElectrumServer({self.addresses[n]: [1000 * n, 1] for n in range(0, 50, 7)},
+                                            max_delay=0.01)
+        port = self.loop.run_until_complete(self.server.start())
+        self.service = AsyncElectrumService('127.0.0.1', port, ssl=False, window=10)
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.service.close())
+        self.loop.run_until_complete(self.server.close())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_spendables_for_addresses(self):
+        spendables = self.loop.run_until_complete(self.service.spendables_for_addresses(self.addresses))
+        self.assertEqual("stand-in 1.0", self.service.server_version)
+        self.assertEqual([(1000 * n, standard_tx_out_script(self.addresses[n])) for n in range(0, 50, 7)],
+                         [(s.coin_value, s.script) for s in spendables if s.coin_value != 1])
+        self.assertEqual(51, self.server.requests)
+        self.assertLessEqual(self.server.max_in_flight, 10)
+        self.assertEqual(0, self.service.in_flight)
+
+    def test_shared_connection(self):
+        used = self.loop.run_until_complete(asyncio.gather(
+            self.service.used_addresses(self.addresses[:25]),
+            self.service.used_addresses(self.addresses[25:]),
+            self.service.spendables_for_address(self.addresses[7])))
+        self.assertEqual(set(self.addresses[n] for n in range(0, 25, 7)), used[0])
+        self.assertEqual(set(self.addresses[n] for n in range(28, 50, 7)), used[1])
+        self.assertEqual([7000, 1], [s.coin_value for s in used[2]])
+
+    def test_error(self):
+        with self.assertRaises(ElectrumError):
+            self.loop.run_until_complete(self.service.call("no.such.method", []))
+        self.assertEqual([], self.loop.run_until_complete(self.service.spendables_for_address(self.addresses[1])))
+
+    def test_subscription(self):
+        account = make_multisig_account()
+        account.set_lookahead(2)
+        account.utxo_store = UTXOStore()
+        changed = asyncio.Event()
+        subscription = AccountSubscription(account, self.service, lambda path, spendables: changed.set())
+        self.loop.run_until_complete(subscription.start())
+        self.assertEqual(["0/0", "0/1", "0/2", "1/0", "1/1", "1/2"], sorted(subscription.paths))
+        requests = self.server.requests
+
+        self.server.pay(account.current_change_address(), 5000)
+        self.loop.run_until_complete(asyncio.wait_for(changed.wait(), 5))
+        self.loop.run_until_complete(subscription.wait())
+        # one fetch for the paid script, and one subscription for the script that entered the lookahead
+        self.assertEqual(requests + 2, self.server.requests)
+        self.assertEqual(5000, account.utxo_store.balance())
+        self.assertEqual(2, account.num_int_keys)
+        self.assertIn("1/3", subscription.paths)
+
+        # paid and spent again before the refresh - the status still shows history
+        changed.clear()
+        subscription._notified(scripthash(account.script_pubkey_for_path("1/1")), "00" * 32)
+        self.loop.run_until_complete(asyncio.wait_for(changed.wait(), 5))
+        self.assertEqual(3, account.num_int_keys)
@@ -0,0 +1,110 @@
+import io
+import json
+import socket
+import sys
+import threading
+from unittest import TestCase, skipIf
+
+from multisigcore.providers.electrum import ElectrumConnection, ElectrumConnectError, ElectrumPool
+from multisigcore.testing import make_multisig_account
+
+if sys.version_info >= (3, 5):
+    import asyncio
+    from multisigcore.testing.electrum_server import StandInElectrumServer
+
+__author__ = 'devrandom'
+
+
+class ElectrumConnectionTest(TestCase):
+    def test_skip_notifications(self):
+        class MySocket(object):
+            def sendall(self, payload):
+                pass
+        lines = [{"method": "blockchain.scripthash.subscribe", "params": ["ab", None]},
+                 {"id": 1, "result": 2}, {"id": 7, "result": 0}, {"id": 0, "result": 1}]
+        connection = ElectrumConnection('127.0.0.1', 0, use_ssl=False)
+        connection._sock = MySocket()
+        connection._sock_file = io.BytesIO(b''.join((json.dumps(line) + "\n").encode('utf8') for line in lines))
+        self.assertEqual([1, 2], [response['result'] for response in connection.call_many("m", [[], []])])
+
+
+@skipIf(sys.version_info < (3, 5), "the stand-in server requires asyncio")
+class ElectrumPoolTest(TestCase):
+    def setUp(self):
+        account = make_multisig_account()
+        self.addresses = [account.address(n) for n in range(100)]
+        unspents = {self.addresses[n]: [1000 * n] for n in range(1, 100, 3)}
+        self.servers = [StandInElectrumServer(unspents, max_delay=0.002, seed=1),
+                        StandInElectrumServer(unspents, max_delay=0.002, seed=2, drop_after=30)]
+        self.loop = asyncio.new_event_loop()
+        self.ports = [self.loop.run_until_complete(server.start()) for server in self.servers]
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        for server in self.servers:
+            asyncio.run_coroutine_threadsafe(server.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def test_sharded(self):
+        pool = ElectrumPool([('127.0.0.1', port) for port in self.ports], connections_per_server=2,
+                            use_ssl=False, shard_size=10, retries=5)
+        self.assertFalse(any(connection.connected for connection in pool.connections))
+        try:
+            spendables = pool.spendables_for_addresses(self.addresses)
+            self.assertEqual([1000 * n for n in range(1, 100, 3)], [s.coin_value for s in spendables])
+            used = pool.used_addresses(self.addresses)
+            self.assertEqual(set(self.addresses[n] for n in range(1, 100, 3)), used)
+            # both servers did some of the work, and the second one dropped connections
+            self.assertTrue(all(server.requests > 0 for server in self.servers))
+            self.assertGreater(self.servers[1].connections, 2)
+        finally:
+            pool.close()
+
+    def test_dead_server(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        dead_port = sock.getsockname()[1]
+        sock.close()
+        pool = ElectrumPool([('127.0.0.1', self.ports[0]), ('127.0.0.1', dead_port)], connections_per_server=1,
+                            use_ssl=False, shard_size=10)
+        try:
+            spendables = pool.spendables_for_addresses(self.addresses)
+            self.assertEqual([1000 * n for n in range(1, 100, 3)], [s.coin_value for s in spendables])
+            self.assertFalse(pool.connections[1].connected)
+        finally:
+            pool.close()
+        pool = ElectrumPool([('127.0.0.1', dead_port)], connections_per_server=2, use_ssl=False)
+        try:
+            with self.assertRaises(ElectrumConnectError):
+                pool.spendables_for_addresses(self.addresses)
+        finally:
+            pool.close()
+
+    def test_history_unsupported(self):
+        server = self.servers[0]
+        result = server.result
+
+        def no_history(method, params):
+            if method == "blockchain.address.get_history":
+                raise ValueError("unknown method %s" % (method,))
+            return result(method, params)
+        server.result = no_history
+        pool = ElectrumPool([('127.0.0.1', self.ports[0])], connections_per_server=1, use_ssl=False)
+        try:
+            self.assertIsNone(pool.used_addresses(self.addresses[:5]))
+        finally:
+            pool.close()
+
+    def test_keepalive(self):
+        pool = ElectrumPool([('127.0.0.1', self.ports[0])], connections_per_server=1, use_ssl=False,
+                            keepalive=0.05)
+        try:
+            pool.spendables_for_address(self.addresses[1])
+            requests = self.servers[0].requests
+            pool._closed.wait(0.2)
+            self.assertGreater(self.servers[0].requests, requests)
+        finally:
+            pool.close()
@@ -0,0 +1,70 @@
+import threading
+import time
+from unittest import TestCase
+
+from multisigcore.providers import BatchService
+from multisigcore.providers.hedged import HedgedService
+from pycoin.tx import Spendable
+
+__author__ = 'devrandom'
+
+
+class MyProvider(BatchService):
+    def __init__(self, delay=0.0, fail=False, value=1000):
+        self.delay = delay
+        self.fail = fail
+        self.value = value
+        self.calls = 0
+        self.released = threading.Event()
+
+    def spendables_for_addresses(self, addresses):
+        self.calls += 1
+        if self.delay:
+            self.released.wait(self.delay)
+        if self.fail:
+            raise IOError("provider failed")
+        return [Spendable(self.value, b'', b'1' * 32, n) for n in range(len(addresses))]
+
+    def used_addresses(self, addresses):
+        return set(addresses[:1])
+
+
+class HedgedServiceTest(TestCase):
+    def test_hedge(self):
+        slow, fast = MyProvider(delay=5), MyProvider()
+        service = HedgedService([slow, fast], default_hedge_delay=0.05)
+        start = time.time()
+        self.assertEqual(2, len(service.spendables_for_addresses(["a", "b"])))
+        slow.released.set()
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(1, fast.calls)
+        stats = service.stats()
+        self.assertEqual(1, stats[1]['successes'])
+        # the fast provider is now tried first
+        service.spendables_for_addresses(["a"])
+        self.assertEqual(1, slow.calls)
+        self.assertEqual(2, fast.calls)
+
+    def test_failover_and_circuit(self):
+        failing, good = MyProvider(fail=True), MyProvider(delay=0.05)
+        service = HedgedService([failing, good], race=True, failure_threshold=2, reset_timeout=60)
+        for _ in range(3):
+            self.assertEqual(1, len(service.spendables_for_addresses(["a"])))
+        # the circuit opened after two failures
+        self.assertEqual(2, failing.calls)
+        self.assertEqual(3, good.calls)
+        self.assertTrue(service.stats()[0]['open'])
+        self.assertEqual(2, service.stats()[0]['errors'])
+        # a failure is followed by the next provider immediately
+        service = HedgedService([MyProvider(fail=True), MyProvider()], default_hedge_delay=5)
+        self.assertEqual(1, len(service.spendables_for_addresses(["a"])))
+        with self.assertRaises(IOError):
+            HedgedService([MyProvider(fail=True)]).spendables_for_addresses(["a"])
+
+    def test_quorum(self):
+        providers = [MyProvider(value=1000), MyProvider(value=2000), MyProvider(value=1000)]
+        service = HedgedService(providers, race=True, quorum=2)
+        self.assertEqual([1000], [s.coin_value for s in service.spendables_for_addresses(["a"])])
+        with self.assertRaises(IOError):
+            HedgedService(providers[:2], quorum=2).spendables_for_addresses(["a"])
+        self.assertEqual(set(["a"]), service.used_addresses(["a", "b"]))
@@ -1,6 +1,12 @@
+import io
+import json
+import struct
 from unittest import TestCase
+from multisigcore.cache import FileCacheJournal, LEAF_BLOCK, compact
 from multisigcore.hierarchy import *
-from multisigcore.testing import make_multisig_account, make_unsorted_multisig_account, TEST_PATH
+from multisigcore.testing import make_multisig_account, make_incomplete_multisig_account, \
+    make_unsorted_multisig_account, TEST_PATH
+from multisigcore.utxo import UTXOStore
 
 from pycoin.encoding import bitcoin_address_to_hash160_sec
 from pycoin.networks import address_prefix_for_netcode
@@ -155,6 +161,15 @@ class HierarchyTest(TestCase):
         # Countersign
         multisigcore.local_sign(tx, [redeem_script], [oracle_key.subkey_for_path("0/0")])
         self.assertTrue(tx.is_signature_ok(0))
+        # the estimate is an upper bound, within a byte per signature
+        size = len(tx.as_bin())
+        estimate = account.estimate_size(1, [tx_out.script for tx_out in tx.txs_out])
+        self.assertLessEqual(size, estimate)
+        self.assertGreaterEqual(size + 2, estimate)
+        self.assertEqual(estimate * 10, account.estimate_fee(1, [tx_out.script for tx_out in tx.txs_out], 10))
+        self.assertLess(recommended_fee_for_tx(tx), account.estimate_fee(1, [], 1000))
+        with self.assertRaises(Exception):
+            make_incomplete_multisig_account().estimated_input_size()
 
     def test_simple_account(self):
         account_key = self.master_key.account_for_path("0H/1/2H")
@@ -182,10 +197,19 @@ class HierarchyTest(TestCase):
         with self.assertRaises(InsufficientBalanceException) as e:
             account.tx([("3FfiLhj1yXkXRFRRb9CMsMXBNZXQEv23Pi", 9001)])
         self.assertEqual(10000, e.exception.balance)
+        unsigned = tx.as_bin()
+        self.assertIs(unsigned, tx.as_bin())
         account.sign(tx)
         self.assertTrue(tx.is_signature_ok(0))
         self.assertEqual(["0/0"], tx.input_chain_paths())
         self.assertEqual([None, "1/0"], tx.output_chain_paths())
+        # the memoized serialization follows mutations
+        plain = Tx(tx.version, tx.txs_in, tx.txs_out, tx.lock_time)
+        self.assertNotEqual(unsigned, tx.as_bin())
+        self.assertEqual(plain.as_bin(), tx.as_bin())
+        self.assertEqual(plain.hash(), tx.hash())
+        tx.txs_out[0].coin_value = 1000
+        self.assertEqual(plain.as_hex(), tx.as_hex())
 
     def test_tx_serialize(self):
         account_key = self.master_key.account_for_path("0H/1/2H")
@@ -234,3 +258,217 @@ class HierarchyTest(TestCase):
         self.assertTrue(account.rotate_addresses(tx))
         self.assertNotEqual(first, account.current_address())
         self.assertNotEqual(first_change, account.current_change_address())
+
+    def test_address_map_incremental(self):
+        account_key = self.master_key.account_for_path("0H/1/2H")
+        account = SimpleAccount(account_key)
+        account.set_lookahead(2)
+        account._provider = MySimpleProvider()
+        account.spendables()
+        self.assertEqual(account.make_address_map(True), account.address_map)
+        account.next_address()
+        account.next_change_address()
+        self.assertEqual(account.make_address_map(True), account.address_map)
+        account.set_lookahead(1)
+        self.assertEqual(account.make_address_map(True), account.address_map)
+        self.assertEqual("0/2", account.path_for(account.address(2)))
+        with self.assertRaises(ValueError):
+            account.path_for_check(account.address(3))
+
+    def test_script_index(self):
+        account_key = self.master_key.account_for_path("0H/1/2H")
+        account = SimpleAccount(account_key)
+        account.set_lookahead(2)
+        script = standard_tx_out_script(account.address(2, True))
+        self.assertEqual("1/2", account.path_for_script(script))
+        self.assertEqual("1/2", account.path_for_hash160(bitcoin_address_to_hash160_sec(account.address(2, True))))
+        self.assertEqual("1/2", account.path_for_script_check(script))
+        self.assertEqual(account.address(2, True), account.address_for_path("1/2"))
+        account.set_lookahead(1)
+        self.assertIsNone(account.path_for_script(script))
+        self.assertIsNone(account.path_for_hash160(bitcoin_address_to_hash160_sec(account.address(2, True))))
+        with self.assertRaises(ValueError):
+            account.path_for_script_check(script)
+        account.next_change_address()
+        self.assertEqual("1/2", account.path_for_script(script))
+
+        multisig = make_multisig_account()
+        multisig.set_lookahead(1)
+        self.assertEqual("0/0", multisig.path_for_script(standard_tx_out_script(multisig.address(0))))
+        self.assertEqual("0/0", multisig.path_for_hash160(multisig._leaf("0/0").hash160))
+
+    def test_invalidate(self):
+        account = SimpleAccount(self.master_key.account_for_path("0H/1/2H"))
+        invalidated = []
+
+        class MyProvider(BatchService):
+            def spendables_for_addresses(self, addresses):
+                return [spend for address in addresses for spend in MySimpleProvider().spendables_for_address(address)]
+
+            def invalidate(self, addresses=None):
+                invalidated.extend(addresses)
+        account._provider = MyProvider()
+        account.tx([("3FfiLhj1yXkXRFRRb9CMsMXBNZXQEv23Pi", 2000)])
+        # the provider does not cache, so nothing is derived for it
+        self.assertEqual([], invalidated)
+        MyProvider.invalidates = True
+        account.tx([("3FfiLhj1yXkXRFRRb9CMsMXBNZXQEv23Pi", 2000)])
+        self.assertEqual(sorted(["1r1msgrPfqCMRAhg23cPBD9ZXH1UQ6jec", account.current_change_address()]),
+                         sorted(invalidated))
+
+    def test_leaves(self):
+        leaves = list(self.multisig_account.leaves(0, 3))
+        self.assertEqual(["0/0", "0/1", "0/2"], [leaf.path for leaf in leaves])
+        self.assertEqual(["3MhrgJ9BtL3GTsUU6EqAqDGKdUAv8C15EN", "3CWheC3YFPXAxVPBKkevMV5YFhy2h2oVSu",
+                          "335QrAenpWLGFRNZT7VpzbkT1bPzRUkWna"], [leaf.address for leaf in leaves])
+        self.assertEqual(self.multisig_account.leaf_script(2).script(), leaves[2].script)
+        uma = make_unsorted_multisig_account()
+        change_leaves = list(uma.leaves(1, 4, change=True, processes=2, chunk_size=1))
+        self.assertEqual([uma.address(n, True) for n in range(1, 4)], [leaf.address for leaf in change_leaves])
+        account = SimpleAccount(self.master_key.account_for_path("0H/1/2H"))
+        self.assertEqual([account.address(n) for n in range(2)], [leaf.address for leaf in account.leaves(0, 2)])
+
+    def test_multisig_account_cache(self):
+        self.assertEqual("335QrAenpWLGFRNZT7VpzbkT1bPzRUkWna", self.multisig_account.address(2))
+        self.multisig_account.next_address()
+        cache = self.multisig_account.cache
+        account = MultisigAccount(keys=self.multisig_account.keys, cache=cache)
+        self.assertEqual(2, account.num_ext_keys)
+        self.assertEqual(cache, account.cache)
+        self.assertEqual("335QrAenpWLGFRNZT7VpzbkT1bPzRUkWna", account.address(2))
+
+    def test_legacy_json_cache(self):
+        account_key = self.master_key.account_for_path("0H/1/2H")
+        leaf = account_key.subkey_for_path("0/0.pub")
+        legacy = json.dumps({'keys': {'0/0': {'hwif': leaf.hwif()}}, 'issued': {'0': 3, '1': 1}})
+        account = SimpleAccount(account_key, legacy)
+        self.assertEqual(3, account.num_ext_keys)
+        self.assertEqual("1r1msgrPfqCMRAhg23cPBD9ZXH1UQ6jec", account.address(0, False))
+        self.assertEqual("1r1msgrPfqCMRAhg23cPBD9ZXH1UQ6jec", SimpleAccount(account_key, account.cache).address(0))
+
+    def test_cache_journal(self):
+        account_key = self.master_key.account_for_path("0H/1/2H")
+        account = SimpleAccount(account_key)
+        account.address(0)
+        snapshot = account.cache
+        f = io.BytesIO()
+        account.journal = FileCacheJournal(f)
+        account.next_address()
+        account.next_change_address()
+        self.assertEqual("181yMj2Es6RNvoHgj6bX82r2Vm38rmHV8C", account.current_address())
+        account1 = SimpleAccount(account_key, cache=snapshot, journal=f.getvalue())
+        self.assertEqual(2, account1.num_ext_keys)
+        self.assertEqual(2, account1.num_int_keys)
+        self.assertEqual("181yMj2Es6RNvoHgj6bX82r2Vm38rmHV8C", account1.current_address())
+        compacted = compact(snapshot, f.getvalue())
+        self.assertEqual(account.cache, compacted)
+        self.assertEqual(account1.current_change_address(), SimpleAccount(account_key, compacted).current_change_address())
+
+    def test_leaf_cache(self):
+        account = MultisigAccount(keys=self.multisig_account.keys, leaf_cache_size=2)
+        self.assertEqual("3MhrgJ9BtL3GTsUU6EqAqDGKdUAv8C15EN", account.address(0))
+        self.assertEqual("3MhrgJ9BtL3GTsUU6EqAqDGKdUAv8C15EN", account.address(0))
+        self.assertEqual("3CWheC3YFPXAxVPBKkevMV5YFhy2h2oVSu", account.address(1))
+        self.assertEqual("335QrAenpWLGFRNZT7VpzbkT1bPzRUkWna", account.address(2))
+        stats = account.leaf_cache_stats
+        self.assertEqual(2, stats['size'])
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(3, stats['misses'])
+        self.assertEqual(1, stats['evictions'])
+        self.assertEqual("3MhrgJ9BtL3GTsUU6EqAqDGKdUAv8C15EN", account.address(0))
+        self.assertEqual(self.multisig_account.script_for_path(TEST_PATH).script(), account.script_for_path(TEST_PATH).script())
+        script = account.script_for_path(TEST_PATH)
+        self.assertEqual(ScriptMultisig(script.n, script.sec_keys).script(), script.script())
+        self.assertEqual(self.multisig_account.cache, MultisigAccount(keys=self.multisig_account.keys, cache=self.multisig_account.cache).cache)
+        self.assertEqual(4, len(MultisigAccount(keys=self.multisig_account.keys, cache=account.cache)._cache['keys']))
+
+    def test_key_cache(self):
+        account = MultisigAccount(keys=self.multisig_account.keys, leaf_cache_size=1)
+        account.set_key_cache_size(LEAF_BLOCK)
+        self.assertEqual("3MhrgJ9BtL3GTsUU6EqAqDGKdUAv8C15EN", account.address(0))
+        self.assertEqual("3CWheC3YFPXAxVPBKkevMV5YFhy2h2oVSu", account.address(1))
+        other = account.address(LEAF_BLOCK + 1)
+        self.assertEqual(1, len(account._cache['keys']))
+        self.assertNotIn("0/0", account._cache['keys'])
+        self.assertEqual(1, len(MultisigAccount(keys=self.multisig_account.keys, cache=account.cache)._cache['keys']))
+        self.assertEqual("3MhrgJ9BtL3GTsUU6EqAqDGKdUAv8C15EN", account.address(0))
+        self.assertEqual(1, len(account._cache['keys']))
+        self.assertNotIn("0/%d" % (LEAF_BLOCK + 1), account._cache['keys'])
+        account.set_key_cache_size(None)
+        self.assertEqual(other, account.address(LEAF_BLOCK + 1))
+        self.assertEqual(2, len(account._cache['keys']))
+
+    def test_v1_binary_cache(self):
+        account_key = self.master_key.account_for_path("0H/1/2H")
+        leaf = account_key.subkey_for_path("0/0.pub")
+        record = leaf.sec() + leaf.chain_code() + struct.pack(">B4sL", 4, leaf.parent_fingerprint(), 0)
+        v1 = b'MSC' + struct.pack(">BB", 1, 3) + b'BTC' + struct.pack(">LLL", 2, 1, 1) + \
+            struct.pack(">H", 3) + b'0/0' + b'\0' + record
+        account = SimpleAccount(account_key, v1)
+        self.assertEqual(2, account.num_ext_keys)
+        self.assertEqual((leaf.sec(),), tuple(account._cache['keys']["0/0"]))
+        self.assertEqual("1r1msgrPfqCMRAhg23cPBD9ZXH1UQ6jec", account.address(0))
+
+    def test_discover(self):
+        account_key = self.master_key.account_for_path("0H/1/2H")
+        funded = SimpleAccount(account_key)
+        receive, change, spent = funded.address(25), funded.address(3, True), funded.address(40)
+
+        class MyProvider(BatchService):
+            def __init__(self):
+                self.calls = 0
+
+            def spendables_for_addresses(self, addresses):
+                self.calls += 1
+                return [Spendable(coin_value=1000, script=standard_tx_out_script(address), tx_out_index=0, tx_hash=b'2'*32)
+                        for address in addresses if address in (receive, change)]
+
+            def used_addresses(self, addresses):
+                return set(address for address in addresses if address == spent)
+
+        account = SimpleAccount(account_key)
+        account._provider = MyProvider()
+        spendables = account.discover(gap_limit=30)
+        self.assertEqual(2, len(spendables))
+        self.assertEqual(42, account.num_ext_keys)
+        self.assertEqual(5, account.num_int_keys)
+        self.assertEqual(3, account._provider.calls)
+        self.assertEqual(2000, account.balance())
+
+    def test_utxo_store(self):
+        account_key = self.master_key.account_for_path("0H/1/2H")
+        account = SimpleAccount(account_key)
+
+        class MyProvider(MySimpleProvider):
+            def __init__(self):
+                self.calls = 0
+                self.spent = False
+
+            def spendables_for_address(self, address):
+                self.calls += 1
+                return [] if self.spent else super(MyProvider, self).spendables_for_address(address)
+
+        provider = MyProvider()
+        account._provider = provider
+        account.set_lookahead(2)
+        account.utxo_store = UTXOStore()
+        self.assertEqual(10000, account.balance())
+        self.assertEqual(6, provider.calls)
+        self.assertEqual(10000, account.balance())
+        self.assertEqual(1, len(account.spendables()))
+        self.assertEqual(6, provider.calls)
+
+        tx = account.tx([("3FfiLhj1yXkXRFRRb9CMsMXBNZXQEv23Pi", 2000)])
+        account.sign(tx)
+        # the input is spent and the change is pending
+        self.assertEqual(7000, account.balance())
+        spendables = account.spendables()
+        self.assertEqual([(tx.hash(), 1)], [(s.tx_hash, s.tx_out_index) for s in spendables])
+
+        # still reported as unspent - stays spent
+        account.sync()
+        self.assertEqual(7000, account.balance())
+        provider.spent = True
+        account.sync([account.address(0)])
+        self.assertEqual(7000, account.balance())
+        self.assertEqual(13, provider.calls)
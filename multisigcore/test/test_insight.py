@@ -0,0 +1,78 @@
+import json
+import threading
+from unittest import TestCase
+
+from httmock import HTTMock, urlmatch
+
+from multisigcore.providers.insight import InsightBatchService
+from multisigcore.testing import make_multisig_account
+from pycoin.serialize import b2h, b2h_rev
+from pycoin.tx.TxOut import standard_tx_out_script
+
+__author__ = 'devrandom'
+
+
+class InsightTest(TestCase):
+    def setUp(self):
+        account = make_multisig_account()
+        self.addresses = [leaf.address for leaf in account.leaves(0, 300, processes=1)]
+        self.urls = []
+        self.lock = threading.Lock()
+        self.gate = None
+
+    def mock(self):
+        @urlmatch(netloc='insight.example.com', path=r'/api/addrs/.*/utxo')
+        def utxo(url, request):
+            addresses = url.path.split('/')[3].split(',')
+            with self.lock:
+                self.urls.append(request.url)
+            if self.gate is not None and len(self.urls) > 1:
+                self.gate.wait(5)
+            return json.dumps([{"address": address, "txid": b2h_rev(bytes(bytearray([n % 256] * 32))), "vout": 1,
+                                "amount": 0.0001, "scriptPubKey": b2h(standard_tx_out_script(address))}
+                               for n, address in enumerate(addresses) if self.addresses.index(address) % 10 == 0])
+        return HTTMock(utxo)
+
+    def test_spendables_for_addresses(self):
+        service = InsightBatchService("http://insight.example.com/", threads=3, max_url_length=1000)
+        try:
+            with self.mock():
+                spendables = service.spendables_for_addresses(self.addresses)
+        finally:
+            service.close()
+        self.assertEqual(sorted(standard_tx_out_script(self.addresses[n]) for n in range(0, 300, 10)),
+                         sorted(s.script for s in spendables))
+        self.assertEqual(set([10000]), set(s.coin_value for s in spendables))
+        # 35 character P2SH addresses - at most 27 fit in a URL of 1000 characters
+        self.assertTrue(all(len(url) <= 1000 for url in self.urls))
+        self.assertEqual(12, len(self.urls))
+
+    def test_adaptive_chunk_size(self):
+        service = InsightBatchService("http://insight.example.com", threads=1, max_url_length=100000)
+        try:
+            with self.mock():
+                service.spendables_for_addresses(self.addresses)
+        finally:
+            service.close()
+        # fast responses double the chunk size, from 100 to 200
+        self.assertEqual(2, len(self.urls))
+        self.assertEqual(100, self.urls[0].count(',') + 1)
+        self.assertEqual(200, self.urls[1].count(',') + 1)
+        service._adapt(10)
+        self.assertEqual(200, service.chunk_size)
+
+    def test_abandoned(self):
+        service = InsightBatchService("http://insight.example.com", threads=1, max_url_length=100)
+        self.gate = threading.Event()
+        try:
+            with self.mock():
+                spendables = service.iter_spendables_for_addresses(self.addresses)
+                next(spendables)
+                spendables.close()
+                self.gate.set()
+                service._pool.close()
+                service._pool.join()
+        finally:
+            service.close()
+        # the worker stops after the chunk it was fetching when the generator was closed
+        self.assertEqual(2, len(self.urls))
@@ -1,12 +1,16 @@
+import copy
 import io
 import json
+import socket
 
 from httmock import HTTMock
 import dateutil.parser
+import requests
 
-from multisigcore.oracle import OracleError, OracleDeferralException, OracleRejectionException, OracleLockoutException, \
+from multisigcore.oracle import OracleError, OracleInternalError, OracleDeferralException, OracleRejectionException, OracleLockoutException, \
     PersonalInformation
 from multisigcore.testing import *
+from multisigcore.utxo import UTXOStore
 
 
 __author__ = 'devrandom'
@@ -39,7 +43,9 @@ class OracleTest(unittest.TestCase):
     def test_sign_request(self):
         # generated with `tx -i 34DjTcNWGReJV4xx7R1AWK7FTz3xMwMcjA  3Ph5UGYHCyvYFQifw76T8iqKL9EkGKDBMz/100000 -o tx.hex`
         unsigned = self.make_partially_signed_tx()
+        before = unsigned.as_hex()
         req = self.oracle._create_oracle_request([TEST_PATH], [], None, unsigned)
+        self.assertEqual(before, unsigned.as_hex())
         self.assertEqual("01000000019cb9e92cd3f91087852382150f19b5d99259be47106d860055d1afb81100222500000000b500473044022042b1b79675985a46e021c056708420f0bade9cdc4b336b55c53d0f22488f34e40220795cbd8291f083ea32eb29e8ace895852823611927b9ba7e94a333f022f5dd4301004c69522102fa0e06db47e8924274c670503238db30367d11ccaca00d385ac370fed93578d2210379014532a465b19fcf1ead9921488274821fd58178542b2aa54007bcc5a29d34210381c235ee18d9e85e3b28200200df3a2276c6b9473f18946ef8740ccaebfa4b1e53aeffffffff01d06c04000000000017a914f155ba65bdb30930da320ec51a0d6c913dfce06b8700000000",
                          req['transaction']['bytes'])
 
@@ -64,6 +70,29 @@ class OracleTest(unittest.TestCase):
         self.maxDiff = None
         self.assertEqual(json.loads(json.dumps(req)), json.loads(JSON))
 
+    def test_input_txs_deduplicated(self):
+        class CountingTxDb(dict):
+            def __init__(self, *args):
+                super(CountingTxDb, self).__init__(*args)
+                self.lookups = []
+
+            def get(self, tx_hash, default=None):
+                self.lookups.append(tx_hash)
+                return super(CountingTxDb, self).get(tx_hash, default)
+
+        tx_db = self.oracle.tx_db = CountingTxDb(self.tx_db)
+        unsigned = self.make_partially_signed_tx()
+        unsigned.txs_in.append(copy.deepcopy(unsigned.txs_in[0]))
+        req = self.oracle._create_oracle_request([TEST_PATH, TEST_PATH], [], None, unsigned)
+        input_tx_hex = b2h(self.input_tx.as_bin())
+        self.assertEqual([input_tx_hex, input_tx_hex], req['transaction']['inputTransactions'])
+        self.assertEqual([self.input_tx.hash()], tx_db.lookups)
+
+        tx_db = self.oracle.tx_db = CountingTxDb(self.tx_db)
+        self.account.prefetch_input_txs([Spendable(300000, b'', self.input_tx.hash(), 0)] * 2)
+        self.oracle._create_oracle_request([TEST_PATH, TEST_PATH], [], None, unsigned)
+        self.assertEqual([self.input_tx.hash()], tx_db.lookups)
+
     def test_sign(self):
         self._request = None
         def digitaloracle_mock(url, request):
@@ -104,6 +133,21 @@ class OracleTest(unittest.TestCase):
             except OracleError as e:
                 pass #expected
 
+    def test_sign_fail_releases_inputs(self):
+        def digitaloracle_mock(url, request):
+            return {"status_code": 400, "content": json.dumps({"error": "failed"}).encode("utf8")}
+
+        unsigned = self.make_partially_signed_tx_with_change()
+        self.account.utxo_store = UTXOStore()
+        self.account.utxo_store.update([(Spendable(300000, unsigned.unspents[0].script, unsigned.txs_in[0].previous_hash,
+                                                   unsigned.txs_in[0].previous_index), TEST_PATH)])
+        self.account.record_signed(unsigned)
+        self.assertEqual(0, self.account.utxo_store.balance())
+        with HTTMock(digitaloracle_mock):
+            with self.assertRaises(OracleError):
+                self.oracle.sign_with_paths(unsigned, [TEST_PATH], [None, TEST_PATH])
+        self.assertEqual(300000, self.account.utxo_store.balance())
+
     def test_sign_defer(self):
         self._request = None
         until = "2010-01-01 00:01:00Z"
@@ -128,6 +172,60 @@ class OracleTest(unittest.TestCase):
                 self.assertEquals(e.until, dateutil.parser.parse(until))
                 self.assertEquals(e.verifications, ["otp"])
 
+    def test_sign_retry(self):
+        self._requests = []
+
+        def digitaloracle_mock(url, request):
+            self._requests.append(request)
+            if len(self._requests) < 3:
+                return {"status_code": 503, "content": b"unavailable"}
+            return {
+                "status_code": 200,
+                "content": json.dumps({"result": "success", "now": "2010-01-01 00:00:00Z", "spendId": "aaa"}).encode("utf8")
+            }
+
+        self.oracle.backoff = 0
+        self.assertIs(self.oracle.session, Oracle(make_multisig_account()).session)
+        with HTTMock(digitaloracle_mock):
+            unsigned = self.make_partially_signed_tx_with_change()
+            res = self.oracle.sign_with_paths(unsigned, [TEST_PATH], [None, TEST_PATH], spend_id="aaa")
+            self.assertEqual(res.spend_id, "aaa")
+            self.assertEqual(3, len(self._requests))
+            self.assertEqual(1, len(set(request.body for request in self._requests)))
+
+            # without a spend id, the oracle cannot recognize a repeated request
+            del self._requests[:]
+            with self.assertRaises(OracleInternalError):
+                self.oracle.sign_with_paths(unsigned, [TEST_PATH], [None, TEST_PATH])
+            self.assertEqual(1, len(self._requests))
+
+    def test_sign_connection_refused(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        url = "http://127.0.0.1:%d/" % sock.getsockname()[1]
+        sock.close()
+        try:
+            requests.get(url, timeout=5)
+            self.fail()
+        except requests.exceptions.ConnectionError as e:
+            refused = e
+
+        class RefusingSession(object):
+            def __init__(self):
+                self.attempts = 0
+
+            def request(self, method, url, **kwargs):
+                self.attempts += 1
+                raise refused
+
+        # a request that was never sent is retried, even without a spend id
+        self.oracle.session = RefusingSession()
+        self.oracle.backoff = 0
+        unsigned = self.make_partially_signed_tx_with_change()
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.oracle.sign_with_paths(unsigned, [TEST_PATH], [None, TEST_PATH])
+        self.assertEqual(self.oracle.retries + 1, self.oracle.session.attempts)
+
     def test_sign_rejected(self):
         self._request = None
         until = "2010-01-01 00:01:00Z"
@@ -0,0 +1,74 @@
+import json
+import sys
+from unittest import TestCase, skipIf
+
+from multisigcore.oracle import OracleDeferralException, OracleRejectionException, OracleUnknownKeychainException
+from multisigcore.test import test_oracle
+from multisigcore.testing import TEST_PATH, make_incomplete_multisig_account
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+if sys.version_info >= (3, 5) and aiohttp is not None:
+    import asyncio
+    from multisigcore.oracle_async import AsyncOracle
+    from multisigcore.testing.oracle_server import StandInOracleServer, sign_concurrently
+
+__author__ = 'devrandom'
+
+
+@skipIf(sys.version_info < (3, 5) or aiohttp is None, "requires asyncio and aiohttp")
+class AsyncOracleTest(TestCase):
+    def setUp(self):
+        test_oracle.OracleTest.setUp(self)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.server = StandInOracleServer()
+        self.base_url = self.loop.run_until_complete(self.server.start())
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.server.close())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_sign(self):
+        def respond(n, body):
+            if n == 1:
+                return 503, {}
+            return 200, {"result": "success", "now": "2010-01-01 00:00:00Z", "spendId": json.loads(body)['spendId']}
+        self.server.respond = respond
+
+        unsigned = self.make_partially_signed_tx_with_change()
+        results = self.loop.run_until_complete(sign_concurrently(
+            self.account, self.tx_db, self.base_url, unsigned, [TEST_PATH], [None, TEST_PATH], 20, concurrency=4))
+        self.assertEqual(["%02d" % n for n in range(20)], [result.spend_id for result in results])
+        # the first request was retried
+        self.assertEqual(21, len(self.server.requests))
+        self.assertTrue(self.server.requests[0][1].endswith("/transactions"))
+        self.assertLessEqual(self.server.max_in_flight, 4)
+
+    def test_exceptions(self):
+        oracle = AsyncOracle(self.account, tx_db=self.tx_db, base_url=self.base_url)
+        unsigned = self.make_partially_signed_tx_with_change()
+
+        self.server.respond = lambda n, body: (200, {"result": "deferred", "spendId": "aaa",
+                                              "deferral": {"reason": "verification", "verifications": ["otp"]}})
+        with self.assertRaises(OracleDeferralException) as context:
+            self.loop.run_until_complete(oracle.sign(unsigned))
+        self.assertEqual(["otp"], context.exception.verifications)
+
+        self.server.respond = lambda n, body: (200, {"result": "rejected"})
+        with self.assertRaises(OracleRejectionException):
+            self.loop.run_until_complete(oracle.sign_with_paths(unsigned, [TEST_PATH], [None, TEST_PATH]))
+
+        incomplete = AsyncOracle(make_incomplete_multisig_account(), base_url=self.base_url, backoff=0)
+        self.server.respond = lambda n, body: (404, {})
+        with self.assertRaises(OracleUnknownKeychainException):
+            self.loop.run_until_complete(incomplete.get())
+        self.assertEqual('GET', self.server.requests[-1][0])
+        self.loop.run_until_complete(oracle.close())
+        self.loop.run_until_complete(incomplete.close())
+
+    make_partially_signed_tx_with_change = test_oracle.OracleTest.make_partially_signed_tx_with_change
@@ -0,0 +1,121 @@
+import itertools
+import threading
+from unittest import TestCase
+
+import mock
+
+import multisigcore
+from multisigcore.hierarchy import MasterKey, MultisigAccount
+from multisigcore.oracle import OracleRejectionException, SignatureResult
+from multisigcore import pipeline as signing_pipeline
+from multisigcore.pipeline import SigningPipeline, STAGE_LOCAL, STAGE_ORACLE
+from multisigcore.testing import make_multisig_account
+from multisigcore.utxo import UTXOStore
+from pycoin.serialize import h2b
+from pycoin.tx import Spendable
+from pycoin.tx.TxOut import standard_tx_out_script
+
+__author__ = 'devrandom'
+
+
+class MyOracle(object):
+    def __init__(self, account, oracle_key):
+        self.account = account
+        self.oracle_key = oracle_key
+
+    def sign(self, tx):
+        if tx.txs_in[0].previous_hash[0] % 2 == 1:
+            raise OracleRejectionException()
+        multisigcore.local_sign(tx, self.account.collect_redeem_scripts(tx),
+                                [self.oracle_key.subkey_for_path(tx_in.path) for tx_in in tx.txs_in])
+        return SignatureResult({'transaction': tx, 'now': None, 'spend_id': None, 'deferral': None})
+
+
+class SigningPipelineTest(TestCase):
+    def setUp(self):
+        master_key = MasterKey.from_seed(h2b("000102030405060708090a0b0c0d0e0f"))
+        keys = [master_key.account_for_path("0H/1/%dH" % n) for n in (2, 3, 4)]
+        self.account = MultisigAccount(keys=keys, sort=False)
+        self.account.set_lookahead(1)
+        self.oracle = MyOracle(self.account, keys[2])
+        funded = self.account.address(0)
+        counter = itertools.count()
+
+        class MyProvider(object):
+            def spendables_for_address(self, address):
+                if address != funded:
+                    return []
+                # a new coin each time, so that each transaction spends a different one
+                return [Spendable(10000, standard_tx_out_script(address), bytes(bytearray([next(counter)] * 32)), 0)]
+        self.account._provider = MyProvider()
+
+    def txs(self, count):
+        for _ in range(count):
+            yield self.account.tx([("3FfiLhj1yXkXRFRRb9CMsMXBNZXQEv23Pi", 2000)])
+
+    def test_sign(self):
+        pipeline = SigningPipeline(self.account, self.oracle, processes=2, threads=3, max_in_flight=4)
+        try:
+            results = list(pipeline.sign(self.txs(6)))
+        finally:
+            pipeline.close()
+        self.assertEqual(list(range(6)), sorted(result.index for result in results))
+        for result in results:
+            if result.index % 2:
+                self.assertIsInstance(result.error, OracleRejectionException)
+                self.assertEqual(STAGE_ORACLE, result.stage)
+                self.assertFalse(result.tx.is_signature_ok(0))
+            else:
+                self.assertIsNone(result.error)
+                self.assertTrue(result.signature.transaction.is_signature_ok(0))
+        stats = pipeline.stats()
+        self.assertEqual(6, stats[STAGE_LOCAL]['count'])
+        self.assertEqual(0, stats[STAGE_LOCAL]['errors'])
+        self.assertEqual(3, stats[STAGE_ORACLE]['errors'])
+        self.assertEqual(3, stats['total']['errors'])
+        self.assertLessEqual(stats['total']['p50'], stats['total']['max'])
+
+    def test_rejected_releases_inputs(self):
+        self.account.utxo_store = UTXOStore()
+        self.account.utxo_store.update([(Spendable(10000, self.account.script_pubkey_for_path("0/0"), b'\x01' * 32, 0),
+                                         "0/0")])
+        tx = self.account.tx([("3FfiLhj1yXkXRFRRb9CMsMXBNZXQEv23Pi", 2000)])
+        results = list(SigningPipeline(self.account, self.oracle, processes=1).sign([tx]))
+        self.assertIsInstance(results[0].error, OracleRejectionException)
+        self.assertEqual(10000, self.account.balance())
+
+    def test_local_failure(self):
+        # no private key
+        account = make_multisig_account()
+        tx = self.account.tx([("3FfiLhj1yXkXRFRRb9CMsMXBNZXQEv23Pi", 2000)])
+        results = list(SigningPipeline(account, processes=1).sign([tx]))
+        self.assertEqual(1, len(results))
+        self.assertEqual(STAGE_LOCAL, results[0].stage)
+        self.assertIsInstance(results[0].error, ValueError)
+
+    def test_unpicklable(self):
+        txs = list(self.txs(2))
+        txs[1].txs_in[0].lock = threading.Lock()
+        pipeline = SigningPipeline(self.account, processes=2)
+        try:
+            results = sorted(pipeline.sign(txs), key=lambda result: result.index)
+        finally:
+            pipeline.close()
+        self.assertIsNone(results[0].error)
+        self.assertEqual(STAGE_LOCAL, results[1].stage)
+        self.assertIsNotNone(results[1].error)
+
+    def test_unpicklable_python2(self):
+        # Python 2 pools have no error callback
+        with mock.patch.object(signing_pipeline, 'sys') as mock_sys:
+            mock_sys.version_info = (2, 7)
+            self.test_unpicklable()
+
+    def test_in_process(self):
+        pipeline = SigningPipeline(self.account, processes=1)
+        # the first transaction spends a coinbase-like input, which is not signed
+        results = list(pipeline.sign(list(self.txs(2))[1:]))
+        self.assertIsNone(results[0].error)
+        self.assertNotEqual(b'', results[0].tx.txs_in[0].script)
+        # no private key stays behind in this process
+        self.assertEqual({}, signing_pipeline._worker_signing_key)
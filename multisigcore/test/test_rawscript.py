@@ -0,0 +1,61 @@
+from unittest import TestCase
+
+from multisigcore import rawscript
+from multisigcore.oracle import DUMMY_SIGNATURE, fixed_input_script
+from multisigcore.testing import make_multisig_account, TEST_PATH
+from pycoin.serialize import b2h
+from pycoin.tx import TxOut
+from pycoin.tx.TxOut import standard_tx_out_script
+from pycoin.tx.script.tools import compile, opcode_list
+
+__author__ = 'devrandom'
+
+
+class RawScriptTest(TestCase):
+    def setUp(self):
+        self.account = make_multisig_account()
+        self.redeem_script = self.account.script_for_path(TEST_PATH).script()
+
+    def test_templates(self):
+        p2sh = standard_tx_out_script("3Ph5UGYHCyvYFQifw76T8iqKL9EkGKDBMz")
+        p2pkh = standard_tx_out_script("1r1msgrPfqCMRAhg23cPBD9ZXH1UQ6jec")
+        self.assertEqual(rawscript.P2SH, rawscript.script_type(p2sh))
+        self.assertEqual(rawscript.P2PKH, rawscript.script_type(p2pkh))
+        self.assertEqual(rawscript.MULTISIG, rawscript.script_type(self.redeem_script))
+        self.assertEqual(p2sh[2:22], rawscript.p2sh_hash160(memoryview(p2sh)))
+        self.assertIsNone(rawscript.p2pkh_hash160(p2sh))
+        self.assertEqual(p2pkh[3:23], rawscript.output_hash160(p2pkh))
+        self.assertIsNone(rawscript.output_hash160(self.redeem_script))
+        num_sigs, secs = rawscript.multisig_info(self.redeem_script)
+        self.assertEqual(2, num_sigs)
+        self.assertEqual(3, len(secs))
+        # memoryviews give the same bytes
+        self.assertEqual(p2pkh[3:23], rawscript.p2pkh_hash160(memoryview(p2pkh)))
+        self.assertEqual(p2sh[2:22], rawscript.output_hash160(memoryview(p2sh)))
+        self.assertEqual((num_sigs, secs), rawscript.multisig_info(memoryview(self.redeem_script)))
+        self.assertTrue(all(isinstance(sec, bytes) for sec in secs))
+        for script in (b'', b'\x6a\x04abcd', p2sh[:-1], self.redeem_script[:-1], b'\x4d\xff'):
+            self.assertIsNone(rawscript.script_type(script))
+        self.assertEqual("3Ph5UGYHCyvYFQifw76T8iqKL9EkGKDBMz", self.account.address_from_spend(TxOut(0, p2sh)))
+        self.assertEqual("1r1msgrPfqCMRAhg23cPBD9ZXH1UQ6jec", self.account.address_from_spend(TxOut(0, p2pkh)))
+        with self.assertRaises(ValueError):
+            self.account.address_from_spend(TxOut(0, b'\x6a\x04abcd'))
+
+    def test_push(self):
+        for size in (0, 1, 75, 76, 255, 256, 70000):
+            data = b'\x01' * size
+            script = rawscript.push(data) + b'\xae'
+            ops = list(rawscript.iter_ops(script))
+            self.assertEqual(data, ops[0][1].tobytes())
+            self.assertEqual((rawscript.OP_CHECKMULTISIG, None, len(script)), ops[1])
+            self.assertEqual([data], [d.tobytes() for d in rawscript.pushes(script[:-1])])
+            self.assertEqual(rawscript.push(data), rawscript.push(memoryview(data)))
+        self.assertIsNone(rawscript.pushes(b'\x4c'))
+
+    def test_fixed_input_script(self):
+        signature = b'\x30' * 71
+        script = compile("OP_0 %s %s %s" % (b2h(DUMMY_SIGNATURE), b2h(signature), b2h(self.redeem_script)))
+        # the same result as rewriting the disassembled text
+        expected = compile(' '.join('OP_0' if op == b2h(DUMMY_SIGNATURE) else op for op in opcode_list(script)))
+        self.assertEqual(expected, fixed_input_script(script))
+        self.assertIs(script, rawscript.replace_pushes(script, b'\x02' * 71, b''))
@@ -0,0 +1,112 @@
+"""
+A local stand-in Electrum server for tests and benchmarks.  Requires Python 3.5 or later.
+
+Each request is answered after a random delay, so responses are generally out of request order.
+"""
+import asyncio
+import hashlib
+import json
+import random
+
+from pycoin.serialize import b2h_rev, b2h
+from pycoin.tx.TxOut import standard_tx_out_script
+
+__author__ = 'devrandom'
+
+
+class StandInElectrumServer(object):
+    def __init__(self, unspents=None, max_delay=0.0, seed=1, drop_after=None):
+        """
+        :param unspents: coin values by address
+        :type unspents: dict[str, list[int]]
+        :param float max_delay: maximum response delay, in seconds
+        :param int drop_after: close each connection when it receives more requests than this, dropping
+            the responses that were not sent yet
+        """
+        self.unspents = unspents or {}
+        self.max_delay = max_delay
+        self.drop_after = drop_after
+        self.requests = 0
+        self.connections = 0
+        self.max_in_flight = 0
+        self._in_flight = 0
+        self._random = random.Random(seed)
+        self._server = None
+        self._subscribers = {}
+
+    def _address_for_scripthash(self, h):
+        for address in self.unspents:
+            if b2h_rev(hashlib.sha256(standard_tx_out_script(address)).digest()) == h:
+                return address
+        return None
+
+    def _status(self, address):
+        if not self.unspents.get(address):
+            return None
+        return b2h(hashlib.sha256(json.dumps(self.unspents[address]).encode('utf8')).digest())
+
+    def pay(self, address, value):
+        """Add an unspent output to the address, and notify its subscribers"""
+        self.unspents.setdefault(address, []).append(value)
+        h = b2h_rev(hashlib.sha256(standard_tx_out_script(address)).digest())
+        notification = {"method": "blockchain.scripthash.subscribe", "params": [h, self._status(address)]}
+        for writer in self._subscribers.get(h, []):
+            writer.write((json.dumps(notification) + "\n").encode('utf8'))
+
+    async def start(self, host='127.0.0.1', port=0):
+        """
+        :return: the port
+        :rtype: int
+        """
+        self._server = await asyncio.start_server(self._handle, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    def result(self, method, params):
+        if method == "server.version":
+            return "stand-in 1.0"
+        if method == "server.ping":
+            return None
+        if method == "blockchain.address.listunspent":
+            return [{"tx_hash": b2h_rev(bytes(bytearray([n] * 32))), "tx_pos": n, "value": value, "height": 1}
+                    for n, value in enumerate(self.unspents.get(params[0], []))]
+        if method == "blockchain.address.get_history":
+            return [{"tx_hash": b2h_rev(bytes(bytearray([n] * 32))), "height": 1}
+                    for n in range(len(self.unspents.get(params[0], [])))]
+        if method == "blockchain.scripthash.subscribe":
+            return self._status(self._address_for_scripthash(params[0]))
+        if method == "blockchain.scripthash.listunspent":
+            return self.result("blockchain.address.listunspent", [self._address_for_scripthash(params[0])])
+        raise ValueError("unknown method %s" % (method,))
+
+    async def _respond(self, writer, request):
+        self._in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self._in_flight)
+        try:
+            if self.max_delay:
+                await asyncio.sleep(self._random.uniform(0, self.max_delay))
+            if request["method"] == "blockchain.scripthash.subscribe":
+                self._subscribers.setdefault(request["params"][0], []).append(writer)
+            try:
+                response = {"id": request["id"], "result": self.result(request["method"], request["params"])}
+            except ValueError as e:
+                response = {"id": request["id"], "error": str(e)}
+            writer.write((json.dumps(response) + "\n").encode('utf8'))
+        finally:
+            self._in_flight -= 1
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        tasks = []
+        while True:
+            line = await reader.readline()
+            if not line or len(tasks) == self.drop_after:
+                break
+            self.requests += 1
+            tasks.append(asyncio.ensure_future(self._respond(writer, json.loads(line.decode('utf8')))))
+        for task in tasks:
+            task.cancel()
+        writer.close()
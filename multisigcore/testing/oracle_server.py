@@ -0,0 +1,75 @@
+"""
+A local stand-in Oracle server for tests.  Requires Python 3.5 or later and aiohttp.
+"""
+import asyncio
+import json
+
+from aiohttp import web
+
+from multisigcore.oracle_async import AsyncOracle, make_session
+
+__author__ = 'devrandom'
+
+
+class StandInOracleServer(object):
+    def __init__(self, respond=None, delay=0.01):
+        """
+        :param respond: called with the number of the request, counting from 1, and its body.  Returns the status
+            code and the JSON result.
+        :param float delay: response delay, in seconds
+        """
+        self.respond = respond
+        self.delay = delay
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._runner = None
+
+    async def _handle(self, request):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            body = await request.read()
+            self.requests.append((request.method, request.path, body))
+            n = len(self.requests)
+            await asyncio.sleep(self.delay)
+            status, result = self.respond(n, body)
+            return web.Response(status=status, body=json.dumps(result).encode('utf8'))
+        finally:
+            self.in_flight -= 1
+
+    async def start(self, host='127.0.0.1', port=0):
+        """
+        :return: the base URL
+        :rtype: str
+        """
+        app = web.Application()
+        app.router.add_route('*', '/{tail:.*}', self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        return "http://%s:%d/" % (host, site._server.sockets[0].getsockname()[1])
+
+    async def close(self):
+        await self._runner.cleanup()
+
+
+async def sign_concurrently(account, tx_db, base_url, tx, input_chain_paths, output_chain_paths, count, oracles=2,
+                            concurrency=4):
+    """
+    Sign a transaction count times with spend ids "00", "01", ..., on oracles that share a session and a semaphore
+
+    :return: the results, in spend id order
+    :rtype: list[multisigcore.oracle.SignatureResult]
+    """
+    session = make_session()
+    semaphore = asyncio.Semaphore(concurrency)
+    clients = [AsyncOracle(account, tx_db=tx_db, base_url=base_url, session=session, semaphore=semaphore, backoff=0)
+               for _ in range(oracles)]
+    try:
+        return await asyncio.gather(*[
+            clients[n % oracles].sign_with_paths(tx, input_chain_paths, output_chain_paths, spend_id="%02d" % n)
+            for n in range(count)])
+    finally:
+        await session.close()
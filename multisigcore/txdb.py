@@ -0,0 +1,103 @@
+import threading
+from multiprocessing.pool import ThreadPool
+
+from pycoin.serialize import b2h
+
+from .cache import LRUCache
+
+__author__ = 'devrandom'
+
+DEFAULT_THREADS = 8
+DEFAULT_MAX_SIZE = 1000
+
+
+class InputTxResolver(object):
+    """
+    Look up the previous transactions spent by a transaction, serialized as hex, for oracle requests.
+
+    Lookups are deduplicated by hash, so that a transaction funding several inputs is looked up and serialized
+    once.  Transactions not cached yet are looked up concurrently on a bounded thread pool.
+    :meth:`prefetch` starts the lookups without waiting, so that they are done by the time we sign.
+    """
+    def __init__(self, tx_db, threads=DEFAULT_THREADS, max_size=DEFAULT_MAX_SIZE):
+        """
+        :param tx_db: lookup database for transactions - see pycoin.services.get_tx_db()
+        :param int threads: maximum number of concurrent lookups
+        :param int max_size: maximum number of serialized transactions kept
+        """
+        self.tx_db = tx_db
+        self.threads = threads
+        self._cache = LRUCache(max_size)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def _lookup(self, tx_hash):
+        try:
+            tx = self.tx_db.get(tx_hash)
+            tx_hex = None if tx is None else b2h(tx.as_bin())
+            with self._lock:
+                if tx_hex is not None:
+                    self._cache[tx_hash] = tx_hex
+                return tx_hex
+        finally:
+            with self._lock:
+                self._pending.pop(tx_hash, None)
+
+    def _start(self, tx_hashes):
+        """Start lookups for the hashes that are neither cached nor pending.  Call with the lock held.
+
+        :return: the cached transactions, and the pending lookups, by hash
+        """
+        cached = {}
+        pending = {}
+        for tx_hash in tx_hashes:
+            if tx_hash in cached or tx_hash in pending:
+                continue
+            tx_hex = self._cache.get(tx_hash)
+            if tx_hex is not None:
+                cached[tx_hash] = tx_hex
+                continue
+            if tx_hash not in self._pending:
+                if self._pool is None:
+                    self._pool = ThreadPool(self.threads)
+                self._pending[tx_hash] = self._pool.apply_async(self._lookup, (tx_hash,))
+            pending[tx_hash] = self._pending[tx_hash]
+        return cached, pending
+
+    def prefetch(self, tx_hashes):
+        """
+        Start looking up transactions in the background
+
+        :param tx_hashes: transaction hashes
+        """
+        with self._lock:
+            self._start(tx_hashes)
+
+    def resolve(self, tx_hashes):
+        """
+        Look up transactions, waiting for the lookups that are not done yet
+
+        :param tx_hashes: transaction hashes, possibly repeated
+        :return: the serialized transactions as hex, or None if not found, by hash
+        :rtype: dict[bytes, str]
+        """
+        with self._lock:
+            result, pending = self._start(tx_hashes)
+        for tx_hash, lookup in pending.items():
+            result[tx_hash] = lookup.get()
+        return result
+
+    def stats(self):
+        """:rtype: dict"""
+        with self._lock:
+            stats = self._cache.stats()
+            stats['pending'] = len(self._pending)
+            return stats
+
+    def close(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.terminate()
+            pool.join()
@@ -0,0 +1,153 @@
+"""
+A persistent local set of unspent outputs, so that balances and transactions do not need a provider round trip.
+
+The store is reconciled with a provider by :meth:`UTXOStore.update`, and is updated locally as we spend -
+inputs of our own transactions are marked spent, and their change outputs are added as pending until the
+provider reports them.  Inputs of a transaction that will not be completed are released again.
+"""
+import sqlite3
+import threading
+import time
+
+from pycoin.tx import Spendable
+
+__author__ = 'devrandom'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS utxo (
+    tx_hash BLOB NOT NULL,
+    tx_out_index INTEGER NOT NULL,
+    coin_value INTEGER NOT NULL,
+    script BLOB NOT NULL,
+    path TEXT,
+    spent INTEGER NOT NULL DEFAULT 0,
+    pending INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (tx_hash, tx_out_index)
+);
+CREATE INDEX IF NOT EXISTS utxo_path ON utxo (path);
+CREATE INDEX IF NOT EXISTS utxo_script ON utxo (script);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class UTXOStore(object):
+    """
+    Unspent outputs in an SQLite database, keyed by outpoint and indexed by path and script.
+
+    Outputs have two flags - spent, if one of our transactions spends them, and pending, if we added them
+    locally (e.g. change) and the provider did not report them yet.
+
+    The store can be used from several threads.
+    """
+
+    def __init__(self, filename=':memory:'):
+        """
+        :param str filename: the database file, by default an in-memory database
+        """
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        self._lock = threading.RLock()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    @property
+    def last_sync(self):
+        """The time of the last full update from a provider, or None if there was none
+        :rtype: float"""
+        with self._lock:
+            row = self._db.execute("SELECT value FROM meta WHERE key = 'last_sync'").fetchone()
+        return float(row[0]) if row else None
+
+    def spendables(self):
+        """
+        :return: the unspent outputs, ordered by outpoint
+        :rtype: list[pycoin.tx.Spendable.Spendable]
+        """
+        with self._lock:
+            rows = self._db.execute("SELECT coin_value, script, tx_hash, tx_out_index FROM utxo WHERE spent = 0 "
+                                    "ORDER BY tx_hash, tx_out_index").fetchall()
+        return [Spendable(coin_value, bytes(script), bytes(tx_hash), tx_out_index)
+                for coin_value, script, tx_hash, tx_out_index in rows]
+
+    def balance(self):
+        """Total value of the unspent outputs"""
+        with self._lock:
+            return self._db.execute("SELECT COALESCE(SUM(coin_value), 0) FROM utxo WHERE spent = 0").fetchone()[0]
+
+    def update(self, entries, paths=None):
+        """
+        Reconcile with the unspent outputs reported by a provider.
+
+        Reported outputs are added, or stop being pending.  Outputs that were not reported are removed, unless
+        they are pending and unspent.  Outputs that we marked spent stay spent while they are still reported.
+
+        :param entries: the reported outputs with their paths
+        :type entries: list[(pycoin.tx.Spendable.Spendable, str)]
+        :param paths: the paths that were queried, or None if all paths were queried
+        :type paths: list[str]
+        """
+        with self._lock, self._db:
+            reported = set()
+            for spend, path in entries:
+                reported.add((bytes(spend.tx_hash), spend.tx_out_index))
+                self._db.execute("INSERT OR IGNORE INTO utxo (tx_hash, tx_out_index, coin_value, script, path) "
+                                 "VALUES (?, ?, ?, ?, ?)",
+                                 (sqlite3.Binary(spend.tx_hash), spend.tx_out_index, spend.coin_value,
+                                  sqlite3.Binary(spend.script), path))
+                self._db.execute("UPDATE utxo SET pending = 0 WHERE tx_hash = ? AND tx_out_index = ?",
+                                 (sqlite3.Binary(spend.tx_hash), spend.tx_out_index))
+            if paths is None:
+                rows = self._db.execute("SELECT tx_hash, tx_out_index FROM utxo "
+                                        "WHERE pending = 0 OR spent = 1").fetchall()
+            else:
+                rows = []
+                for path in paths:
+                    rows.extend(self._db.execute("SELECT tx_hash, tx_out_index FROM utxo "
+                                                 "WHERE (pending = 0 OR spent = 1) AND path = ?", (path,)))
+            gone = [(tx_hash, tx_out_index) for tx_hash, tx_out_index in rows
+                    if (bytes(tx_hash), tx_out_index) not in reported]
+            self._db.executemany("DELETE FROM utxo WHERE tx_hash = ? AND tx_out_index = ?", gone)
+            if paths is None:
+                self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('last_sync', ?)",
+                                 (repr(time.time()),))
+
+    def add(self, spend, path, pending=True):
+        """
+        Add an output that we created, such as change
+
+        :type spend: pycoin.tx.Spendable.Spendable
+        :param str path: the path of the output
+        :param bool pending: whether to keep the output until a provider reports it
+        """
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO utxo (tx_hash, tx_out_index, coin_value, script, path, pending) "
+                             "VALUES (?, ?, ?, ?, ?, ?)",
+                             (sqlite3.Binary(spend.tx_hash), spend.tx_out_index, spend.coin_value,
+                              sqlite3.Binary(spend.script), path, 1 if pending else 0))
+
+    def mark_spent(self, outpoints):
+        """
+        Mark outputs as spent by one of our transactions
+
+        :param outpoints: tx_hash and tx_out_index pairs
+        :type outpoints: list[(bytes, int)]
+        """
+        with self._lock, self._db:
+            self._db.executemany("UPDATE utxo SET spent = 1 WHERE tx_hash = ? AND tx_out_index = ?",
+                                 [(sqlite3.Binary(tx_hash), tx_out_index) for tx_hash, tx_out_index in outpoints])
+
+    def release(self, outpoints):
+        """
+        Undo :meth:`mark_spent` for outputs of a transaction that will not be completed or broadcast
+
+        :param outpoints: tx_hash and tx_out_index pairs
+        :type outpoints: list[(bytes, int)]
+        """
+        with self._lock, self._db:
+            self._db.executemany("UPDATE utxo SET spent = 0 WHERE tx_hash = ? AND tx_out_index = ?",
+                                 [(sqlite3.Binary(tx_hash), tx_out_index) for tx_hash, tx_out_index in outpoints])
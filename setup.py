@@ -51,6 +51,9 @@ setup(
         'urllib3',
         'python-dateutil'
     ],
+    extras_require={
+        'async': ['aiohttp']
+    },
     tests_require=[
         'httmock',
         'mock',